@@ -2,14 +2,13 @@
 
 WITH users as -- Select users to potentially message
 (
-SELECT record_id, geometry
+SELECT record_id, geometry_utm
 FROM internal."Sign Up Information"
 WHERE record_id = ANY ( ARRAY[1,2,3,4,5] ) -- inserted record_ids
 )
 SELECT u.record_id, MAX(p.last_elevated) as last_elevated
 FROM users u, internal."PurpleAir Stations" p
-WHERE ST_DWithin(ST_Transform(u.geometry,26915), -- query for users within the distance from the sensor
-										    ST_Transform(p.geometry, 26915),1000); --1609.34 meters in a mile
+WHERE ST_DWithin(u.geometry_utm, p.geometry_utm, 1000) -- query for users within the distance from the sensor, 1609.34 meters in a mile
 GROUP BY u.record_id;
 
 -- VIEW? Find alerts' last_seen (CTE) <- Could be changed to last_elevated
@@ -31,9 +30,7 @@ GROUP BY a.alert_index;
 with buff as
 	(
 	SELECT ST_Transform(
-			ST_Buffer(
-			ST_Transform(s.geometry,26915),
-					1000),
+			ST_Buffer(s.geometry_utm, 1000),
 					4326) as geom 
 	FROM internal."PurpleAir Stations" s
 	WHERE s.channel_state = 3 AND s.channel_flags = 0
@@ -123,13 +120,12 @@ INNER JOIN internal."PurpleAir Stations" p ON (p.sensor_index = a.sensor_index);
 
 WITH sensor as -- query for the desired sensor
     (
-    SELECT sensor_index, geometry
+    SELECT sensor_index, geometry_utm
     FROM internal."PurpleAir Stations"
     WHERE sensor_index = 156605
     )
     SELECT *
     FROM internal."Sign Up Information" u, sensor s
-    WHERE u.subscribed = TRUE AND ST_DWithin(ST_Transform(u.geometry,26915), -- query for users within the distance from the sensor
-										    ST_Transform(s.geometry, 26915),1000); --1609.34 meters in a mile
+    WHERE u.subscribed = TRUE AND ST_DWithin(u.geometry_utm, s.geometry_utm, 1000); -- query for users within the distance from the sensor, 1609.34 meters in a mile
 										    
 										    
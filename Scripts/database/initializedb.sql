@@ -13,7 +13,7 @@
 --CREATE EXTENSION postgis_topology;
 
 CREATE table internal."Daily Log" -- This is to store important daily metrics
-    ("date" date DEFAULT CURRENT_DATE,
+    ("date" date DEFAULT CURRENT_DATE UNIQUE, -- One row per day (Send_Alerts.update_user_table adds to it)
      new_users int,
      messages_sent int DEFAULT 0,
      segments_sent int DEFAULT 0,
@@ -24,12 +24,14 @@ CREATE table internal."Sign Up Information"-- This is our internal record keepin
 	(record_id integer, -- Unique Identifier from REDCap
 	last_messaged timestamp DEFAULT CURRENT_DATE + INTERVAL '8 hours', -- Last time messaged
 	messages_sent int DEFAULT 1, -- Number of messages sent
-	active_alerts bigint [] DEFAULT array[]::bigint [], -- List of Active Alerts
-	cached_alerts bigint [] DEFAULT array[]::bigint [], -- List of ended Alerts not yet notified about
 	subscribed boolean DEFAULT TRUE, -- Is the user wanting texts? 
-	geometry geometry);
+	geometry geometry(Point, 4326),
+	geometry_utm geometry(Point, 26915) -- Projected to UTM 15N (meters), kept in sync automatically
+		GENERATED ALWAYS AS (ST_Transform(ST_SetSRID(geometry, 4326), 26915)) STORED);
 	
 CREATE INDEX user_gid ON internal."Sign Up Information" USING GIST(geometry);  -- Create spatial index
+CREATE INDEX user_utm_gid ON internal."Sign Up Information" USING GIST(geometry_utm);  -- Create projected spatial index
+CREATE INDEX user_record_id ON internal."Sign Up Information" (record_id);
 	
 CREATE table internal."Reports Archive"-- These are for reporting to the City and future research
 	(report_id varchar(12), -- Unique Identifier with format #####-MMDDYY
@@ -50,14 +52,21 @@ CREATE table internal."Active Alerts Acute PurpleAir"
 	(alert_index bigserial, -- Unique identifier for an air quality spike alert
 	 sensor_indices int [] DEFAULT array[]::int [], -- List of Sensor Unique Identifiers 
 	  start_time timestamp,
-	   max_reading float); -- Maximum value registered from all sensors
+	   max_reading float, -- Maximum value registered from all sensors
+	   mean_reading float, -- Running mean of the readings from all sensors
+	   sample_count int DEFAULT 1); -- Number of readings in the mean
+
+CREATE INDEX active_alerts_sensor_indices ON internal."Active Alerts Acute PurpleAir" USING GIN(sensor_indices); -- Alerts holding any of these sensors (&&)
 
 CREATE table internal."Archived Alerts Acute PurpleAir" -- Archive of the Above table
     (alert_index bigint,
     sensor_indices int [], -- List of Sensor Unique Identifiers 
     start_time timestamp,
     duration_minutes integer,
-    max_reading float);
+    max_reading float,
+    mean_reading float,
+    sample_count int,
+    merged_into bigint); -- The alert it was merged into (New_Alerts.Merge_alerts), NULL if it ended
     
 CREATE TABLE internal."PurpleAir Stations" -- See PurpleAir API - https://api.purpleair.com/
 (
@@ -70,15 +79,84 @@ CREATE TABLE internal."PurpleAir Stations" -- See PurpleAir API - https://api.pu
 	channel_state int,
 	channel_flags int,
 	altitude int,
-	geometry geometry
+	geometry geometry(Point, 4326),
+	geometry_utm geometry(Point, 26915) -- Projected to UTM 15N (meters), kept in sync automatically
+		GENERATED ALWAYS AS (ST_Transform(ST_SetSRID(geometry, 4326), 26915)) STORED
 );
 
 CREATE INDEX PurpleAir_gid ON internal."PurpleAir Stations" USING GIST(geometry);  -- Create spatial index for stations
+CREATE INDEX PurpleAir_utm_gid ON internal."PurpleAir Stations" USING GIST(geometry_utm);  -- Create projected spatial index for stations
 
 CREATE TABLE internal."Minneapolis Boundary"-- From MN Geocommons - https://gisdata.mn.gov/dataset/us-mn-state-metc-bdry-census2020counties-ctus
 (
     "CTU_ID" int, -- Unique Identifier
     "CTU_NAME" text, -- City/Township Name
     "CTU_CODE" text, -- City/Township Code
-    geometry geometry -- Polygon
+    geometry geometry(Geometry, 4326), -- Polygon
+    geometry_utm geometry(Geometry, 26915) -- Projected to UTM 15N (meters), kept in sync automatically
+    	GENERATED ALWAYS AS (ST_Transform(ST_SetSRID(geometry, 4326), 26915)) STORED
+);
+
+CREATE INDEX boundary_utm_gid ON internal."Minneapolis Boundary" USING GIST(geometry_utm);
+
+CREATE TABLE internal.sensor_subscriber -- Precomputed subscribed users within 1000 meters of each active sensor (see Sensor_Subscriber.py)
+(
+    sensor_index int,
+    record_id integer,
+    distance_m float, -- Distance in meters between the sensor and the user's location
+    PRIMARY KEY (sensor_index, record_id)
+);
+
+CREATE INDEX sensor_subscriber_record_id ON internal.sensor_subscriber (record_id);
+
+CREATE TABLE internal.user_alert -- Which alerts each user is in (replaces the active_alerts/cached_alerts arrays)
+(
+    record_id integer, -- Unique Identifier from REDCap
+    alert_index bigint, -- Unique identifier for an air quality spike alert
+    state varchar(6) DEFAULT 'active' CHECK (state IN ('active', 'cached')), -- active, or cached = ended but not yet notified about
+    ts timestamp DEFAULT CURRENT_TIMESTAMP AT TIME ZONE 'America/Chicago', -- When the state last changed
+    PRIMARY KEY (record_id, alert_index)
+);
+
+CREATE INDEX user_alert_alert_index ON internal.user_alert (alert_index);
+
+CREATE VIEW internal.user_alert_arrays AS -- Compatibility view with the old array columns
+SELECT u.*,
+	ARRAY(SELECT ua.alert_index FROM internal.user_alert ua
+		WHERE ua.record_id = u.record_id AND ua.state = 'active' ORDER BY ua.alert_index) as active_alerts, -- List of Active Alerts
+	ARRAY(SELECT ua.alert_index FROM internal.user_alert ua
+		WHERE ua.record_id = u.record_id AND ua.state = 'cached' ORDER BY ua.alert_index) as cached_alerts -- List of ended Alerts not yet notified about
+FROM internal."Sign Up Information" u;
+
+CREATE TABLE internal.api_usage -- PurpleAir API points spent per day (see PurpleAir_Budget.py)
+(
+    day date PRIMARY KEY, -- America/Chicago
+    calls int DEFAULT 0, -- Number of API calls
+    rows bigint DEFAULT 0, -- Sensors (rows) returned
+    points bigint DEFAULT 0 -- Estimated points spent
+);
+
+CREATE TABLE internal.readings -- Every reading fetched from PurpleAir, partitioned by UTC day (readings_YYYYMMDD - see Readings_Table.py)
+(
+    ts timestamptz NOT NULL, -- When we queried PurpleAir (UTC, so the repeated hour when daylight saving time ends can't collide)
+    sensor_index integer NOT NULL, -- Unique Identifier from PurpleAir
+    pm25 real, -- pm2.5_10minute
+    channel_flags smallint,
+    last_seen timestamptz,
+    PRIMARY KEY (sensor_index, ts)
+) PARTITION BY RANGE (ts);
+
+CREATE INDEX readings_ts_brin ON internal.readings USING BRIN (ts);
+
+CREATE TABLE internal.opt_out -- Phone numbers that have texted us a stop word (see Opt_Outs.py)
+(
+    phone text PRIMARY KEY, -- E.164 (+1XXXXXXXXXX)
+    opted_out_at timestamp, -- When they texted us (America/Chicago)
+    keyword text -- What they texted
+);
+
+CREATE TABLE internal.opt_out_sync -- How far we have read Twilio's inbound messages (see Opt_Outs.py)
+(
+    id boolean PRIMARY KEY DEFAULT TRUE CHECK (id), -- Only one row
+    last_date_sent timestamptz -- The newest inbound message read
 );
@@ -0,0 +1,221 @@
+-- Run this file to bring a database created with an older initializedb.sql up to date
+-- Every statement is safe to run more than once
+-- You can run this by using a psql command like:
+-- psql "host=postgres.cla.umn.edu user=<your_username> password=<your_password> " -f upgradedb.sql
+
+-- One "Daily Log" row per day (Send_Alerts.update_user_table - overlapping send batches add to the same row)
+
+DO $$
+BEGIN
+	IF NOT EXISTS (SELECT 1 FROM pg_constraint
+				WHERE conrelid = 'internal."Daily Log"'::regclass AND contype = 'u') THEN
+		
+		WITH removed as -- Collapse days logged more than once
+		(
+		DELETE FROM internal."Daily Log"
+		RETURNING *
+		)
+		INSERT INTO internal."Daily Log" ("date", new_users, messages_sent, segments_sent, reports_for_day)
+		SELECT "date", SUM(new_users), SUM(messages_sent), SUM(segments_sent), SUM(reports_for_day)
+		FROM removed
+		GROUP BY "date";
+		
+		ALTER TABLE internal."Daily Log"
+			ADD CONSTRAINT daily_log_date_key UNIQUE ("date");
+	END IF;
+END $$;
+
+-- Running mean/sample count of alert readings (Ongoing_Alerts.Update_alert_readings)
+
+ALTER TABLE internal."Active Alerts Acute PurpleAir"
+	ADD COLUMN IF NOT EXISTS mean_reading float, -- Running mean of the readings from all sensors
+	ADD COLUMN IF NOT EXISTS sample_count int DEFAULT 1; -- Number of readings in the mean
+
+UPDATE internal."Active Alerts Acute PurpleAir"
+SET mean_reading = max_reading
+WHERE mean_reading IS NULL;
+
+CREATE INDEX IF NOT EXISTS active_alerts_sensor_indices ON internal."Active Alerts Acute PurpleAir" USING GIN(sensor_indices); -- Alerts holding any of these sensors (&&)
+
+ALTER TABLE internal."Archived Alerts Acute PurpleAir"
+	ADD COLUMN IF NOT EXISTS mean_reading float,
+	ADD COLUMN IF NOT EXISTS sample_count int;
+
+-- Alerts merged into another alert are archived too (New_Alerts.Merge_alerts)
+
+ALTER TABLE internal."Archived Alerts Acute PurpleAir"
+	ADD COLUMN IF NOT EXISTS merged_into bigint; -- The alert it was merged into, NULL if it ended
+
+-- Precomputed sensor to subscriber proximity (Sensor_Subscriber.py)
+
+CREATE INDEX IF NOT EXISTS user_record_id ON internal."Sign Up Information" (record_id);
+
+CREATE TABLE IF NOT EXISTS internal.sensor_subscriber -- Subscribed users within 1000 meters of each active sensor
+(
+    sensor_index int,
+    record_id integer,
+    distance_m float, -- Distance in meters between the sensor and the user's location
+    PRIMARY KEY (sensor_index, record_id)
+);
+
+CREATE INDEX IF NOT EXISTS sensor_subscriber_record_id ON internal.sensor_subscriber (record_id);
+
+INSERT INTO internal.sensor_subscriber (sensor_index, record_id, distance_m)
+SELECT s.sensor_index, u.record_id,
+    ST_Distance(ST_Transform(u.geometry, 26915), ST_Transform(s.geometry, 26915))
+FROM internal."Sign Up Information" u, internal."PurpleAir Stations" s
+WHERE u.subscribed = TRUE AND s.channel_state <> 0
+    AND ST_DWithin(ST_Transform(u.geometry, 26915), ST_Transform(s.geometry, 26915), 1000)
+ON CONFLICT DO NOTHING;
+
+-- Projected geometry columns (UTM 15N, meters) so distance queries can use the spatial indexes
+
+-- Only once per table - geometry can't change type after geometry_utm (and later the user_alert_arrays view) depend on it
+
+DO $$
+DECLARE
+	t record;
+BEGIN
+	FOR t IN SELECT * FROM (VALUES ('Sign Up Information', 'Point'),
+	                               ('PurpleAir Stations', 'Point'),
+	                               ('Minneapolis Boundary', 'Geometry')) AS x(table_name, geometry_type)
+	LOOP
+		IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+		               WHERE table_schema = 'internal' AND table_name = t.table_name AND column_name = 'geometry_utm') THEN
+			EXECUTE format('ALTER TABLE internal.%I
+				ALTER COLUMN geometry TYPE geometry(%s, 4326) USING ST_SetSRID(geometry, 4326),
+				ADD COLUMN geometry_utm geometry(%s, 26915)
+					GENERATED ALWAYS AS (ST_Transform(ST_SetSRID(geometry, 4326), 26915)) STORED;',
+				t.table_name, t.geometry_type, t.geometry_type);
+		END IF;
+	END LOOP;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS user_utm_gid ON internal."Sign Up Information" USING GIST(geometry_utm);
+CREATE INDEX IF NOT EXISTS PurpleAir_utm_gid ON internal."PurpleAir Stations" USING GIST(geometry_utm);
+CREATE INDEX IF NOT EXISTS boundary_utm_gid ON internal."Minneapolis Boundary" USING GIST(geometry_utm);
+
+ANALYZE internal."Sign Up Information";
+ANALYZE internal."PurpleAir Stations";
+
+-- Normalized user to alert association (replaces the active_alerts/cached_alerts arrays)
+
+CREATE TABLE IF NOT EXISTS internal.user_alert
+(
+    record_id integer, -- Unique Identifier from REDCap
+    alert_index bigint, -- Unique identifier for an air quality spike alert
+    state varchar(6) DEFAULT 'active' CHECK (state IN ('active', 'cached')), -- active, or cached = ended but not yet notified about
+    ts timestamp DEFAULT CURRENT_TIMESTAMP AT TIME ZONE 'America/Chicago', -- When the state last changed
+    PRIMARY KEY (record_id, alert_index)
+);
+
+CREATE INDEX IF NOT EXISTS user_alert_alert_index ON internal.user_alert (alert_index);
+
+DO $$
+BEGIN
+	IF EXISTS (SELECT 1 FROM information_schema.columns
+				WHERE table_schema = 'internal' AND table_name = 'Sign Up Information' AND column_name = 'active_alerts') THEN
+				
+		INSERT INTO internal.user_alert (record_id, alert_index, state)
+		SELECT u.record_id, a.alert_index, 'active'
+		FROM internal."Sign Up Information" u, unnest(u.active_alerts) as a(alert_index)
+		ON CONFLICT DO NOTHING;
+		
+		INSERT INTO internal.user_alert (record_id, alert_index, state)
+		SELECT u.record_id, c.alert_index, 'cached'
+		FROM internal."Sign Up Information" u, unnest(u.cached_alerts) as c(alert_index)
+		ON CONFLICT DO NOTHING;
+		
+		ALTER TABLE internal."Sign Up Information"
+			DROP COLUMN active_alerts,
+			DROP COLUMN cached_alerts;
+	END IF;
+END $$;
+
+CREATE OR REPLACE VIEW internal.user_alert_arrays AS -- Compatibility view with the old array columns
+SELECT u.*,
+	ARRAY(SELECT ua.alert_index FROM internal.user_alert ua
+		WHERE ua.record_id = u.record_id AND ua.state = 'active' ORDER BY ua.alert_index) as active_alerts, -- List of Active Alerts
+	ARRAY(SELECT ua.alert_index FROM internal.user_alert ua
+		WHERE ua.record_id = u.record_id AND ua.state = 'cached' ORDER BY ua.alert_index) as cached_alerts -- List of ended Alerts not yet notified about
+FROM internal."Sign Up Information" u;
+
+-- PurpleAir API point ledger
+
+CREATE TABLE IF NOT EXISTS internal.api_usage -- PurpleAir API points spent per day (see PurpleAir_Budget.py)
+(
+    day date PRIMARY KEY, -- America/Chicago
+    calls int DEFAULT 0, -- Number of API calls
+    rows bigint DEFAULT 0, -- Sensors (rows) returned
+    points bigint DEFAULT 0 -- Estimated points spent
+);
+
+-- Readings history
+
+-- readings used to be keyed on America/Chicago wall time (timestamp) - set the rows aside to be moved into the UTC (timestamptz) table
+-- (the partition key's type can't be altered in place)
+
+DO $$
+BEGIN
+	IF EXISTS (SELECT 1 FROM information_schema.columns
+				WHERE table_schema = 'internal' AND table_name = 'readings' AND column_name = 'ts'
+					AND data_type = 'timestamp without time zone') THEN
+		
+		CREATE TABLE internal.readings_migrating AS
+		SELECT ts AT TIME ZONE 'America/Chicago' as ts, sensor_index, pm25, channel_flags,
+			last_seen AT TIME ZONE 'America/Chicago' as last_seen
+		FROM internal.readings;
+		
+		DROP TABLE internal.readings; -- and its partitions
+	END IF;
+END $$;
+
+CREATE TABLE IF NOT EXISTS internal.readings -- Every reading fetched from PurpleAir, partitioned by UTC day (readings_YYYYMMDD - see Readings_Table.py)
+(
+    ts timestamptz NOT NULL, -- When we queried PurpleAir (UTC, so the repeated hour when daylight saving time ends can't collide)
+    sensor_index integer NOT NULL, -- Unique Identifier from PurpleAir
+    pm25 real, -- pm2.5_10minute
+    channel_flags smallint,
+    last_seen timestamptz,
+    PRIMARY KEY (sensor_index, ts)
+) PARTITION BY RANGE (ts);
+
+CREATE INDEX IF NOT EXISTS readings_ts_brin ON internal.readings USING BRIN (ts);
+
+DO $$
+DECLARE
+	d date;
+BEGIN
+	IF EXISTS (SELECT 1 FROM information_schema.tables
+				WHERE table_schema = 'internal' AND table_name = 'readings_migrating') THEN
+		
+		FOR d IN SELECT DISTINCT (ts AT TIME ZONE 'UTC')::date FROM internal.readings_migrating
+		LOOP
+			EXECUTE format('CREATE TABLE IF NOT EXISTS internal.%I PARTITION OF internal.readings FOR VALUES FROM (%L) TO (%L);',
+				'readings_' || to_char(d, 'YYYYMMDD'), d::text || ' 00:00:00+00', (d + 1)::text || ' 00:00:00+00');
+		END LOOP;
+		
+		INSERT INTO internal.readings (ts, sensor_index, pm25, channel_flags, last_seen)
+		SELECT ts, sensor_index, pm25, channel_flags, last_seen
+		FROM internal.readings_migrating
+		ON CONFLICT DO NOTHING;
+		
+		DROP TABLE internal.readings_migrating;
+	END IF;
+END $$;
+
+-- Opt-out registry
+
+CREATE TABLE IF NOT EXISTS internal.opt_out -- Phone numbers that have texted us a stop word (see Opt_Outs.py)
+(
+    phone text PRIMARY KEY, -- E.164 (+1XXXXXXXXXX)
+    opted_out_at timestamp, -- When they texted us (America/Chicago)
+    keyword text -- What they texted
+);
+
+CREATE TABLE IF NOT EXISTS internal.opt_out_sync -- How far we have read Twilio's inbound messages (see Opt_Outs.py)
+(
+    id boolean PRIMARY KEY DEFAULT TRUE CHECK (id), -- Only one row
+    last_date_sent timestamptz -- The newest inbound message read
+);
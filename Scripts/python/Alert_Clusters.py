@@ -0,0 +1,174 @@
+# Spatial clustering of spiking sensors into alerts
+# Sensors within cluster_distance of each other (chained - a DBSCAN pass with min_samples = 1) belong to one alert
+# New_Alerts uses it to join new spikes to nearby active alerts (merging alerts a spike connects)
+# Ongoing_Alerts uses it to split alerts whose spiking sensors have drifted apart
+# Clustering is spatial only - every sensor clustered in a tick is spiking in that tick (new spikes and active alerts),
+# so they already overlap in time
+
+## Load modules
+
+from psycopg2 import sql
+import Basic_PSQL as psql
+
+# Data Manipulation
+
+import numpy as np
+import pandas as pd
+import shapely # Needs shapely >= 2.0 for vectorized STRtree queries
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+cluster_distance = 1500 # meters - spiking sensors closer than this are one event
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Get_sensor_xy(sensor_indices, pg_connection_dict):
+    '''
+    Gets the projected coordinates (UTM 15N meters) of sensor_indices (a list of integers)
+
+    returns a pd.DataFrame with columns sensor_index (int), x, y (floats)
+    '''
+
+    cmd = sql.SQL('''SELECT sensor_index, ST_X(geometry_utm), ST_Y(geometry_utm)
+    FROM "PurpleAir Stations"
+    WHERE sensor_index = ANY ( {} );
+    ''').format(sql.Literal([int(sensor_index) for sensor_index in sensor_indices]))
+
+    response = psql.get_response(cmd, pg_connection_dict)
+
+    xy_df = pd.DataFrame(response, columns = ['sensor_index', 'x', 'y'])
+
+    return xy_df
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Label_components(xy, distance = cluster_distance, groups = None):
+    '''
+    Labels the connected components of points xy (np.array n x 2, meters) where points within distance are connected
+    If groups (np.array of n labels) is given, only points in the same group can be connected
+
+    returns a np.array of n integers - every point's component is the position of its first member
+    '''
+
+    n = len(xy)
+
+    if n == 0:
+        return np.array([], dtype = np.int64)
+
+    # Pairs within distance from an STRtree (only the nearby pairs, not all n x n)
+
+    points = shapely.points(np.asarray(xy, dtype = float))
+
+    left, right = shapely.STRtree(points).query(points, predicate = 'dwithin', distance = distance)
+
+    if groups is not None:
+        groups = np.asarray(groups)
+        same_group = groups[left] == groups[right]
+        left, right = left[same_group], right[same_group]
+
+    # Union-find over the pairs - propagate the smallest label along them (with pointer jumping) until nothing changes
+
+    labels = np.arange(n)
+
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, left, labels[right])
+        new_labels = new_labels[new_labels]
+
+        if (new_labels == labels).all():
+            return labels
+
+        labels = new_labels
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Plan_new_alerts(new_sensor_indices, active_sensors_df, pg_connection_dict, distance = cluster_distance):
+    '''
+    Clusters new spiking sensors (a list of integers) with the sensors of the active alerts
+    (active_sensors_df - columns alert_index, sensor_index from query.Get_active_alert_sensors)
+
+    returns
+    plan_df - pd.DataFrame with a row for every new sensor - columns sensor_index, group (int - new sensors in the same new alert),
+                alert_index (the active alert it joins, -1 = a new alert)
+    merges - dictionary of surviving alert_index: list of alert_indices merged into it (a new sensor connected them)
+    '''
+
+    new_sensor_indices = [int(sensor_index) for sensor_index in new_sensor_indices]
+
+    points_df = pd.concat([pd.DataFrame({'sensor_index': new_sensor_indices, 'alert_index': -1}),
+                           active_sensors_df[['sensor_index', 'alert_index']]],
+                          ignore_index = True).drop_duplicates('sensor_index')
+
+    xy_df = Get_sensor_xy(points_df.sensor_index.to_list(), pg_connection_dict)
+
+    points_df = points_df.merge(xy_df, on = 'sensor_index', how = 'left')
+
+    # Sensors without a location are a cluster of their own
+
+    located = points_df.x.notna().to_numpy()
+
+    groups = len(points_df) + np.arange(len(points_df))
+    groups[located] = Label_components(points_df[located][['x', 'y']].astype(float).to_numpy(), distance)
+
+    points_df['group'] = groups
+
+    # Which active alerts are in each group? The oldest (lowest alert_index) survives
+
+    existing_df = points_df[points_df.alert_index >= 0]
+    survivors = existing_df.groupby('group').alert_index.min()
+
+    merges = {}
+
+    for group, alert_indices in existing_df.groupby('group').alert_index:
+        alert_indices = sorted(set(alert_indices))
+        if len(alert_indices) > 1 and group in set(points_df[points_df.alert_index < 0].group):
+            merges[int(alert_indices[0])] = [int(i) for i in alert_indices[1:]]
+
+    plan_df = points_df[points_df.alert_index < 0][['sensor_index', 'group']].copy()
+    plan_df['alert_index'] = plan_df.group.map(survivors).fillna(-1).astype(int)
+
+    return plan_df.reset_index(drop = True), merges
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Plan_splits(spiking_sensors_df, pg_connection_dict, distance = cluster_distance):
+    '''
+    Finds active alerts whose currently spiking sensors are no longer one cluster
+
+    spiking_sensors_df - pd.DataFrame with columns alert_index, sensor_index of the alerts' currently spiking sensors
+
+    returns a pd.DataFrame with columns parent (alert_index), part (int), sensor_index
+    for the sensors to move into new alerts (the largest part stays in the parent alert)
+    '''
+
+    empty_df = pd.DataFrame({'parent': pd.Series(dtype = int), 'part': pd.Series(dtype = int), 'sensor_index': pd.Series(dtype = int)})
+
+    # Only alerts with at least 2 spiking sensors can split
+
+    counts = spiking_sensors_df.alert_index.value_counts()
+    points_df = spiking_sensors_df[spiking_sensors_df.alert_index.isin(counts[counts > 1].index)].copy()
+
+    if len(points_df) == 0:
+        return empty_df
+
+    xy_df = Get_sensor_xy(points_df.sensor_index.to_list(), pg_connection_dict)
+    points_df = points_df.merge(xy_df, on = 'sensor_index', how = 'inner')
+
+    # One pass for every alert - sensors in different alerts are never connected
+
+    points_df['part'] = Label_components(points_df[['x', 'y']].astype(float).to_numpy(), distance,
+                                         groups = points_df.alert_index.to_numpy())
+
+    # Keep the biggest part (then the lowest label) in the parent, the rest move
+
+    sizes = points_df.groupby(['alert_index', 'part']).size().reset_index(name = 'n')
+    sizes = sizes.sort_values(['alert_index', 'n', 'part'], ascending = [True, False, True])
+    kept = sizes.drop_duplicates('alert_index')
+
+    moving_df = points_df.merge(kept[['alert_index', 'part']], on = ['alert_index', 'part'], how = 'left', indicator = True)
+    moving_df = moving_df[moving_df._merge == 'left_only']
+
+    if len(moving_df) == 0:
+        return empty_df
+
+    return moving_df.rename(columns = {'alert_index': 'parent'})[['parent', 'part', 'sensor_index']].reset_index(drop = True)
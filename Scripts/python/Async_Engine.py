@@ -0,0 +1,383 @@
+# An asyncio engine for the real-time part of each tick (GetSort_Spikes.workflow -> Send_Alerts.send_all_messages)
+# PurpleAir and REDCap are called over one aiohttp session, so calls don't block each other
+# and independent steps run together - PurpleAir chunks at once, phone number lookups alongside unsubscribe checks
+# The event loop runs on its own thread, so MAIN.py's send stage (see Scheduler.py) drains a tick's texts
+# while the next tick fetches
+# What stays blocking, on worker threads (asyncio.to_thread):
+# - the database - psycopg2 (pooled, see Basic_PSQL.py), every query is composed with psycopg2.sql
+# - texts - our_twilio.Send_messages, so both engines share its token bucket and retries
+# - new and ongoing alerts - one after the other, they UPDATE the same alert rows and together they can deadlock
+# Turn it on with ASYNC_ENGINE='true' in the .env file (see MAIN.py)
+
+## Load modules
+
+import asyncio
+import aiohttp
+import threading # The event loop's thread
+import time # For timing calls
+
+# Time
+
+import datetime as dt
+
+# Data Manipulation
+
+import pandas as pd
+
+# Our functions
+
+import PurpleAir_Functions as purp
+import PurpleAir_Replay
+import GetSort_Spikes
+import New_Alerts
+import Ongoing_Alerts
+import Ended_Alerts
+import Send_Alerts
+import REDCap_Functions as redcap
+import Twilio_Functions as our_twilio
+import Create_messages
+import Opt_Outs
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+redcap_url = 'https://redcap.ahc.umn.edu/api/'
+
+max_concurrent_requests = 10 # At most this many calls to any one service at a time
+lookup_chunk_size = 50 # record_ids per REDCap phone number lookup (chunks are looked up at once)
+
+_loop = None # The event loop - kept for the whole run so the session's connections are reused
+_thread = None # Runs _loop
+_session = None # aiohttp.ClientSession
+_limits = None # Dictionary of service: asyncio.Semaphore
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def is_started():
+    '''
+    Is the async engine in use?
+    '''
+
+    return _loop is not None
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Start():
+    '''
+    Starts the event loop and session, and has GetSort_Spikes fetch PurpleAir through them
+    '''
+
+    global _loop, _thread
+
+    _loop = asyncio.new_event_loop()
+
+    _thread = threading.Thread(target = _loop.run_forever, name = 'async_engine', daemon = True)
+    _thread.start()
+
+    _Run(_Open_session())
+
+    GetSort_Spikes.fetch_sensors = _Fetch_from_thread
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Run(coroutine):
+    '''
+    Runs coroutine on the loop and waits for its result - from any other thread
+    '''
+
+    return asyncio.run_coroutine_threadsafe(coroutine, _loop).result()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+async def _Open_session():
+    '''
+    Opens the aiohttp session (must be inside the loop)
+    '''
+
+    global _session, _limits
+
+    timeout = aiohttp.ClientTimeout(sock_connect = purp.timeout[0], sock_read = purp.timeout[1])
+
+    _session = aiohttp.ClientSession(timeout = timeout)
+    _limits = {service: asyncio.Semaphore(max_concurrent_requests) for service in ['purpleair', 'redcap']}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Close():
+    '''
+    Closes the session and the event loop - PurpleAir goes back to the requests session
+    '''
+
+    global _loop, _thread, _session
+
+    if _loop is None:
+        return
+
+    GetSort_Spikes.fetch_sensors = purp.Get_PurpleAir_df_sensors
+
+    _Run(_session.close())
+
+    _loop.call_soon_threadsafe(_loop.stop)
+    _thread.join()
+    _loop.close()
+
+    _loop = None
+    _thread = None
+    _session = None
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Run_tick(purpleAir_api, pg_connection_dict, spike_threshold, reports_for_day, base_report_url, can_text):
+    '''
+    Runs one tick on the event loop (see Tick) and waits for it
+    '''
+
+    return _Run(Tick(purpleAir_api, pg_connection_dict, spike_threshold, reports_for_day, base_report_url, can_text))
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Run_send(record_ids, messages, redCap_token_signUp, pg_connection_dict):
+    '''
+    Sends a tick's messages on the event loop (see Send_all_messages) and waits for them -
+    for MAIN.py's send stage, so the next tick doesn't wait for them
+    '''
+
+    _Run(Send_all_messages(record_ids, messages, redCap_token_signUp, pg_connection_dict))
+
+## Workflow
+
+async def Tick(purpleAir_api, pg_connection_dict, spike_threshold, reports_for_day, base_report_url, can_text):
+    '''
+    The same as MAIN.py's GetSort_Spikes -> New/Ongoing/Ended Alerts steps
+    The messages are sent afterwards, on MAIN.py's send stage (see Run_send)
+
+    returns purpleAir_runtime (datetime), messages, record_ids_to_text (lists) and reports_for_day
+    '''
+
+    # Query PurpleAir for Spikes and sort out if we have new, ongoing, ended, flagged, not spiked sensors
+    # (the PurpleAir calls come back to this loop - see _Fetch_from_thread)
+
+    spikes_df, purpleAir_runtime, sensors_dict = await asyncio.to_thread(GetSort_Spikes.workflow,
+                                                                         purpleAir_api, pg_connection_dict, spike_threshold)
+
+    new_spikes_df = spikes_df[spikes_df.sensor_index.isin(sensors_dict['new'])] if len(sensors_dict['new']) > 0 else None
+    ongoing_spikes_df = spikes_df[spikes_df.sensor_index.isin(sensors_dict['ongoing'])] if len(sensors_dict['ongoing']) > 0 else None
+
+    # NEW spikes, then the ONGOING spikes' readings - one after the other, like MAIN.py
+    # (joining/merging alerts and updating their readings are UPDATEs on the same alert rows - together they can deadlock)
+    # Splitting ongoing alerts comes last - new spikes may have merged them
+
+    messages, record_ids_to_text = [], []
+
+    if new_spikes_df is not None:
+        messages, record_ids_to_text = await asyncio.to_thread(New_Alerts.workflow, new_spikes_df, purpleAir_runtime, [], [], can_text, pg_connection_dict)
+
+    if ongoing_spikes_df is not None:
+        await asyncio.to_thread(Ongoing_Alerts.workflow, ongoing_spikes_df, pg_connection_dict, spikes_df) # New spikes may have merged alerts
+
+    # ENDED spikes
+
+    messages, record_ids_to_text, reports_for_day = await asyncio.to_thread(Ended_Alerts.workflow, sensors_dict,
+                                                                            purpleAir_runtime,
+                                                                            messages,
+                                                                            record_ids_to_text,
+                                                                            reports_for_day,
+                                                                            base_report_url,
+                                                                            can_text,
+                                                                            pg_connection_dict)
+
+    return purpleAir_runtime, messages, record_ids_to_text, reports_for_day
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+## PurpleAir
+
+def _Fetch_from_thread(purpleAir_api, sensor_ids, fields, timezone = 'America/Chicago', modified_since = None):
+    '''
+    GetSort_Spikes.fetch_sensors while the engine is running - called from a worker thread,
+    it runs Get_PurpleAir_df_sensors on the loop and waits for it
+    '''
+
+    future = asyncio.run_coroutine_threadsafe(Get_PurpleAir_df_sensors(purpleAir_api, sensor_ids, fields,
+                                                                       timezone, modified_since), _loop)
+
+    return future.result()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+async def Get_PurpleAir_df_sensors(purpleAir_api, sensor_ids, fields, timezone = 'America/Chicago', modified_since = None):
+    '''
+    The same as purp.Get_PurpleAir_df_sensors (same plan, chunks, typing and call log) over aiohttp - all chunks at once
+
+    Replaying/recording goes through purp (see PurpleAir_Replay.py)
+    '''
+
+    if PurpleAir_Replay.is_replaying() or PurpleAir_Replay.is_recording():
+        return await asyncio.to_thread(purp.Get_PurpleAir_df_sensors, purpleAir_api, sensor_ids, fields, timezone, modified_since)
+
+    sensor_ids = [int(sensor_id) for sensor_id in sensor_ids]
+
+    plan = purp.Plan_fetch(sensor_ids, fields)
+
+    if plan['method'] == 'bounds':
+        query_strings = [purp._Bounds_query_string(fields, *plan['bounds'], modified_since)]
+    else:
+        query_strings = purp._Sensors_query_strings(plan['chunks'], fields, modified_since)
+
+    if len(query_strings) == 0: # Nothing to ask for
+        return pd.DataFrame(), PurpleAir_Replay.Now(timezone)
+
+    results = await asyncio.gather(*[_Response_to_df(query_string, purpleAir_api, timezone) for query_string in query_strings])
+
+    dfs = [chunk_df for chunk_df, chunk_runtime in results if len(chunk_df.columns) > 0] # No columns = failed
+
+    if len(dfs) < len(results):
+        print(f'{len(results) - len(dfs)} of {len(results)} PurpleAir chunks failed')
+
+    if len(dfs) < len(results) and modified_since is not None:
+        df = pd.DataFrame() # A partial delta would move the caller's modified_since past the failed chunks' sensors - fail it all
+    else:
+        df = pd.concat(dfs, ignore_index = True) if len(dfs) > 0 else pd.DataFrame()
+    runtime = max(chunk_runtime for chunk_df, chunk_runtime in results) # One runtime - when the last chunk came back
+
+    if plan['method'] == 'bounds' and len(df) > 0: # Keep only the sensors we asked for
+        df = df[df.sensor_index.isin(sensor_ids)].reset_index(drop=True)
+
+    return df, runtime
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+async def _Response_to_df(query_string, purpleAir_api, timezone):
+    '''
+    The same as purp._Response_to_df over aiohttp - retries purp.retry_statuses and connection errors with backoff
+
+    returns df (no columns if the call failed) and runtime
+    '''
+
+    url = purp.base_url + '?' + query_string
+
+    fields = [p[len('fields='):].split('%2C') for p in query_string.split('&') if p.startswith('fields=')]
+    fields = fields[0] if len(fields) > 0 else []
+
+    for attempt in range(purp.max_retries + 1):
+
+        start = time.perf_counter()
+
+        try:
+            async with _limits['purpleair']:
+                async with _session.get(url, headers = {'X-API-Key': purpleAir_api}) as response:
+                    status_code = response.status
+                    content = await response.read()
+                    retry_after = response.headers.get('Retry-After')
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+
+            purp.api_call_log.append({'time': dt.datetime.now(dt.timezone.utc), 'url': url, 'fields': fields, 'status_code': None,
+                                      'seconds': time.perf_counter() - start, 'bytes': 0, 'rows': 0})
+
+            if attempt == purp.max_retries:
+                print('ERROR in PurpleAir API Call')
+                print(e)
+                return pd.DataFrame(), PurpleAir_Replay.Now(timezone)
+
+            await asyncio.sleep(purp.backoff_seconds * 2 ** attempt)
+            continue
+
+        entry = {'time': dt.datetime.now(dt.timezone.utc), 'url': url, 'fields': fields, 'status_code': status_code,
+                 'seconds': time.perf_counter() - start, 'bytes': len(content), 'rows': 0}
+        purp.api_call_log.append(entry)
+
+        if status_code in purp.retry_statuses and attempt < purp.max_retries:
+            wait = float(retry_after) if retry_after is not None and retry_after.isdigit() else purp.backoff_seconds * 2 ** attempt
+            await asyncio.sleep(wait)
+            continue
+
+        break
+
+    runtime = PurpleAir_Replay.Now(timezone) # When we call - datetime in our timezone
+
+    if status_code != 200:
+        print('ERROR in PurpleAir API Call')
+        print('HTTP Status: ' + str(status_code))
+        print(content.decode(errors = 'replace'))
+
+        return pd.DataFrame(), runtime
+
+    df = await asyncio.to_thread(purp.Decode_response, content, timezone) # Typed columns (empty if nothing matched)
+
+    entry['rows'] = len(df)
+
+    return df, runtime
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+## Messaging
+
+async def Send_all_messages(record_ids, messages, redCap_token_signUp, pg_connection_dict):
+    '''
+    The same as Send_Alerts.send_all_messages:
+    1. Send each message to the corresponding record_id (unless they unsubscribed - then unsubscribe them)
+    2. update the user signup data to reflect each new message sent (+1 messages_sent, time added)
+
+    The phone number lookups (in chunks) run alongside the opt out registry's sync (see Opt_Outs.py)
+    '''
+
+    chunks = [record_ids[i:i + lookup_chunk_size] for i in range(0, len(record_ids), lookup_chunk_size)]
+
+    results = await asyncio.gather(asyncio.to_thread(Opt_Outs.Sync, pg_connection_dict),
+                                   *[Get_phone_numbers(chunk, redCap_token_signUp) for chunk in chunks])
+
+    numbers = [number for chunk_numbers in results[1:] for number in chunk_numbers]
+
+    if len(numbers) != len(record_ids): # Assumption in redcap.Get_phone_numbers
+        print('Error Receiving REDCap data - no messages sent')
+        return
+
+    unsubscribed = [Opt_Outs.is_opted_out(number) for number in numbers]
+
+    if any(unsubscribed):
+
+        # Unsubscribe from our database and delete their Twilio information
+        record_ids_to_unsubscribe = [int(record_id) for record_id, is_unsubscribed in zip(record_ids, unsubscribed) if is_unsubscribed]
+        numbers_to_unsubscribe = [number for number, is_unsubscribed in zip(numbers, unsubscribed) if is_unsubscribed]
+
+        await asyncio.gather(asyncio.to_thread(Send_Alerts.Unsubscribe_users, record_ids_to_unsubscribe, pg_connection_dict),
+                             asyncio.to_thread(our_twilio.delete_twilio_info, numbers_to_unsubscribe))
+
+        # Drop unsubscriptions from numbers/record_ids/messages lists
+
+        keep = [i for i, is_unsubscribed in enumerate(unsubscribed) if not is_unsubscribed]
+
+        numbers = [numbers[i] for i in keep]
+        record_ids = [record_ids[i] for i in keep]
+        messages = [messages[i] for i in keep]
+
+    # Send messages - the same rate limit and retries as the sync path (see Twilio_Functions.Send_messages)
+
+    times = await asyncio.to_thread(our_twilio.send_texts, numbers, messages)
+
+    sent = [i for i, t in enumerate(times) if t is not None]
+
+    segments_sent = sum(Create_messages.count_segments(messages[i]) for i in sent) # See Create_messages.py
+
+    await asyncio.to_thread(Send_Alerts.update_user_table, [record_ids[i] for i in sent], [times[i] for i in sent],
+                            pg_connection_dict, segments_sent)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+async def Get_phone_numbers(record_ids, redCap_token_signUp):
+    '''
+    The same as redcap.Get_phone_numbers over aiohttp
+    '''
+
+    try:
+        async with _limits['redcap']:
+            async with _session.post(redcap_url, data = redcap._Phone_numbers_request(record_ids, redCap_token_signUp)) as response:
+                status_code = response.status
+                text = await response.text()
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print('Error Receiving REDCap data')
+        print(e)
+        return []
+
+    return redcap._Unpack_phone_numbers(status_code, text, record_ids)
@@ -2,33 +2,245 @@
 
 ## Load modules
 
+import os # For pool settings from .env
+from io import StringIO # Staging for COPY
+import threading # Pools are shared between threads
+import time # For backing off between reconnects
+import weakref # Per connection bookkeeping that goes away with the connection
+from contextlib import contextmanager
+
 import psycopg2
 from psycopg2 import sql
+from psycopg2 import pool as pg_pool
+
+# Geometry
+
+import shapely.wkb
+import shapely.wkt
 
 # ~~~~~~~~~~~~~~
 
-def send_update(cmd, pg_connection_dict):
+## Connection Pools
+
+# One pool per set of credentials, kept open for the life of the process
+# Sizes can be set in the .env file (DB_POOL_MIN/DB_POOL_MAX) or with configure_pool()
+
+_pools = {} # key = tuple of the pg_connection_dict items, value = ThreadedConnectionPool
+_pool_settings = {} # key = same as above, value = dictionary of minconn/maxconn
+_pools_lock = threading.Lock()
+
+connection_options = {'keepalives': 1, # Passed to every new connection
+                      'keepalives_idle': 30,
+                      'keepalives_interval': 10,
+                      'keepalives_count': 3,
+                      'connect_timeout': 10
+                     }
+
+idle_check_seconds = 60 # Connections idle longer than this are checked (SELECT 1) before they are lent out
+_last_used = weakref.WeakKeyDictionary() # connection: time.monotonic() when it was last given back
+
+max_retries = 5 # How many times will we try to (re)connect?
+backoff_seconds = 1 # Initial wait between retries, doubles every attempt
+
+# ~~~~~~~~~~~~~~
+
+def _pool_key(pg_connection_dict):
     '''
-    Takes a command (sql.SQL() string) and pg_connection_dict
-    Sends the command to postgres
-    And closes connection
+    Turns pg_connection_dict into something hashable for the _pools dictionary
+    '''
+    
+    return tuple(sorted(pg_connection_dict.items()))
+    
+# ~~~~~~~~~~~~~~
+
+def configure_pool(pg_connection_dict, minconn = None, maxconn = None):
+    '''
+    Sets the minimum/maximum number of connections kept for pg_connection_dict
+    
+    Must be called before the first query with these credentials to take effect
+    Defaults come from DB_POOL_MIN (1) and DB_POOL_MAX (10) in the .env file
+    '''
+    
+    settings = {'minconn': minconn if minconn is not None else int(os.getenv('DB_POOL_MIN', 1)),
+                'maxconn': maxconn if maxconn is not None else int(os.getenv('DB_POOL_MAX', 10))
+               }
+    
+    with _pools_lock:
+        _pool_settings[_pool_key(pg_connection_dict)] = settings
+    
+# ~~~~~~~~~~~~~~
+
+def _get_pool(pg_connection_dict):
+    '''
+    Returns the pool for pg_connection_dict, creating it on first use
+    Creating the pool is retried with exponential backoff if the database is unreachable
+    '''
+    
+    key = _pool_key(pg_connection_dict)
+    
+    with _pools_lock:
+    
+        if key in _pools:
+            return _pools[key]
+            
+        if key not in _pool_settings:
+            _pool_settings[key] = {'minconn': int(os.getenv('DB_POOL_MIN', 1)),
+                                   'maxconn': int(os.getenv('DB_POOL_MAX', 10))
+                                  }
+        settings = _pool_settings[key]
+    
+    # Connect without holding the lock - other threads (and other pools) aren't held up while we back off
+    
+    wait = backoff_seconds
+    
+    for attempt in range(max_retries):
+        try:
+            new_pool = pg_pool.ThreadedConnectionPool(settings['minconn'],
+                                                      settings['maxconn'],
+                                                      **pg_connection_dict,
+                                                      **connection_options)
+            break
+        except psycopg2.OperationalError as e:
+            if attempt == max_retries - 1:
+                raise
+            print(f'Database connection failed ({e}), retrying in {wait} seconds')
+            time.sleep(wait)
+            wait *= 2
+    
+    with _pools_lock:
+    
+        if key in _pools: # Another thread got there first - use theirs
+            new_pool.closeall()
+        else:
+            _pools[key] = new_pool
+            
+        return _pools[key]
+
+# ~~~~~~~~~~~~~~
+
+def _is_healthy(conn):
+    '''
+    Health check for a pooled connection - is it open and does it answer?
+    Only asks the database if the connection has been idle for idle_check_seconds
+    (otherwise errors are caught when it's used - see get_connection)
+    '''
+    
+    if conn.closed:
+        return False
+    
+    if time.monotonic() - _last_used.get(conn, 0) < idle_check_seconds:
+        return True
+    
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1;')
+        conn.rollback() # Don't leave the check's transaction open
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+        
+# ~~~~~~~~~~~~~~
+
+def _checkout(pg_connection_dict):
+    '''
+    Gets a healthy connection from the pool
+    Broken connections are thrown away and replaced, backing off if the database is down
+    '''
+    
+    connection_pool = _get_pool(pg_connection_dict)
+    
+    wait = backoff_seconds
+    
+    for attempt in range(max_retries):
+        try:
+            conn = connection_pool.getconn()
+        except pg_pool.PoolError:
+            # Every connection is in use - wait for one to come back
+            print(f'Every pooled connection is in use, waiting {wait} seconds (attempt {attempt + 1} of {max_retries})')
+            conn = None
+        except psycopg2.OperationalError as e:
+            print(f'Database connection failed ({e}), retrying in {wait} seconds')
+            conn = None
+    
+        if conn is not None:
+            if _is_healthy(conn):
+                return conn
+            _last_used.pop(conn, None)
+            connection_pool.putconn(conn, close=True) # Discard it, the pool will open a new one
+        
+        if attempt < max_retries - 1:
+            time.sleep(wait)
+            wait *= 2
+        
+    raise psycopg2.OperationalError('Could not get a healthy connection from the pool')
+    
+# ~~~~~~~~~~~~~~
+
+@contextmanager
+def get_connection(pg_connection_dict):
+    '''
+    Context manager that lends out a pooled connection
+    
+    with psql.get_connection(pg_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(cmd)
+        
+    Commits if the block finishes, rolls back if it raises
+    And gives the connection back to the pool either way
     '''
     
-    # Create connection with postgres option keepalives_idle = 1 seconds
-    conn = psycopg2.connect(**pg_connection_dict, 
-                            keepalives_idle=1)
+    connection_pool = _get_pool(pg_connection_dict)
+    conn = _checkout(pg_connection_dict)
     
-    # Create cursor
-    cur = conn.cursor()
+    broken = False
     
-    cur.execute(cmd) # Execute
+    try:
+        yield conn
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True # Don't lend it out again
+        raise
+    except:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        if broken or conn.closed:
+            _last_used.pop(conn, None)
+            connection_pool.putconn(conn, close=True)
+        else:
+            _last_used[conn] = time.monotonic()
+            connection_pool.putconn(conn)
+        
+# ~~~~~~~~~~~~~~
+
+def close_all_pools():
+    '''
+    Closes every pooled connection - call this when the program terminates
+    '''
     
-    conn.commit() # Committ command
+    with _pools_lock:
+        for connection_pool in _pools.values():
+            connection_pool.closeall()
+        _pools.clear()
+
+# ~~~~~~~~~~~~~~
+
+def send_update(cmd, pg_connection_dict):
+    '''
+    Takes a command (sql.SQL() string) and pg_connection_dict
+    Sends the command to postgres on a pooled connection
+    '''
     
-    # Close cursor
-    cur.close()
-    # Close connection
-    conn.close()
+    with get_connection(pg_connection_dict) as conn:
+    
+        # Create cursor
+        cur = conn.cursor()
+        
+        cur.execute(cmd) # Execute
+        
+        # Close cursor
+        cur.close()
     
     
 # ~~~~~~~~~~~~~~
@@ -36,80 +248,136 @@ def send_update(cmd, pg_connection_dict):
 def get_response(cmd, pg_connection_dict):
     '''
     Takes a command (sql.SQL() string) and pg_connection_dict
-    Sends the command to postgres
+    Sends the command to postgres on a pooled connection
     Retrieves the response
-    And closes connection
     '''
     
-    # Create connection with postgres option keepalives_idle = 30 seconds
-    conn = psycopg2.connect(**pg_connection_dict, 
-                            keepalives_idle=30)
+    with get_connection(pg_connection_dict) as conn:
     
-    # Create cursor
-    cur = conn.cursor()
+        # Create cursor
+        cur = conn.cursor()
+        
+        cur.execute(cmd) # Execute
+        
+        # Fetch Response
+        
+        response = cur.fetchall()
+        
+        # Close cursor
+        cur.close()
     
-    cur.execute(cmd) # Execute
+    return response
     
-    conn.commit() # Committ command
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _to_ewkb(geometry, srid = 4326):
+    '''
+    Converts a geometry (shapely object or Well Known Text) into hex Extended Well Known Binary
+    which postgis reads directly during COPY - no ST_GeomFromText per row
+    '''
     
-    # Fetch Response
+    if geometry is None:
+        return None
     
-    response = cur.fetchall()
+    if isinstance(geometry, str):
+        geometry = shapely.wkt.loads(geometry)
+        
+    return shapely.wkb.dumps(geometry, hex=True, srid=srid)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _copy_chunk(cur, chunk, target, fieldnames):
+    '''
+    Streams one chunk of a dataframe into target (a sql.Identifier) using COPY FROM STDIN (csv)
+    '''
     
-    # Close cursor
-    cur.close()
-    # Close connection
-    conn.close()
+    buffer = StringIO()
+    chunk.to_csv(buffer, index=False, header=False, na_rep='\\N')
+    buffer.seek(0)
     
-    return response
+    cmd = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N');").format(
+                    target,
+                    sql.SQL(', ').join(map(sql.Identifier, fieldnames)))
     
+    cur.copy_expert(cmd.as_string(cur.connection), buffer)
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def insert_into(df, tablename, pg_connection_dict, is_spatial = False):
+def insert_into(df, tablename, pg_connection_dict, is_spatial = False, chunksize = 10000, conflict_columns = None):
     '''
     Takes a well formatted dataframe, df,  
         with the columns aligned to the fields of a table in the database (tablename)
     as well as pg_connection_dict
-    Inserts all rows into database
-    And closes connection
+    Bulk loads all rows into database with COPY in a single transaction
     
     IF YOU ARE INSERTING A SPATIAL DATASET - please indicate this by setting the is_spatial variable = True
-    And be sure that the last column is called geometry with well known text in WGS84 (EPSG:4326) "Lat/lon"
+    And be sure that the last column is called geometry with well known text or shapely geometries in WGS84 (EPSG:4326) "Lat/lon"
+    
+    chunksize = number of rows sent per COPY (keeps memory bounded on large loads)
+    conflict_columns = optional list of columns that identify a row, eg. ['sensor_index'] - must be a unique key/constraint of tablename
+                        rows that already exist are updated instead of inserted (upsert through a temporary staging table,
+                        INSERT ... ON CONFLICT - if a row is repeated in df the last one wins)
     '''
     
+    if len(df) == 0:
+        return
     
     fieldnames = list(df.columns)
     
-    # Create connection with postgres option keepalives_idle = 100 seconds
-    conn = psycopg2.connect(**pg_connection_dict, 
-                            keepalives_idle=100)
+    with get_connection(pg_connection_dict) as conn: # One commit at the end
     
-    # Create cursor
-    cur = conn.cursor()
-    
-    for row in df.itertuples():
+        # Create cursor
+        cur = conn.cursor()
         
-        vals = row[1:]
+        if conflict_columns is None: # Straight into the table
         
-        if is_spatial: # We need to treat the geometry column of WKT a little differently
+            target = sql.Identifier(tablename)
+            
+        else: # Into a staging table that disappears on commit
         
-            q1 = sql.SQL(f'INSERT INTO "{tablename}"' + ' ({}) VALUES ({},{});').format(
-     sql.SQL(', ').join(map(sql.Identifier, fieldnames)),
-     sql.SQL(', ').join(sql.Placeholder() * (len(fieldnames) - 1)),
-     sql.SQL('ST_SetSRID(ST_GeomFromText(%s), 4326)::geometry'))
+            target = sql.Identifier('insert_into_staging')
+            
+            # Only df's columns, with their types - no defaults (never draws on the table's sequences) or constraints
+            cmd = sql.SQL('CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA;').format(
+                            target, sql.SQL(', ').join(map(sql.Identifier, fieldnames)), sql.Identifier(tablename))
+            cur.execute(cmd)
+            
+        for start in range(0, len(df), chunksize):
         
-        else:
+            chunk = df.iloc[start:start + chunksize]
+            
+            if is_spatial: # Geometry goes over as EWKB (with SRID)
+                chunk = chunk.copy()
+                chunk['geometry'] = [_to_ewkb(geom) for geom in chunk['geometry']]
+            
+            _copy_chunk(cur, chunk, target, fieldnames)
+            
+        if conflict_columns is not None: # Merge the staging table into the real one
         
-            q1 = sql.SQL(f'INSERT INTO "{tablename}"' + ' ({}) VALUES ({});').format(
-     sql.SQL(', ').join(map(sql.Identifier, fieldnames)),
-     sql.SQL(', ').join(sql.Placeholder() * (len(fieldnames))))
-
-        # Execute command
-        cur.execute(q1.as_string(conn), (vals))
-    
-        conn.commit() # Commit command
-    
-    # Close cursor
-    cur.close()
-    # Close connection
-    conn.close()
+            update_columns = [field for field in fieldnames if field not in conflict_columns]
+            
+            if len(update_columns) > 0:
+                on_conflict = sql.SQL('DO UPDATE SET {}').format(
+                                sql.SQL(', ').join([sql.SQL('{} = EXCLUDED.{}').format(sql.Identifier(field), sql.Identifier(field)) 
+                                                   for field in update_columns]))
+            else:
+                on_conflict = sql.SQL('DO NOTHING')
+            
+            # One row per key (the last one copied) - ON CONFLICT can't touch the same row twice in one statement
+            
+            cmd = sql.SQL('''INSERT INTO {} ({})
+            SELECT DISTINCT ON ({}) {}
+            FROM {} s
+            ORDER BY {}, s.ctid DESC
+            ON CONFLICT ({}) {};''').format(sql.Identifier(tablename),
+                                    sql.SQL(', ').join(map(sql.Identifier, fieldnames)),
+                                    sql.SQL(', ').join([sql.SQL('s.{}').format(sql.Identifier(field)) for field in conflict_columns]),
+                                    sql.SQL(', ').join([sql.SQL('s.{}').format(sql.Identifier(field)) for field in fieldnames]),
+                                    target,
+                                    sql.SQL(', ').join([sql.SQL('s.{}').format(sql.Identifier(field)) for field in conflict_columns]),
+                                    sql.SQL(', ').join(map(sql.Identifier, conflict_columns)),
+                                    on_conflict)
+            cur.execute(cmd)
+        
+        # Close cursor
+        cur.close()
@@ -77,3 +77,32 @@ For questions see SpikeAlerts.github.io/Website
 Reply STOP to end this service. Msg&Data Rates May Apply'''
 
     return message
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# SMS encoding - see https://www.twilio.com/docs/glossary/what-sms-character-limit
+
+gsm_characters = set("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+gsm_extension_characters = set("^{}\\[~]|€\f") # These take up two characters
+
+def count_segments(message):
+    '''
+    Estimates how many SMS segments a message (string) will be sent as
+    
+    GSM-7 messages fit 160 characters in 1 segment (153 per segment when split)
+    Anything else is sent as UCS-2 - 70 characters in 1 segment (67 when split)
+    
+    Returns an integer
+    '''
+    
+    if all((c in gsm_characters) or (c in gsm_extension_characters) for c in message):
+        length = sum(2 if c in gsm_extension_characters else 1 for c in message)
+        single_segment, multi_segment = 160, 153
+    else:
+        length = len(message.encode('utf-16-le')) // 2
+        single_segment, multi_segment = 70, 67
+        
+    if length <= single_segment:
+        return 1
+    
+    return -(-length // multi_segment) # Ceiling division
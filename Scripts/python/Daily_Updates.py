@@ -13,7 +13,6 @@ import pytz # Timezones
 import Basic_PSQL as psql
 import Our_Queries as query
 from psycopg2 import sql
-import psycopg2
 
 # Analysis
 
@@ -26,6 +25,9 @@ import numpy as np
 import PurpleAir_Functions as purp
 import REDCap_Functions as redcap
 import Twilio_Functions as our_twilio
+import Sensor_Subscriber
+import Spatial_Index
+import Readings_Table
 
 # Messaging
 
@@ -40,14 +42,44 @@ def workflow(next_update_time, reports_for_day, messages_sent_today, purpleAir_a
     This is the full workflow for Daily Updates
     
     returns the next_update_time (datetime timestamp), reports_for_day, messages_sent_today (ints)
+    
+    MAIN.py runs Maintenance on a worker thread instead (see Daily_Worker.py)
+    '''
+    
+    if Maintenance(next_update_time, purpleAir_api, redCap_token_signUp, pg_connection_dict, timezone): # If updated full system
+        
+        print(reports_for_day, 'reports yesterday')
+        print(messages_sent_today, 'messages sent yesterday')
+        
+        # Initialize storage for daily metrics
+        reports_for_day = 0
+        messages_sent_today = 0
+    
+    # Get next update time (in 1 day)
+    next_update_time += dt.timedelta(days=1)
+    
+    return next_update_time, reports_for_day, messages_sent_today
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Maintenance(next_update_time, purpleAir_api, redCap_token_signUp, pg_connection_dict, timezone = 'America/Chicago', update_spatial_index = True):
+    '''
+    The database work of the daily update - stations from PurpleAir, new users from REDCap (welcome texts) and the readings partitions
+    
+    update_spatial_index = rebuild the spatial index (if it's in use) afterwards -
+                           Daily_Worker passes False, it builds the new index itself and MAIN.py swaps it in
+    
+    returns True if the stations/users were updated (False if they already were today)
     '''
     
     # PurpleAir
     # If we haven't already updated the full sensor list today, let's do that
     
     last_PurpleAir_update = query.Get_last_PurpleAir_update(pg_connection_dict, timezone = timezone) # See Daily_Updates.py      
+    
+    updated = last_PurpleAir_update < next_update_time
       
-    if last_PurpleAir_update < next_update_time: # If haven't updated full system today
+    if updated: # If haven't updated full system today
         # Update "PurpleAir Stations" from PurpleAir
         Sensor_Information_Daily_Update(pg_connection_dict, purpleAir_api)
     
@@ -57,17 +89,14 @@ def workflow(next_update_time, reports_for_day, messages_sent_today, purpleAir_a
         Add_new_users(REDCap_df, pg_connection_dict)
         print(len(REDCap_df), 'new users')
         
-        print(reports_for_day, 'reports yesterday')
-        print(messages_sent_today, 'messages sent yesterday')
-        
-        # Initialize storage for daily metrics
-        reports_for_day = 0
-        messages_sent_today = 0
+        # One rebuild of the spatial index for all of today's new/retired stations and new users
+        if update_spatial_index and Spatial_Index.is_loaded():
+            Spatial_Index.Load(pg_connection_dict)
     
-    # Get next update time (in 1 day)
-    next_update_time += dt.timedelta(days=1)
+    # Readings history - create the coming partitions, drop the expired ones (see Readings_Table.py)
+    Readings_Table.Maintain(pg_connection_dict, dt.datetime.now(pytz.timezone(timezone)).date())
     
-    return next_update_time, reports_for_day, messages_sent_today
+    return updated
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
    
@@ -149,13 +178,11 @@ def Get_PurpleAir(nwlng, selat, selng, nwlat, purpleAir_api):
     
     df, runtime = purp.Get_PurpleAir_df_bounds(fields, nwlng, selat, selng, nwlat, purpleAir_api)
     
-    # Datatype corrections
-    df['sensor_index']  = df.sensor_index.astype(int)
-    df['last_seen'] = pd.to_datetime(df['last_seen'].astype(int),
-                                             utc = True,
-                                             unit='s').dt.tz_convert('America/Chicago')
-    df['channel_flags'] = df.channel_flags.astype(int)
-
+    # Remember how many sensors are in our bounds (lets the spike queries use the bounds when that is cheaper)
+    if len(df) > 0:
+        purp.Set_bounds_info(nwlng, selat, selng, nwlat, len(df))
+    
+    # Datatypes are already set by purp.Decode_response
 
     # Filter for City of Minneapolis
     is_city = df.name.apply(lambda x: 'CITY OF MINNEAPOLIS' in x.upper())
@@ -233,18 +260,7 @@ def Add_new_PurpleAir_Stations(sensor_indices, pg_connection_dict, purpleAir_api
 
     if len(df) > 0:
 
-        # Correct Last Seen/date created into datetimes (in UTC UNIX time)
-
-        df['date_created'] = pd.to_datetime(df['date_created'].astype(int),
-                                                 utc = True,
-                                                 unit='s').dt.tz_convert('America/Chicago')
-        df['last_seen'] = pd.to_datetime(df['last_seen'].astype(int),
-                                                 utc = True,
-                                                 unit='s').dt.tz_convert('America/Chicago')
-        
-         # Make sure sensor_index is an integer
-        
-        df['sensor_index'] = pd.to_numeric(df['sensor_index'])
+        # Last Seen/date created are already datetimes and sensor_index an integer (see purp.Decode_response)
 
         # Spatializing
                                              
@@ -260,9 +276,9 @@ def Add_new_PurpleAir_Stations(sensor_indices, pg_connection_dict, purpleAir_api
          
         sorted_df = gdf.copy()[cols_for_db] 
         
-        # Get Well Known Text of the geometry
+        # Keep the shapely geometry - insert_into sends it as EWKB
                              
-        sorted_df['geometry'] = gdf.geometry.apply(lambda x: x.wkt)
+        sorted_df['geometry'] = gdf.geometry.values
         
         # Format the times
         
@@ -270,6 +286,10 @@ def Add_new_PurpleAir_Stations(sensor_indices, pg_connection_dict, purpleAir_api
         sorted_df['last_seen'] = gdf.last_seen.apply(lambda x : x.strftime('%Y-%m-%d %H:%M:%S'))
          
         psql.insert_into(sorted_df, "PurpleAir Stations", pg_connection_dict, is_spatial = True)    
+        
+        # Add their nearby subscribers to sensor_subscriber
+        
+        Sensor_Subscriber.Add_sensors(sorted_df.sensor_index.to_list(), pg_connection_dict)
     
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     
@@ -286,6 +306,10 @@ WHERE sensor_index = ANY ( {} );
     ''').format(sql.Literal(sensor_indices))
     
     psql.send_update(cmd, pg_connection_dict)
+    
+    # Retired sensors no longer have subscribers
+    
+    Sensor_Subscriber.Remove_sensors(sensor_indices, pg_connection_dict)
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -305,29 +329,24 @@ def Update_name(sensor_indices, merged_df, pg_connection_dict):
     name_controversy_df['last_seen_PurpleAir'] = name_controversy_df.last_seen_PurpleAir.apply(lambda x : x.strftime('%Y-%m-%d %H:%M:%S'))
     
     # Connect to database
-    conn = psycopg2.connect(**pg_connection_dict,
-                            keepalives_idle=20)
-    # Create cursor
-    cur = conn.cursor()
-    
-    for i, row in name_controversy_df.iterrows():
-    
-        cmd = sql.SQL('''UPDATE "PurpleAir Stations"
-        SET name = {}, last_seen = {}, channel_flags = {}
-        WHERE sensor_index = {};
-        ''').format(sql.Literal(row.name_PurpleAir),
-                    sql.Literal(row.last_seen_PurpleAir),
-                    sql.Literal(row.channel_flags_PurpleAir),
-                    sql.Literal(row.sensor_index))
+    with psql.get_connection(pg_connection_dict) as conn: # Commits when finished
+        # Create cursor
+        cur = conn.cursor()
         
-        cur.execute(cmd)
+        for i, row in name_controversy_df.iterrows():
         
-    conn.commit()
-    
-    # Close cursor
-    cur.close()
-    # Close connection
-    conn.close()
+            cmd = sql.SQL('''UPDATE "PurpleAir Stations"
+            SET name = {}, last_seen = {}, channel_flags = {}
+            WHERE sensor_index = {};
+            ''').format(sql.Literal(row.name_PurpleAir),
+                        sql.Literal(row.last_seen_PurpleAir),
+                        sql.Literal(row.channel_flags_PurpleAir),
+                        sql.Literal(row.sensor_index))
+            
+            cur.execute(cmd)
+        
+        # Close cursor
+        cur.close()
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -393,27 +412,23 @@ def Update_Flags_LastSeen(sensor_indices, merged_df, pg_connection_dict):
     if len(sameName_df.sensor_index) > 0: 
 
         # Connect to database
-        conn = psycopg2.connect(**pg_connection_dict) 
-        # Create cursor
-        cur = conn.cursor()
-        
-        for i, row in sameName_df.iterrows():
-        
-            cmd = sql.SQL('''UPDATE "PurpleAir Stations"
-            SET last_seen = {}, channel_flags = {}
-            WHERE sensor_index = {};
-            ''').format(sql.Literal(row.last_seen_PurpleAir),
-                        sql.Literal(row.channel_flags_PurpleAir),
-                        sql.Literal(row.sensor_index))
+        with psql.get_connection(pg_connection_dict) as conn: # Commits when finished
+            # Create cursor
+            cur = conn.cursor()
             
-            cur.execute(cmd)
+            for i, row in sameName_df.iterrows():
             
-        conn.commit()
-        
-        # Close cursor
-        cur.close()
-        # Close connection
-        conn.close()
+                cmd = sql.SQL('''UPDATE "PurpleAir Stations"
+                SET last_seen = {}, channel_flags = {}
+                WHERE sensor_index = {};
+                ''').format(sql.Literal(row.last_seen_PurpleAir),
+                            sql.Literal(row.channel_flags_PurpleAir),
+                            sql.Literal(row.sensor_index))
+                
+                cur.execute(cmd)
+            
+            # Close cursor
+            cur.close()
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -430,11 +445,6 @@ def Add_new_users(df, pg_connection_dict):
     
     if len(df) > 0:
         
-        load_dotenv()
-
-        account_sid = os.environ['TWILIO_ACCOUNT_SID']
-        auth_token = os.environ['TWILIO_AUTH_TOKEN']
-        twilio_number = os.environ['TWILIO_NUMBER']
         # Insert into database
         
         df['geometry'] = df.wkt
@@ -446,12 +456,16 @@ def Add_new_users(df, pg_connection_dict):
         
         psql.insert_into(df_for_db, "Sign Up Information", pg_connection_dict, is_spatial = True)
         
+        # Add the sensors nearby them to sensor_subscriber
+        
+        Sensor_Subscriber.Add_users(df_for_db.record_id.to_list(), pg_connection_dict)
+        
         # Now message those new users
         
         numbers = df.phone.to_list()
         messages = [Create_messages.welcome_message()]*len(numbers)
         
-        our_twilio.send_texts(numbers, messages, account_sid, auth_token, twilio_number)
+        our_twilio.send_texts(numbers, messages)
     
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -0,0 +1,141 @@
+# Runs the daily update (see Daily_Updates.Maintenance) on a worker thread with its own database connections
+# so the real-time loop keeps checking for spikes while stations/users are refreshed
+# When it's done the worker builds a new spatial index (if it's in use) and hands it back -
+# MAIN.py swaps it in at the start of a tick (Apply), so a tick sees the old snapshot or the new one, never half of each
+# Only the in-memory spatial index is a snapshot - with the postgis backend a tick reads "PurpleAir Stations",
+# "Sign Up Information" and sensor_subscriber while the worker is still writing them (each of its statements commits on its own)
+
+## Load modules
+
+import threading
+import queue # Handing work to/snapshots from the worker
+import traceback
+
+import Basic_PSQL as psql
+import Daily_Updates
+import Spatial_Index
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+application_name = 'SpikeAlerts daily' # Tells the worker's connections apart in pg_stat_activity (and gives them their own pool)
+pool_size = 2
+
+_thread = None
+_requests = queue.Queue() # next_update_time (datetime) per daily update, None to stop
+_snapshots = queue.Queue() # Dictionaries of next_update_time, updated (bool), spatial_index (or None)
+_busy = threading.Event()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def is_started():
+    '''
+    Is the daily worker running?
+    '''
+
+    return _thread is not None
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Start(purpleAir_api, redCap_token_signUp, pg_connection_dict, timezone = 'America/Chicago'):
+    '''
+    Starts the worker thread - its connections are pg_connection_dict with our application_name (a separate pool)
+    '''
+
+    global _thread
+
+    daily_connection_dict = dict(pg_connection_dict, application_name = application_name)
+
+    psql.configure_pool(daily_connection_dict, 1, pool_size)
+
+    _thread = threading.Thread(target = _Run,
+                               args = (purpleAir_api, redCap_token_signUp, daily_connection_dict, timezone),
+                               name = 'daily_updates',
+                               daemon = True)
+    _thread.start()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Run(purpleAir_api, redCap_token_signUp, daily_connection_dict, timezone):
+    '''
+    The worker - runs each requested daily update, then builds the snapshot for Apply()
+    '''
+
+    while True:
+
+        next_update_time = _requests.get()
+
+        if next_update_time is None: # Stop()
+            break
+
+        _busy.set()
+
+        try:
+            updated = Daily_Updates.Maintenance(next_update_time, purpleAir_api, redCap_token_signUp,
+                                                daily_connection_dict, timezone,
+                                                update_spatial_index = False) # Never the live index - Apply() swaps in the one built below
+
+            spatial_index = Spatial_Index.Build(daily_connection_dict) if Spatial_Index.is_loaded() else None
+
+            _snapshots.put({'next_update_time': next_update_time,
+                            'updated': updated,
+                            'spatial_index': spatial_index})
+
+        except Exception:
+            print('ERROR in daily update')
+            traceback.print_exc()
+
+        _busy.clear()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Submit(next_update_time):
+    '''
+    Asks the worker for the daily update due at next_update_time (datetime) - returns right away
+    '''
+
+    if _busy.is_set():
+        print('The last daily update is still running - queueing this one')
+
+    _requests.put(next_update_time)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Apply():
+    '''
+    Swaps in the newest snapshot from the worker (if there is one) - call from the real-time loop between ticks
+
+    returns the list of finished updates (dictionaries of next_update_time, updated - True if the stations/users were updated)
+    '''
+
+    finished = []
+
+    while True:
+
+        try:
+            snapshot = _snapshots.get_nowait()
+        except queue.Empty:
+            break
+
+        if snapshot['spatial_index'] is not None:
+            Spatial_Index.Swap(snapshot['spatial_index'])
+
+        finished += [{'next_update_time': snapshot['next_update_time'], 'updated': snapshot['updated']}]
+
+    return finished
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Stop(timeout = None):
+    '''
+    Lets the worker finish what it's doing and stops it
+    '''
+
+    global _thread
+
+    if _thread is None:
+        return
+
+    _requests.put(None)
+    _thread.join(timeout)
+
+    _thread = None
@@ -2,9 +2,12 @@
 
 # File manipulation
 
+import traceback # Log a failed history write without stopping spike detection
+
 # Purple Air
 
 import PurpleAir_Functions as purp
+import PurpleAir_Replay # The clock follows the recording when replaying
 
 # Time
 
@@ -17,10 +20,47 @@ import Our_Queries as query
 import Basic_PSQL as psql
 from psycopg2 import sql
 
+# Sensor State
+
+import Sensor_State # In-memory classification if it's loaded (see MAIN.py)
+import Readings_Buffer # Recent readings for persistence
+import Readings_Table # History of every reading
+
 # Data Manipulation
 
 import pandas as pd
 
+## Delta Polling
+
+# With delta_polling on, we only ask PurpleAir for sensors modified since our last successful poll
+# and merge them into _current_readings (the latest raw row for every sensor) - spikes are found on that table
+# A full refresh is done every full_refresh_minutes (and whenever the table is missing or sensors are new to it)
+# Turn it on with PURPLEAIR_DELTA_POLLING='true' in the .env file (see MAIN.py)
+
+delta_polling = False
+full_refresh_minutes = 60
+overlap_seconds = 60 # Ask for a little before the last poll (clock skew/late writes) - duplicates are merged
+
+_current_readings = None # pd.DataFrame - raw PurpleAir rows, one per sensor_index (int)
+_last_poll = None # datetime of the last successful poll
+_last_full_refresh = None # datetime of the last successful full poll
+
+# The function that queries PurpleAir for a list of sensors - same arguments/returns as purp.Get_PurpleAir_df_sensors
+# (Async_Engine.py swaps in its aiohttp version)
+
+fetch_sensors = purp.Get_PurpleAir_df_sensors
+
+## Spike Persistence
+
+# A reading over the threshold is only a spike if at least persistence_k of the sensor's last persistence_n readings were
+# (see Readings_Buffer.py) - or, with rising_trend, if persistence_k - 1 of them were and they are trending up (lets a growing plume alert one reading early)
+# A lone jump is never a trend: with k = 3, n = 4, readings [10, 10, 500] have 1 of 3 over 35 - not persistent, and not 2 over, so not rising either
+# persistence_k = persistence_n = 1 is a single reading threshold. Set in MAIN.py
+
+persistence_k = 1
+persistence_n = 1
+rising_trend = False
+
 ## Workflow
 
 def workflow(purpleAir_api, pg_connection_dict, spike_threshold):
@@ -39,7 +79,8 @@ def workflow(purpleAir_api, pg_connection_dict, spike_threshold):
 
     # Query PurpleAir for Spikes
 
-    spikes_df, purpleAir_runtime, flagged_sensor_ids = Get_spikes_df(purpleAir_api, sensor_ids, spike_threshold) # In Get_Spikes_df.py
+    spikes_df, purpleAir_runtime, flagged_sensor_ids = Get_spikes_df(purpleAir_api, sensor_ids, spike_threshold,
+                                                                     pg_connection_dict = pg_connection_dict) # Also keeps the readings
     
     # Update last_elevated
     
@@ -52,13 +93,13 @@ def workflow(purpleAir_api, pg_connection_dict, spike_threshold):
 
         flag_sensors(flagged_sensor_ids.to_list(), pg_connection_dict)    
     
-    sensors_dict = Sort_sensor_indices(spikes_df, flagged_sensor_ids, pg_connection_dict)
+    sensors_dict = Sort_sensor_indices(spikes_df, flagged_sensor_ids, pg_connection_dict, purpleAir_runtime)
     
     return spikes_df, purpleAir_runtime, sensors_dict
 
 ### The Function to get spikes dataframe
 
-def Get_spikes_df(purpleAir_api, sensor_ids, spike_threshold, timezone = 'America/Chicago'):
+def Get_spikes_df(purpleAir_api, sensor_ids, spike_threshold, timezone = 'America/Chicago', pg_connection_dict = None):
     
     ''' This function queries the PurpleAir API for sensors in the list of sensor_ids for readings over a spike threshold. 
     It will return a pandas dataframe with columns sensor_index (integer) and pm25 (float) as well as a runtime (datetime)
@@ -68,6 +109,7 @@ def Get_spikes_df(purpleAir_api, sensor_ids, spike_threshold, timezone = 'Americ
     api = string of PurpleAir API api_read_key
     sensor_ids = list of integers of purpleair sensor ids to query
     spike_threshold = float of spike value threshold (keep values >=)
+    pg_connection_dict = optional - if given, all the readings are appended to the readings table
     
     Outputs:
     
@@ -80,22 +122,24 @@ def Get_spikes_df(purpleAir_api, sensor_ids, spike_threshold, timezone = 'Americ
     
     fields = ['pm2.5_10minute', 'channel_flags', 'last_seen']
 
-    sensors_df, runtime = purp.Get_PurpleAir_df_sensors(purpleAir_api, sensor_ids, fields)
+    sensors_df, runtime = Get_current_readings(purpleAir_api, sensor_ids, fields, timezone)
         
     if len(sensors_df) > 0:
-        # Correct last_seen
-        sensors_df['last_seen'] = pd.to_datetime(sensors_df['last_seen'],
-                                                 utc = True,
-                                                 unit='s').dt.tz_convert(timezone)                                
-        # Correct sensor_index/channel_flags
-        sensors_df['sensor_index'] = sensors_df['sensor_index'].astype(int)
-        sensors_df['channel_flags'] = sensors_df['channel_flags'].astype(int)
+        # Keep the history (see Readings_Table.py) - best effort, a failed write shouldn't cost us this tick's spikes
+        if pg_connection_dict is not None:
+            try:
+                Readings_Table.Append(sensors_df, runtime, pg_connection_dict)
+            except Exception:
+                print('ERROR appending readings')
+                traceback.print_exc()
+        
+        # Columns are already typed (see purp.Decode_response)
         ### Clean the data
         # Key
         # Channel Flags - 0 = Normal, 1 = A Downgraded, 2 - B Downgraded, 3 - Both Downgraded
         # last seen not in the last hour is also a flag
         flags = (sensors_df.channel_flags != 0 
-                ) |(sensors_df.last_seen < dt.datetime.now(pytz.timezone(timezone)) - dt.timedelta(minutes=60)
+                ) |(sensors_df.last_seen < PurpleAir_Replay.Now(timezone) - dt.timedelta(minutes=60)
                      )
         clean_df = sensors_df[~flags].copy()
 
@@ -106,8 +150,22 @@ def Get_spikes_df(purpleAir_api, sensor_ids, spike_threshold, timezone = 'Americ
         # Remove NaNs
         clean_df = clean_df.dropna()
         
-        ### Get spikes_df
-        spikes_df = clean_df[clean_df.pm25 >= spike_threshold][['sensor_index', 'pm25']].reset_index(drop=True) 
+        # Remember this tick's readings
+        Readings_Buffer.Update(clean_df.sensor_index.to_numpy(), clean_df.pm25.to_numpy())
+        
+        ### Get spikes_df - over the threshold now and persistently (or rising)
+        over_df = clean_df[clean_df.pm25 >= spike_threshold]
+        
+        over_sensors = over_df.sensor_index.to_numpy()
+        is_spike = Readings_Buffer.Persistent(over_sensors, spike_threshold, persistence_k, persistence_n)
+        if rising_trend and persistence_k > 1: # Rising AND already over the threshold in K-1 readings - rising alone passes any jump
+            rising = Readings_Buffer.Rising(over_sensors, persistence_n)
+            nearly_persistent = Readings_Buffer.Persistent(over_sensors, spike_threshold, persistence_k - 1, persistence_n)
+            is_spike = is_spike | (rising & nearly_persistent)
+        
+        spikes_df = over_df[is_spike][['sensor_index', 'pm25']].reset_index(drop=True) 
+        spikes_df['sensor_index'] = spikes_df.sensor_index.astype(int)
+        spikes_df['pm25'] = spikes_df.pm25.astype(float).round(3) # float32 -> float64 without the float32 noise (12.3 not 12.300000190734863)
         
         ### Get Flagged Sensor_ids
         flagged_df = sensors_df[flags].copy()
@@ -119,6 +177,72 @@ def Get_spikes_df(purpleAir_api, sensor_ids, spike_threshold, timezone = 'Americ
     
     return spikes_df, runtime, flagged_sensor_ids
     
+### The Function to get the current readings (full or delta polling)
+
+def Get_current_readings(purpleAir_api, sensor_ids, fields, timezone = 'America/Chicago'):
+    '''
+    Gets the latest PurpleAir row for every sensor in sensor_ids (list of integers)
+
+    Without delta_polling (or when a full refresh is due) this queries every sensor.
+    Otherwise it only queries sensors modified_since the last successful poll (plus any sensors we have never seen)
+    and merges them into _current_readings
+
+    returns the same as purp.Get_PurpleAir_df_sensors - df (typed - empty if errored) and runtime
+    '''
+
+    global _current_readings, _last_poll, _last_full_refresh
+
+    now = PurpleAir_Replay.Now(timezone)
+
+    full_refresh = (not delta_polling
+                    or _current_readings is None
+                    or now - _last_full_refresh > dt.timedelta(minutes = full_refresh_minutes)
+                   )
+
+    if full_refresh:
+
+        df, runtime = fetch_sensors(purpleAir_api, sensor_ids, fields, timezone)
+
+        if delta_polling and len(df) > 0:
+            _current_readings = df
+            _last_poll = runtime
+            _last_full_refresh = runtime
+
+        return df, runtime
+
+    # Delta - only what changed since the last poll
+
+    modified_since = _last_poll.timestamp() - overlap_seconds
+
+    delta_df, runtime = fetch_sensors(purpleAir_api, sensor_ids, fields, timezone, modified_since)
+
+    if len(delta_df.columns) == 0: # Errored - keep our table, try again next time
+        return pd.DataFrame(), runtime
+
+    dfs = [_current_readings, delta_df]
+
+    # Sensors new to us (eg. added by the daily update) get a normal query
+
+    unseen_sensor_ids = list(set(sensor_ids) - set(_current_readings.sensor_index) - set(delta_df.sensor_index))
+
+    if len(unseen_sensor_ids) > 0:
+
+        unseen_df, unseen_runtime = fetch_sensors(purpleAir_api, unseen_sensor_ids, fields, timezone)
+
+        dfs += [unseen_df]
+
+    # Merge - the newest row for each sensor wins, only keep the sensors we asked about
+
+    merged_df = pd.concat([df for df in dfs if len(df) > 0], ignore_index = True)
+    merged_df = merged_df.drop_duplicates('sensor_index', keep = 'last')
+
+    _current_readings = merged_df[merged_df.sensor_index.isin(sensor_ids)].reset_index(drop=True)
+    _last_poll = runtime
+
+    print(f'Delta poll - {len(delta_df)} of {len(_current_readings)} sensors changed')
+
+    return _current_readings.copy(), runtime
+
 ### Function to update all last_elevateds
 
 def Update_last_elevated(sensor_indices, purpleAir_runtime, pg_connection_dict):
@@ -152,18 +276,28 @@ def flag_sensors(sensor_indices, pg_connection_dict):
     
 ### Function to sort the sensor indices
     
-def Sort_sensor_indices(spikes_df, flagged_sensor_ids, pg_connection_dict):
+def Sort_sensor_indices(spikes_df, flagged_sensor_ids, pg_connection_dict, purpleAir_runtime = None):
     '''
     This sorts the sensor indices into sets based on if they are new, ongoing, ended, flagged, or not spiked
     
     Inputs: spikes_df - pd.DataFrame - from Get_spikes_df()
             sensor_ids - list of integers - from get_sensor_ids()
             active_alerts_df - pd.DataFrame - from get_active_alerts()
+            purpleAir_runtime - datetime - when the spikes were read
             
     returns a dictionary with keys 'new', 'ongoing', 'ended', 'flagged', or 'not'
                 values are sets of integers (sensor_index)
+    
+    Uses Sensor_State (in memory, no queries) if it's loaded, otherwise the database
     '''
     
+    if Sensor_State.is_loaded():
+    
+        return Sensor_State.Classify(spikes_df.sensor_index.to_list() if len(spikes_df) > 0 else [],
+                                     flagged_sensor_ids,
+                                     purpleAir_runtime if purpleAir_runtime is not None else PurpleAir_Replay.Now(),
+                                     PurpleAir_Replay.Now())
+    
     # Initialize storage
     
     sensor_dict = {'new': set(),
@@ -183,14 +317,14 @@ def Sort_sensor_indices(spikes_df, flagged_sensor_ids, pg_connection_dict):
     active_alerts_df = query.Get_previous_active_sensors(pg_connection_dict)
     
     if len(active_alerts_df) > 0:
-        previous_active_spike_sensors = set(active_alerts_df.sensor_indices.sum()) # From our database - sensor_indices are currently composed of arrays
+        previous_active_spike_sensors = set().union(*active_alerts_df.sensor_indices) # From our database - sensor_indices are currently composed of arrays
         # The sensor_indices are given as lists of indices because we may cluster alerts eventually
     else:
         previous_active_spike_sensors = set()
         
     # Not active  = all sensors not elevated in past 30 minutes
     
-    not_elevated_sensor_indices = set(query.Get_not_elevated_sensors(pg_connection_dict))
+    not_elevated_sensor_indices = set(query.Get_not_elevated_sensors(pg_connection_dict, now = PurpleAir_Replay.Now()))
 
     # The sets:
 
@@ -29,8 +29,7 @@ import time # For Sleeping
 
 # Database 
 
-import psycopg2
-from psycopg2 import sql
+import Basic_PSQL as psql # Pooled connections
 
 # Data Manipulation
 
@@ -47,6 +46,14 @@ import Ongoing_Alerts
 import Ended_Alerts
 import Send_Alerts
 import Twilio_Functions as our_twilio
+import Spatial_Index
+import PurpleAir_Functions as purp
+import PurpleAir_Budget
+import PurpleAir_Replay
+import Sensor_State
+import Scheduler
+import Daily_Worker
+import Opt_Outs
 
 ## Global Variables
 
@@ -70,15 +77,97 @@ creds = [os.getenv('DB_NAME'),
 
 pg_connection_dict = dict(zip(['dbname', 'user', 'password', 'port', 'host'], creds))  
 
+# Replaying a recording? (see PurpleAir_Replay.py) - it writes alerts/readings with the recorded times,
+# so it must run against its own database (REPLAY_DB_NAME, and REPLAY_DB_USER/PASS/PORT/HOST if they differ), never production
+
+replaying = bool(os.getenv('PURPLEAIR_REPLAY'))
+
+if replaying:
+
+    replay_creds = [os.getenv('REPLAY_DB_NAME'),
+                    os.getenv('REPLAY_DB_USER') or os.getenv('DB_USER'),
+                    os.getenv('REPLAY_DB_PASS') or os.getenv('DB_PASS'),
+                    os.getenv('REPLAY_DB_PORT') or os.getenv('DB_PORT'),
+                    os.getenv('REPLAY_DB_HOST') or os.getenv('DB_HOST')
+                   ]
+
+    replay_connection_dict = dict(zip(['dbname', 'user', 'password', 'port', 'host'], replay_creds))
+
+    same_database = all(replay_connection_dict[key] == pg_connection_dict[key] for key in ['dbname', 'port', 'host'])
+
+    if not replay_connection_dict['dbname'] or same_database:
+        sys.exit('Replaying needs its own database - set REPLAY_DB_NAME (not the production DB_NAME) in the .env file')
+
+    pg_connection_dict = replay_connection_dict
+
+psql.configure_pool(pg_connection_dict) # Connections are reused for the whole run - see Basic_PSQL.py
+
+# Where do we look up users nearby sensors? 'postgis' (database) or 'memory' (see Spatial_Index.py)
+
+spatial_backend = os.getenv('SPATIAL_BACKEND', 'postgis')
+
+if spatial_backend == 'memory':
+    Spatial_Index.Load(pg_connection_dict)
+
+# Keep every sensor's state in memory (see Sensor_State.py) - rebuilt from the database at startup
+
+Sensor_State.Load(pg_connection_dict)
+
+# Only ask PurpleAir for sensors modified since the last poll? (see GetSort_Spikes.py)
+
+GetSort_Spikes.delta_polling = os.getenv('PURPLEAIR_DELTA_POLLING', 'false').lower() == 'true'
+
+# PurpleAir point budgets - the polling interval widens to stay within them (see PurpleAir_Budget.py)
+
+PurpleAir_Budget.daily_budget = int(os.getenv('PURPLEAIR_DAILY_POINTS')) if os.getenv('PURPLEAIR_DAILY_POINTS') else None
+PurpleAir_Budget.monthly_budget = int(os.getenv('PURPLEAIR_MONTHLY_POINTS')) if os.getenv('PURPLEAIR_MONTHLY_POINTS') else None
+
+# How many texts per second does our Twilio messaging service allow? (see Twilio_Functions.py)
+
+our_twilio.messages_per_second = float(os.getenv('TWILIO_MESSAGES_PER_SECOND', 1))
+
+# Record PurpleAir responses? Or replay a recording offline? (see PurpleAir_Replay.py)
+# Replaying skips the daily updates and never sends texts - REPLAY_SPEED = times faster than real time ('' = no sleeping)
+
+if os.getenv('PURPLEAIR_RECORD_DIR'):
+    PurpleAir_Replay.Start_recording(os.getenv('PURPLEAIR_RECORD_DIR'))
+
+if replaying:
+    PurpleAir_Replay.Load_replay(os.getenv('PURPLEAIR_REPLAY'),
+                                 speed = float(os.getenv('REPLAY_SPEED')) if os.getenv('REPLAY_SPEED') else None)
+
+# Run each tick's PurpleAir/REDCap/Twilio calls on asyncio? (see Async_Engine.py - needs aiohttp)
+
+async_engine = os.getenv('ASYNC_ENGINE', 'false').lower() == 'true'
+
+if async_engine:
+    import Async_Engine
+    Async_Engine.Start()
+
+# Daily updates run on their own thread and connections (not while replaying)
+
+if not replaying:
+    Daily_Worker.Start(purpleAir_api, redCap_token_signUp, pg_connection_dict)
+
+    # Catch up the opt out registry before the first texts (see Opt_Outs.py)
+    Opt_Outs.Sync(pg_connection_dict)
+
 ## Other Constants from System Arguments
 
 spike_threshold = int(sys.argv[1]) # Value which defines an AQ_Spike (Micgrograms per meter cubed)
 
+# A spike needs K of the last N readings over spike_threshold, or K-1 of them and a rising trend (see GetSort_Spikes.py)
+# Defaults to a single reading over spike_threshold (K = N = 1, no rising trend)
+
+GetSort_Spikes.persistence_k = int(os.getenv('SPIKE_PERSISTENCE_K', 1))
+GetSort_Spikes.persistence_n = int(os.getenv('SPIKE_PERSISTENCE_N', 1))
+GetSort_Spikes.rising_trend = os.getenv('SPIKE_RISING_TREND', 'false').lower() == 'true'
+
 timestep = int(sys.argv[3]) # Sleep time in between updates (in Minutes)
 
 # When to stop the program? (datetime)
 days_to_run = int(sys.argv[2]) # How many days will we run this?
-starttime = dt.datetime.now(pytz.timezone('America/Chicago')) 
+starttime = PurpleAir_Replay.Now('America/Chicago') # The recording's start if replaying
 stoptime = starttime + dt.timedelta(days=days_to_run)
 
 # Waking hours
@@ -93,6 +182,10 @@ base_report_url = 'https://redcap.ahc.umn.edu/surveys/?s=LN3HHDCJXYCKFCLE'
 
 verified_number = True
 
+# What to do when a tick takes longer than the timestep? 'skip' to the next tick on schedule or 'catch_up' (see Scheduler.py)
+
+overrun_policy = 'skip'
+
 
 ### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~`
 
@@ -113,15 +206,25 @@ next_update_time = starttime.replace(hour=8, minute = 0, second = 0)
 reports_for_day = 0
 messages_sent_today = 0
 
+# Fixed cadence ticks on a monotonic clock (the replay clock if replaying)
+
+if replaying:
+    schedule = Scheduler.Start(timestep * 60, overrun_policy, clock = lambda: PurpleAir_Replay.Now().timestamp())
+else:
+    schedule = Scheduler.Start(timestep * 60, overrun_policy)
+
 while True:
 #    try:
-    now = dt.datetime.now(pytz.timezone('America/Chicago')) # The current time
+    now = PurpleAir_Replay.Now('America/Chicago') # The current time (the replay clock if replaying)
 
     print(now)
 
     if stoptime < now: # Check if we've hit stoptime
         break
         
+    if replaying and PurpleAir_Replay.is_finished(): # Played the whole recording
+        break
+        
     # Is is within waking hours? Can we text people?
     if (now.hour < too_late_hr) & (now.hour > too_early_hr):
         can_text = True
@@ -132,69 +235,94 @@ while True:
    
    # Daily Updates
    
-    if now > next_update_time:
-    
-        next_update_time, reports_for_day, messages_sent_today = Daily_Updates.workflow(next_update_time,
-                                                                                        reports_for_day,
-                                                                                  messages_sent_today,
-                                                                                   purpleAir_api,
-                                                                                    redCap_token_signUp,
-                                                                                    pg_connection_dict)
+    if now > next_update_time and replaying: # Offline - no REDCap/emails/texts
+    
+        next_update_time += dt.timedelta(days=1)
+   
+    elif now > next_update_time: # On the daily worker (see Daily_Worker.py) - the spike checks don't wait for it
+    
+        Daily_Worker.Submit(next_update_time)
+        
+        next_update_time += dt.timedelta(days=1)
+    
+    for finished in Daily_Worker.Apply(): # Swap in the newest stations/users snapshot if the worker finished one
+        
+        if finished['updated']: # If updated full system
+        
+            print(reports_for_day, 'reports yesterday')
+            print(messages_sent_today, 'messages sent yesterday')
+            
+            # Initialize storage for daily metrics (report_ids restart with today's date)
+            reports_for_day = 0
+            messages_sent_today = 0
    
    # ~~~~~~~~~~~~~~~~~~~~~
 
-    # Query PurpleAir for Spikes and sort out if we have new, ongoing, ended, flagged, not spiked sensors
+    if async_engine: # The same steps on the event loop - see Async_Engine.py
 
-    spikes_df, purpleAir_runtime, sensors_dict = GetSort_Spikes.workflow(purpleAir_api, pg_connection_dict, spike_threshold)
+        purpleAir_runtime, messages, record_ids_to_text, reports_for_day = Async_Engine.Run_tick(purpleAir_api,
+                                                                                                 pg_connection_dict,
+                                                                                                 spike_threshold,
+                                                                                                 reports_for_day,
+                                                                                                 base_report_url,
+                                                                                                 can_text)
 
+    else:
+        # Query PurpleAir for Spikes and sort out if we have new, ongoing, ended, flagged, not spiked sensors
+
+        spikes_df, purpleAir_runtime, sensors_dict = GetSort_Spikes.workflow(purpleAir_api, pg_connection_dict, spike_threshold)
 
-    # Initialize message/record_id storage
+
+        # Initialize message/record_id storage
     
-    record_ids_to_text = []
-    messages = []
+        record_ids_to_text = []
+        messages = []
     
-    # ~~~~~~~~~~~~~~~~~~~~~
+        # ~~~~~~~~~~~~~~~~~~~~~
     
-    # NEW Spikes
+        # NEW Spikes
     
-    if len(sensors_dict['new']) > 0:
+        if len(sensors_dict['new']) > 0:
 
-        new_spikes_df = spikes_df[spikes_df.sensor_index.isin(sensors_dict['new'])] 
+            new_spikes_df = spikes_df[spikes_df.sensor_index.isin(sensors_dict['new'])] 
     
-        messages, record_ids_to_text = New_Alerts.workflow(new_spikes_df, purpleAir_runtime, messages, record_ids_to_text, can_text, pg_connection_dict)
+            messages, record_ids_to_text = New_Alerts.workflow(new_spikes_df, purpleAir_runtime, messages, record_ids_to_text, can_text, pg_connection_dict)
                  
-    # ~~~~~~~~~~~~~~~~~~~~~
+        # ~~~~~~~~~~~~~~~~~~~~~
 
-    # ONGOING spikes
+        # ONGOING spikes
 
-    if len(sensors_dict['ongoing']) > 0:
+        if len(sensors_dict['ongoing']) > 0:
 
-        ongoing_spikes_df = spikes_df[spikes_df.sensor_index.isin(sensors_dict['ongoing'])]
+            ongoing_spikes_df = spikes_df[spikes_df.sensor_index.isin(sensors_dict['ongoing'])]
         
-        Ongoing_Alerts.workflow(ongoing_spikes_df, pg_connection_dict)
+            Ongoing_Alerts.workflow(ongoing_spikes_df, pg_connection_dict, spikes_df) # New spikes may have merged alerts
     
-    # ~~~~~~~~~~~~~~~~~~~~~~~~
+        # ~~~~~~~~~~~~~~~~~~~~~~~~
     
-    # ENDED spikes
-
-    messages, record_ids_to_text, reports_for_day = Ended_Alerts.workflow(sensors_dict,
-                                                                         purpleAir_runtime,
-                                                                          messages,
-                                                                           record_ids_to_text,
-                                                                            reports_for_day,
-                                                                            base_report_url,
-                                                                            can_text,
-                                                                             pg_connection_dict)
+        # ENDED spikes
+
+        messages, record_ids_to_text, reports_for_day = Ended_Alerts.workflow(sensors_dict,
+                                                                             purpleAir_runtime,
+                                                                              messages,
+                                                                               record_ids_to_text,
+                                                                                reports_for_day,
+                                                                                base_report_url,
+                                                                                can_text,
+                                                                                 pg_connection_dict)
                 
     # ~~~~~~~~~~~~~~~~~~~~~           
-    
+
     # Send all messages
     
     if len(record_ids_to_text) > 0:
     
-        Send_Alerts.send_all_messages(record_ids_to_text, messages,
-                          redCap_token_signUp,
-                          pg_connection_dict) # in Send_Alerts.py & .ipynb
+        if not replaying: # Never text anyone from a replay
+            # On the background send stage - the next tick's fetch doesn't wait for the texts to go out (see Scheduler.py)
+            Scheduler.Submit('send', Async_Engine.Run_send if async_engine else Send_Alerts.send_all_messages,
+                              list(record_ids_to_text), list(messages),
+                              redCap_token_signUp,
+                              pg_connection_dict) # in Send_Alerts.py & .ipynb
         
         # Save them locally - for developers
         
@@ -208,13 +336,20 @@ while True:
     
     # ~~~~~~~~~~~~~~~~~~~~~
 
-    # SLEEP between updates
-
-    when_to_awake = now + dt.timedelta(minutes=timestep) 
+    # Record the PurpleAir points we spent, widen the interval if we're over budget (see PurpleAir_Budget.py)
+    
+    PurpleAir_Budget.Record_calls(pg_connection_dict)
+    
+    interval = PurpleAir_Budget.Polling_interval(timestep, pg_connection_dict) # minutes
+    
+    print(f'PurpleAir burn rate: {PurpleAir_Budget.Burn_rate():.0f} points/hour')
+    
+    # SLEEP until the next tick is due (or advance the replay clock)
 
-    sleep_seconds = (when_to_awake - dt.datetime.now(pytz.timezone('America/Chicago'))).seconds # - it takes about 3 seconds to run through everything without texting... I think?
+    if Scheduler.Pending('send') > 1:
+        print(Scheduler.Pending('send'), 'message batches still sending')
 
-    time.sleep(sleep_seconds) # Sleep
+    Scheduler.Wait(schedule, interval * 60, sleep = PurpleAir_Replay.Sleep)
         
 #    except Exception as e:
 #        our_twilio.send_texts([os.environ['LOCAL_PHONE']], ['SpikeAlerts Down'])
@@ -233,4 +368,11 @@ while True:
 
 #our_twilio.send_texts([os.environ['LOCAL_PHONE']], ['Terminating Program'])
 
+Scheduler.Shutdown() # Let the last messages go out
+Daily_Worker.Stop()
+if async_engine:
+    Async_Engine.Close()
+psql.close_all_pools()
+purp.close_session()
+
 print("Terminating Program")
@@ -5,13 +5,17 @@
 import datetime as dt # Working with dates/times
 import pytz # Timezones
 
-# Database 
+# Database
 
 import Basic_PSQL as psql
 import Our_Queries as query
-import psycopg2
 from psycopg2 import sql
 
+# Sensor State
+
+import Sensor_State
+import Alert_Clusters
+
 # Data Manipulation
 
 import pandas as pd
@@ -24,117 +28,242 @@ import Create_messages
 
 def workflow(new_spikes_df, purpleAir_runtime, messages, record_ids_to_text, can_text, pg_connection_dict):
     '''
-    Runs the full workflow for a new spike
-    
-    Needs new_spikes_df (pd.DataFrame with columns 'sensor_index' int  and 'pm25' float, 
+    Runs the full workflow for all new spikes at once
+
+    Needs new_spikes_df (pd.DataFrame with columns 'sensor_index' int  and 'pm25' float,
             purpleAir_runtime (datetime timestamp))
     '''
-    
-    # NEW Spikes - for every newly alerted sensor we should...
-    
-    for _, row in new_spikes_df.iterrows():
-
-        # 1) Add to active alerts
-    
-        newest_alert_index = add_to_active_alerts(row,
-                                                 pg_connection_dict,
-                                                 purpleAir_runtime # When we ran the PurpleAir Query
-                                                 )
-        
-        # 2) Query users ST_Dwithin 1000 meters & subscribed = TRUE
-        
-        record_ids_nearby = query.Get_active_users_nearby_sensor(pg_connection_dict, row.sensor_index, 1000) # in Send_Alerts.py
-        
-        if len(record_ids_nearby) > 0:
-
-            if can_text: # Waking Hours
-        
-                # a) Query users from record_ids_nearby if both active_alerts and cached_alerts are empty
-                record_ids_new_alerts = query.Get_users_to_message_new_alert(pg_connection_dict, record_ids_nearby) # in Send_Alerts.py & .ipynb 
-                
-                # Compose Messages & concat to messages/record_id_to_text   
-                
-                # Add to message/record_id storage for future messaging
-                record_ids_to_text += record_ids_new_alerts
-                messages += [Create_messages.new_alert_message(row.sensor_index)]*len(record_ids_new_alerts) # in Create_Messages.py
-                
-            # b) Add newest_alert_index to record_ids_nearby's Active Alerts
-            Update_users_active_alerts(record_ids_nearby, newest_alert_index, pg_connection_dict) 
-            
+
+    # NEW Spikes - for all newly alerted sensors together we should...
+
+    # 1) Cluster them with each other and with the active alerts (see Alert_Clusters.py)
+
+    active_sensors_df = query.Get_active_alert_sensors(pg_connection_dict) # in Our_Queries.py
+
+    plan_df, merges = Alert_Clusters.Plan_new_alerts(new_spikes_df.sensor_index.to_list(), active_sensors_df, pg_connection_dict)
+
+    plan_df = plan_df.merge(new_spikes_df[['sensor_index', 'pm25']], on = 'sensor_index')
+
+    # 2) Merge the active alerts a new spike connects (one statement)
+
+    if len(merges) > 0:
+
+        Merge_alerts(merges, pg_connection_dict)
+
+        survivor_of = {absorbed:survivor for survivor, absorbed_list in merges.items() for absorbed in absorbed_list}
+        merged_df = active_sensors_df[active_sensors_df.alert_index.isin(survivor_of.keys())]
+
+        Sensor_State.Set_alerts(merged_df.sensor_index.to_list(), merged_df.alert_index.map(survivor_of).to_list()) # If it's in use
+
+    # 3) Add the new sensors next to an active alert to that alert (one statement)
+
+    joined_df = plan_df[plan_df.alert_index >= 0]
+
+    if len(joined_df) > 0:
+
+        Add_sensors_to_alerts(joined_df, pg_connection_dict)
+
+    # 4) One new alert for each remaining cluster (one INSERT)
+
+    created_df = add_to_active_alerts(plan_df[plan_df.alert_index < 0],
+                                      pg_connection_dict,
+                                      purpleAir_runtime # When we ran the PurpleAir Query
+                                      )
+
+    new_alerts_df = pd.concat([joined_df[['alert_index', 'sensor_index']], created_df[['alert_index', 'sensor_index']]],
+                              ignore_index = True)
+
+    new_alerts_df['order'] = new_alerts_df.sensor_index.map({sensor_index:i for i, sensor_index in enumerate(new_spikes_df.sensor_index.astype(int))})
+
+    Sensor_State.Set_alerts(new_alerts_df.sensor_index.to_list(), new_alerts_df.alert_index.to_list()) # If it's in use
+
+    # 5) Query users ST_Dwithin 1000 meters & subscribed = TRUE for all the new sensors at once
+
+    nearby_df = query.Get_active_users_nearby_sensors(pg_connection_dict, new_alerts_df.sensor_index.to_list(), 1000) # in Our_Queries.py
+
+    if len(nearby_df) > 0:
+
+        nearby_df = nearby_df.merge(new_alerts_df, on = 'sensor_index')
+
+        if can_text: # Waking Hours
+
+            # a) Users nearby with no active or cached alerts get one message
+            #    about the first new sensor near them (same order as new_spikes_df)
+
+            to_text_df = nearby_df[nearby_df.no_alerts].sort_values(['order', 'record_id']
+                                                                  ).drop_duplicates('record_id')
+
+            # Compose Messages & concat to messages/record_id_to_text
+
+            # Add to message/record_id storage for future messaging
+            record_ids_to_text += to_text_df.record_id.to_list()
+            messages += [Create_messages.new_alert_message(sensor_index) for sensor_index in to_text_df.sensor_index] # in Create_Messages.py
+
+        # b) Add the alert indices to the nearby users' Active Alerts (already there if they joined an alert near them)
+        Update_users_active_alerts(nearby_df.record_id.to_list(), nearby_df.alert_index.to_list(), pg_connection_dict)
+
     return messages, record_ids_to_text
-            
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    
-def add_to_active_alerts(row, pg_connection_dict, purpleAir_runtime):
+
+def add_to_active_alerts(new_spikes_df, pg_connection_dict, purpleAir_runtime):
     '''
-    This takes a row from spikes_df,
+    This takes new_spikes_df (columns sensor_index and pm25, optionally group - sensors with the same group share an alert),
     the connection dictionary,
     runtime_for_db = datetime when purpleair was queried
-    
-    it returns the alert_index that it created
-    
+
+    It inserts one alert per group (per spike without groups) in a single statement and
+    returns a dataframe of the alerts' sensors with columns
+    alert_index (int), sensor_index (int)
     '''
-    cols_for_db = ['sensor_indices', 'start_time', 'max_reading']
-    sensor_indices = [row.sensor_index] # We haven't started to cluster alerts yet
+
+    if len(new_spikes_df) == 0:
+        return pd.DataFrame({'alert_index': pd.Series(dtype = int), 'sensor_index': pd.Series(dtype = int)})
+
+    sensor_indices = new_spikes_df.sensor_index.astype(int).to_list()
+    readings = new_spikes_df.pm25.astype(float).to_list()
+    groups = new_spikes_df.group.astype(int).to_list() if 'group' in new_spikes_df else list(range(len(sensor_indices)))
     runtime_for_db = purpleAir_runtime.strftime('%Y-%m-%d %H:%M:%S')
-    reading = float(row.pm25)
-
-    # Create Cursor for commands
-    conn = psycopg2.connect(**pg_connection_dict)
-    cur = conn.cursor()
-    
-    # This is really a great way to insert a lot of data
-
-    vals = [sensor_indices, runtime_for_db, reading]
-    
-    q1 = sql.SQL('INSERT INTO "Active Alerts Acute PurpleAir" ({}) VALUES ({});').format(
-     sql.SQL(', ').join(map(sql.Identifier, cols_for_db)),
-     sql.SQL(', ').join(sql.Placeholder() * (len(cols_for_db))))
-
-    cur.execute(q1.as_string(conn),
-        (vals)
-        )
-    # Commit command
-    conn.commit()
-    
-    # Get alert_index we just created
-    
-    cmd = sql.SQL('''SELECT alert_index
-    FROM "Active Alerts Acute PurpleAir"
-    WHERE sensor_indices = {}::int[];'''
-             ).format(sql.Literal(sensor_indices))
-    
-    cur.execute(cmd)     
-    
-    conn.commit() # Committ command
-    
-    newest_alert_index = cur.fetchall()[0][0]
-    
-    # Close cursor
-    cur.close()
-    # Close connection
-    conn.close()
-    
-    return newest_alert_index
-    
+
+    cmd = sql.SQL('''
+    INSERT INTO "Active Alerts Acute PurpleAir" (sensor_indices, start_time, max_reading, mean_reading, sample_count)
+    SELECT ARRAY_AGG(s.sensor_index ORDER BY s.n), {}, MAX(s.pm25), AVG(s.pm25), COUNT(*)
+    FROM unnest({}::int[], {}::float[], {}::int[]) WITH ORDINALITY AS s(sensor_index, pm25, grp, n)
+    GROUP BY s.grp
+    ORDER BY MIN(s.n)
+    RETURNING alert_index, sensor_indices;
+    ''').format(sql.Literal(runtime_for_db),
+                sql.Literal(sensor_indices),
+                sql.Literal(readings),
+                sql.Literal(groups))
+
+    response = psql.get_response(cmd, pg_connection_dict)
+
+    # Unpack response - one row per sensor
+
+    created_df = pd.DataFrame([(alert_index, sensor_index) for alert_index, sensors in response for sensor_index in sensors],
+                              columns = ['alert_index', 'sensor_index'])
+
+    return created_df
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Add_sensors_to_alerts(joined_df, pg_connection_dict):
+    '''
+    Adds new spiking sensors to active alerts - joined_df has columns sensor_index, alert_index, pm25
+    Their readings go into the alerts' max_reading/mean_reading/sample_count - all alerts in one UPDATE
+    '''
+
+    cmd = sql.SQL('''
+WITH joined as
+(
+SELECT j.alert_index, ARRAY_AGG(j.sensor_index) as sensor_indices,
+    MAX(j.pm25) as max_pm25, SUM(j.pm25) as sum_pm25, COUNT(*) as n
+FROM unnest({}::bigint[], {}::int[], {}::float[]) AS j(alert_index, sensor_index, pm25)
+GROUP BY j.alert_index
+)
+UPDATE "Active Alerts Acute PurpleAir" a
+SET sensor_indices = a.sensor_indices || j.sensor_indices,
+    max_reading = GREATEST(j.max_pm25, a.max_reading),
+    mean_reading = (COALESCE(a.mean_reading, a.max_reading) * a.sample_count + j.sum_pm25) / (a.sample_count + j.n),
+    sample_count = a.sample_count + j.n
+FROM joined j
+WHERE a.alert_index = j.alert_index;
+    ''').format(sql.Literal(joined_df.alert_index.astype(int).to_list()),
+                sql.Literal(joined_df.sensor_index.astype(int).to_list()),
+                sql.Literal(joined_df.pm25.astype(float).to_list()))
+
+    psql.send_update(cmd, pg_connection_dict)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Merge_alerts(merges, pg_connection_dict):
+    '''
+    Merges active alerts - merges is a dictionary of surviving alert_index: list of alert_indices to merge into it
+
+    The merged alerts are moved to the archive (merged_into = the survivor), their sensors/readings/start_time folded into the survivor
+    and their users moved to the survivor in user_alert - all in one statement
+    '''
+
+    survivors = [survivor for survivor, absorbed_list in merges.items() for absorbed in absorbed_list]
+    absorbed = [absorbed for survivor, absorbed_list in merges.items() for absorbed in absorbed_list]
+
+    cmd = sql.SQL('''
+WITH pairs as
+(
+SELECT p.absorbed, p.survivor
+FROM unnest({}::bigint[], {}::bigint[]) AS p(absorbed, survivor)
+), removed as -- The merged alerts
+(
+DELETE FROM "Active Alerts Acute PurpleAir" a
+USING pairs p
+WHERE a.alert_index = p.absorbed
+RETURNING a.alert_index, p.survivor, a.sensor_indices, a.start_time,
+    CURRENT_TIMESTAMP AT TIME ZONE 'America/Chicago' - a.start_time as time_diff,
+    a.max_reading, COALESCE(a.mean_reading, a.max_reading) as mean_reading, a.sample_count
+), archived as -- Keep their history - reports can leave out the merged ones (merged_into IS NOT NULL)
+(
+INSERT INTO "Archived Alerts Acute PurpleAir" (alert_index, sensor_indices, start_time, duration_minutes, max_reading, mean_reading, sample_count, merged_into)
+SELECT r.alert_index, r.sensor_indices, r.start_time, (((DATE_PART('day', r.time_diff) * 24) +
+    DATE_PART('hour', r.time_diff)) * 60 + DATE_PART('minute', r.time_diff)) as duration_minutes,
+    r.max_reading, r.mean_reading, r.sample_count, r.survivor
+FROM removed r
+), sensors as
+(
+SELECT r.survivor, ARRAY_AGG(x.sensor_index) as sensor_indices
+FROM removed r
+CROSS JOIN LATERAL unnest(r.sensor_indices) AS x(sensor_index)
+GROUP BY r.survivor
+), readings as
+(
+SELECT r.survivor, MIN(r.start_time) as start_time, MAX(r.max_reading) as max_reading,
+    SUM(r.mean_reading * r.sample_count) as sum_readings, SUM(r.sample_count) as sample_count
+FROM removed r
+GROUP BY r.survivor
+), merged as
+(
+UPDATE "Active Alerts Acute PurpleAir" a
+SET sensor_indices = a.sensor_indices || s.sensor_indices,
+    start_time = LEAST(a.start_time, r.start_time),
+    max_reading = GREATEST(a.max_reading, r.max_reading),
+    mean_reading = (COALESCE(a.mean_reading, a.max_reading) * a.sample_count + r.sum_readings) / (a.sample_count + r.sample_count),
+    sample_count = a.sample_count + r.sample_count
+FROM sensors s, readings r
+WHERE a.alert_index = s.survivor AND r.survivor = s.survivor
+), moved_users as
+(
+INSERT INTO user_alert (record_id, alert_index, state)
+SELECT ua.record_id, p.survivor, 'active'
+FROM user_alert ua
+INNER JOIN pairs p ON (p.absorbed = ua.alert_index)
+ON CONFLICT DO NOTHING
+)
+DELETE FROM user_alert ua
+USING pairs p
+WHERE ua.alert_index = p.absorbed;
+    ''').format(sql.Literal(absorbed), sql.Literal(survivors))
+
+    psql.send_update(cmd, pg_connection_dict)
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 # Update User's Active Alerts
 
-def Update_users_active_alerts(record_ids, alert_index, pg_connection_dict):
+def Update_users_active_alerts(record_ids, alert_indices, pg_connection_dict):
     '''
-    This function takes a list of record_ids (users), an alert index (integer), and pg_connection_dict
+    This function takes a list of record_ids (users), an equally long list of alert indices (integers), and pg_connection_dict
 
-    It will add this alert index to all the record_ids' active_alerts
+    It will add each alert index as an active alert for the matching record_id in user_alert - all users in one INSERT
     '''
-    
+
     cmd = sql.SQL('''
-UPDATE "Sign Up Information"
-SET active_alerts = ARRAY_APPEND(active_alerts, {}) -- inserted alert_index
-WHERE record_id = ANY ( {} ); -- inserted record_ids 
-    ''').format(sql.Literal(alert_index),
-                sql.Literal(record_ids)
+INSERT INTO user_alert (record_id, alert_index, state)
+SELECT n.record_id, n.alert_index, 'active'
+FROM unnest({}::int[], {}::bigint[]) AS n(record_id, alert_index) -- inserted record_ids/alert_indices
+ON CONFLICT DO NOTHING;
+    ''').format(sql.Literal([int(record_id) for record_id in record_ids]),
+                sql.Literal([int(alert_index) for alert_index in alert_indices])
                )
 
     psql.send_update(cmd, pg_connection_dict)
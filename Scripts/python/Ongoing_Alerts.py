@@ -1,49 +1,177 @@
 ### Import Packages
 
-# Database 
+# Database
 
 import Basic_PSQL as psql
+import Our_Queries as query
 from psycopg2 import sql
 
+# Data Manipulation
+
+import pandas as pd
+
+# Clustering
+
+import Alert_Clusters
+import Sensor_State
+
 ## Workflow
 
-def workflow(ongoing_spikes_df, pg_connection_dict):
+def workflow(ongoing_spikes_df, pg_connection_dict, spikes_df = None):
     '''
-    Runs the full workflow for an ongoing spike
-    
+    Runs the full workflow for the ongoing spikes
+
     Needs ongoing_spikes_df (pd.DataFrame with columns 'sensor_index' int  and 'pm25' float)
+    and spikes_df, every spike this tick - new and ongoing (defaults to ongoing_spikes_df)
+    '''
+
+    # Ongoing Spikes - for all Ongoing alerted sensors together we should..
+
+    # 1) Update the maximum reading, mean reading and sample count (one statement)
+
+    Update_alert_readings(ongoing_spikes_df, pg_connection_dict)
+
+    # 2) Split the alerts whose spiking sensors are no longer one cluster (see Alert_Clusters.py)
+    #    (New_Alerts merges alerts when a new spike connects them - that new spike has to count or the merge is undone right away)
+
+    if spikes_df is None:
+        spikes_df = ongoing_spikes_df
+
+    Split_clusters(spikes_df, pg_connection_dict)
+
+# ~~~~~~~~~~~~~~~~~~~~~
+
+def Split_clusters(spikes_df, pg_connection_dict):
+    '''
+    Splits the active alerts whose spiking sensors are no longer one cluster into new alerts
+    spikes_df should hold every spike this tick (new and ongoing) and run after New_Alerts.workflow
     '''
-    
-    # Ongoing Spikes - for every Ongoing alerted sensor we should..            
 
+    active_sensors_df = query.Get_active_alert_sensors(pg_connection_dict) # in Our_Queries.py
 
-    for _, spike in ongoing_spikes_df.iterrows():
+    spiking_sensors_df = active_sensors_df[active_sensors_df.sensor_index.isin(spikes_df.sensor_index)]
 
-        # 1) Update the maximum reading
+    moving_df = Alert_Clusters.Plan_splits(spiking_sensors_df, pg_connection_dict)
 
-        Update_max_reading(spike, pg_connection_dict)
-        
-        # 2) Merge/Cluster alerts? 
-        # NOT DONE - FAR FUTURE TO DO
+    if len(moving_df) > 0:
+
+        created_df = Split_alerts(moving_df, pg_connection_dict)
+
+        Sensor_State.Set_alerts(created_df.sensor_index.to_list(), created_df.alert_index.to_list()) # If it's in use
 
 # ~~~~~~~~~~~~~~~~~~~~~
 
-def Update_max_reading(row, pg_connection_dict):
+def Update_alert_readings(ongoing_spikes_df, pg_connection_dict):
     '''
-    Row should be a row from the ongoing_spikes dataFrame
+    ongoing_spikes_df should be the ongoing spikes dataFrame
     eg. spikes_df[spikes_df.sensor_index.isin(ongoing_spike_sensors)]
+
+    Sends sensor_index/pm25 as two arrays and updates every affected alert in one statement:
+    max_reading = the highest reading so far
+    sample_count = number of readings so far
+    mean_reading = running mean of those readings
     '''
 
-    sensor_index = row.sensor_index
-    reading = row.pm25
-    
-    cmd = sql.SQL('''
-UPDATE "Active Alerts Acute PurpleAir"
-SET max_reading = GREATEST({}, max_reading)
-WHERE {} = ANY (sensor_indices);
+    sensor_indices = ongoing_spikes_df.sensor_index.astype(int).to_list()
+    readings = ongoing_spikes_df.pm25.astype(float).to_list()
 
-''').format(sql.Literal(reading), sql.Literal(sensor_index))
+    cmd = sql.SQL('''
+WITH readings as -- The newest readings
+(
+SELECT r.sensor_index, r.pm25
+FROM unnest({}::int[], {}::float[]) AS r(sensor_index, pm25)
+), alert_readings as -- Aggregated per alert (alerts may hold several sensors)
+(
+SELECT a.alert_index, MAX(r.pm25) as max_pm25, SUM(r.pm25) as sum_pm25, COUNT(*) as n
+FROM "Active Alerts Acute PurpleAir" a
+CROSS JOIN LATERAL unnest(a.sensor_indices) AS x(sensor_index)
+INNER JOIN readings r ON (r.sensor_index = x.sensor_index)
+WHERE a.sensor_indices && {}::int[] -- Only the alerts touched this tick (GIN indexed)
+GROUP BY a.alert_index
+)
+UPDATE "Active Alerts Acute PurpleAir" a
+SET max_reading = GREATEST(ar.max_pm25, a.max_reading),
+    mean_reading = (COALESCE(a.mean_reading, a.max_reading) * a.sample_count + ar.sum_pm25) / (a.sample_count + ar.n),
+    sample_count = a.sample_count + ar.n
+FROM alert_readings ar
+WHERE a.alert_index = ar.alert_index;
+''').format(sql.Literal(sensor_indices), sql.Literal(readings), sql.Literal(sensor_indices))
 
     psql.send_update(cmd, pg_connection_dict)
-    
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~  
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Split_alerts(moving_df, pg_connection_dict):
+    '''
+    moving_df should be from Alert_Clusters.Plan_splits (columns parent, part, sensor_index)
+
+    Moves every part's sensors out of its parent alert into a new alert in one statement:
+    the new alert keeps the parent's start_time and readings,
+    users near the moved sensors are added to the new alert
+    and users no longer near any of the parent's remaining sensors leave the parent
+
+    returns a pd.DataFrame with columns alert_index, sensor_index of the new alerts
+    '''
+
+    cmd = sql.SQL('''
+WITH moving as
+(
+SELECT m.parent, m.part, m.sensor_index
+FROM unnest({}::bigint[], {}::int[], {}::int[]) AS m(parent, part, sensor_index)
+), parts as
+(
+SELECT parent, part, ARRAY_AGG(sensor_index ORDER BY sensor_index) as sensor_indices
+FROM moving
+GROUP BY parent, part
+), created as -- The new alerts
+(
+INSERT INTO "Active Alerts Acute PurpleAir" (sensor_indices, start_time, max_reading, mean_reading, sample_count)
+SELECT p.sensor_indices, a.start_time, a.max_reading, a.mean_reading, a.sample_count
+FROM parts p
+INNER JOIN "Active Alerts Acute PurpleAir" a ON (a.alert_index = p.parent)
+RETURNING alert_index, sensor_indices
+), created_parts as -- A sensor is only in one part
+(
+SELECT c.alert_index, p.parent, c.sensor_indices
+FROM created c
+INNER JOIN parts p ON (p.sensor_indices[1] = c.sensor_indices[1])
+), remaining as -- What stays in the parents
+(
+SELECT a.alert_index as parent,
+    ARRAY(SELECT x FROM unnest(a.sensor_indices) AS x WHERE x <> ALL (mv.sensor_indices)) as sensor_indices
+FROM "Active Alerts Acute PurpleAir" a
+INNER JOIN (SELECT parent, ARRAY_AGG(sensor_index) as sensor_indices FROM moving GROUP BY parent) mv ON (mv.parent = a.alert_index)
+), shrunk as
+(
+UPDATE "Active Alerts Acute PurpleAir" a
+SET sensor_indices = r.sensor_indices
+FROM remaining r
+WHERE a.alert_index = r.parent
+), moved_users as
+(
+INSERT INTO user_alert (record_id, alert_index, state)
+SELECT DISTINCT ua.record_id, cp.alert_index, 'active'
+FROM created_parts cp
+INNER JOIN user_alert ua ON (ua.alert_index = cp.parent)
+INNER JOIN sensor_subscriber ss ON (ss.record_id = ua.record_id AND ss.sensor_index = ANY (cp.sensor_indices))
+ON CONFLICT DO NOTHING
+), left_users as
+(
+DELETE FROM user_alert ua
+USING remaining r
+WHERE ua.alert_index = r.parent
+    AND NOT EXISTS (SELECT 1 FROM sensor_subscriber ss
+                    WHERE ss.record_id = ua.record_id AND ss.sensor_index = ANY (r.sensor_indices))
+)
+SELECT alert_index, sensor_indices
+FROM created;
+''').format(sql.Literal(moving_df.parent.astype(int).to_list()),
+            sql.Literal(moving_df.part.astype(int).to_list()),
+            sql.Literal(moving_df.sensor_index.astype(int).to_list()))
+
+    response = psql.get_response(cmd, pg_connection_dict)
+
+    created_df = pd.DataFrame([(alert_index, sensor_index) for alert_index, sensors in response for sensor_index in sensors],
+                              columns = ['alert_index', 'sensor_index'])
+
+    return created_df
@@ -0,0 +1,208 @@
+# A local registry of phone numbers that have opted out (texted us a stop word)
+# Kept in the opt_out table and in memory (a set of E.164 numbers), so checking a number is a set lookup
+# Sync() reads only the inbound Twilio messages since the newest one we have read (the high-water mark in opt_out_sync)
+# instead of every recipient's whole history before every send
+
+## Load modules
+
+import os
+import threading # Synced from the send thread(s)
+
+from psycopg2 import sql
+import Basic_PSQL as psql
+
+import Twilio_Functions as our_twilio # The shared Twilio client
+
+# Time
+
+import datetime as dt
+import pytz # Timezones
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+stop_key_words = ['STOP', 'STOPALL', 'UNSUBSCRIBE', 'CANCEL', 'END', 'QUIT'] # see https://support.twilio.com/hc/en-us/articles/223134027-Twilio-support-for-opt-out-keywords-SMS-STOP-filtering-
+
+default_country_code = '1' # For 10 digit numbers (eg. REDCap's '(XXX) XXX-XXXX')
+
+_opted_out = None # Set of E.164 numbers - None until loaded
+_high_water_mark = None # datetime (UTC) of the newest inbound message read - None means we have never read them
+_our_numbers = None # The messaging service's sender numbers - None until looked up
+_lock = threading.Lock()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Normalize(number):
+    '''
+    Turns a phone number (eg. '(612) 555-0100', '612-555-0100', '+16125550100') into E.164 ('+16125550100')
+
+    returns a string (None if there are no digits)
+    '''
+
+    if number is None:
+        return None
+
+    number = str(number).strip()
+    digits = ''.join(c for c in number if c.isdigit())
+
+    if len(digits) == 0:
+        return None
+
+    if number.startswith('+'):
+        return '+' + digits
+
+    if len(digits) == 10:
+        return '+' + default_country_code + digits
+
+    return '+' + digits
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def is_loaded():
+    '''
+    Is the registry in memory?
+    '''
+
+    return _opted_out is not None
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Load(pg_connection_dict):
+    '''
+    Loads the registry and the high-water mark from the database
+    '''
+
+    global _opted_out, _high_water_mark
+
+    cmd = sql.SQL('''SELECT phone
+    FROM opt_out;
+    ''')
+
+    response = psql.get_response(cmd, pg_connection_dict)
+
+    opted_out = set(row[0] for row in response)
+
+    cmd = sql.SQL('''SELECT last_date_sent
+    FROM opt_out_sync;
+    ''')
+
+    response = psql.get_response(cmd, pg_connection_dict)
+
+    _high_water_mark = response[0][0] if len(response) > 0 else None
+    _opted_out = opted_out
+
+    print(len(_opted_out), 'opted out numbers in the registry')
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Get_our_numbers(client):
+    '''
+    The numbers people can reply to - every number in the messaging service's sender pool (TWILIO_SERVICE_SID)
+    and TWILIO_NUMBER. Looked up once
+
+    returns a sorted list of E.164 strings
+    '''
+
+    global _our_numbers
+
+    if _our_numbers is None:
+
+        pool = client.messaging.v1.services(os.environ['TWILIO_SERVICE_SID']).phone_numbers.list()
+
+        _our_numbers = sorted(set([Normalize(number.phone_number) for number in pool] + [Normalize(os.environ['TWILIO_NUMBER'])]))
+
+    return _our_numbers
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Sync(pg_connection_dict):
+    '''
+    Adds the numbers that texted a stop word since the high-water mark to the registry (loading it first if needed)
+    The first sync reads every inbound message, after that only the new ones
+
+    returns the newly opted out numbers (a list of E.164 strings)
+    '''
+
+    global _high_water_mark
+
+    with _lock:
+
+        if _opted_out is None:
+            Load(pg_connection_dict)
+
+        client = our_twilio._get_client()
+
+        # Only messages to our numbers (inbound) - Twilio filters them, so we never page through what we sent
+        # The messaging service can send from (and get STOP replies to) any number in its pool
+
+        inbound = []
+
+        for number in _Get_our_numbers(client):
+
+            if _high_water_mark is None:
+                inbound += client.messages.list(to = number)
+            else:
+                inbound += client.messages.list(to = number, date_sent_after = _high_water_mark) # Inclusive - repeats are ignored
+
+        inbound = [message for message in inbound if message.direction == 'inbound' and message.date_sent is not None]
+
+        if len(inbound) == 0:
+            return []
+
+        stops = [message for message in inbound
+                 if message.body is not None and message.body.strip().upper() in stop_key_words]
+
+        phones = [Normalize(message.from_) for message in stops]
+        times = [message.date_sent.astimezone(pytz.timezone('America/Chicago')).strftime('%Y-%m-%d %H:%M:%S') for message in stops]
+        keywords = [message.body.strip().upper() for message in stops]
+
+        high_water_mark = max(message.date_sent for message in inbound)
+
+        # Add them and move the high-water mark in one statement
+
+        cmd = sql.SQL('''
+        WITH added as
+        (
+        INSERT INTO opt_out (phone, opted_out_at, keyword)
+        SELECT o.phone, o.opted_out_at, o.keyword
+        FROM unnest({}::text[], {}::timestamp[], {}::text[]) AS o(phone, opted_out_at, keyword)
+        WHERE o.phone IS NOT NULL
+        ON CONFLICT DO NOTHING
+        )
+        INSERT INTO opt_out_sync (id, last_date_sent)
+        VALUES (TRUE, {})
+        ON CONFLICT (id) DO UPDATE SET last_date_sent = GREATEST(opt_out_sync.last_date_sent, EXCLUDED.last_date_sent);
+        ''').format(sql.Literal(phones),
+                    sql.Literal(times),
+                    sql.Literal(keywords),
+                    sql.Literal(high_water_mark.isoformat()))
+
+        psql.send_update(cmd, pg_connection_dict)
+
+        new_numbers = sorted(set(phone for phone in phones if phone is not None) - _opted_out)
+
+        _opted_out.update(new_numbers)
+        _high_water_mark = high_water_mark if _high_water_mark is None else max(_high_water_mark, high_water_mark)
+
+    if len(new_numbers) > 0:
+        print(len(new_numbers), 'new opt outs')
+
+    return new_numbers
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def is_opted_out(number):
+    '''
+    Has number (any format) opted out? - a set lookup (call Sync() first to catch new opt outs)
+    '''
+
+    return _opted_out is not None and Normalize(number) in _opted_out
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Check(numbers):
+    '''
+    Returns the indices of the phone numbers in numbers that have opted out
+    (same as our_twilio.check_unsubscriptions, without asking Twilio)
+    '''
+
+    return [i for i, number in enumerate(numbers) if is_opted_out(number)]
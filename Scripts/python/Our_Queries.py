@@ -4,6 +4,7 @@
 
 from psycopg2 import sql
 import Basic_PSQL as psql
+import Spatial_Index # Optional in-memory backend for nearby users
 import pandas as pd
 import pytz
 import datetime as dt
@@ -84,9 +85,7 @@ def Get_extent(pg_connection_dict):
     cmd = sql.SQL('''
     WITH buffer as
 	    (
-	    SELECT ST_BUFFER(ST_Transform(ST_SetSRID(geometry, 4326),
-								      26915),
-					     100) geom -- buff the geometry by 100 meters
+	    SELECT ST_BUFFER(geometry_utm, 100) geom -- buff the projected geometry by 100 meters
 	    FROM "Minneapolis Boundary"
 	    ), bbox as
 	    (
@@ -188,16 +187,41 @@ def Get_previous_active_sensors(pg_connection_dict):
 
 ### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def Get_not_elevated_sensors(pg_connection_dict, alert_lag=20):
+def Get_active_alert_sensors(pg_connection_dict):
+    '''
+    Get every sensor in an active alert
+    Returns a pd.DataFrame with columns alert_index (int), sensor_index (int) - one row per sensor
+    '''
+    
+    cmd = sql.SQL('''SELECT a.alert_index, x.sensor_index
+    FROM "Active Alerts Acute PurpleAir" a
+    CROSS JOIN LATERAL unnest(a.sensor_indices) AS x(sensor_index);
+    ''')
+    
+    response = psql.get_response(cmd, pg_connection_dict)
+    
+    active_sensors_df = pd.DataFrame(response, columns = ['alert_index', 'sensor_index'])
+    
+    return active_sensors_df
+
+### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Get_not_elevated_sensors(pg_connection_dict, alert_lag=20, now=None):
     '''
     Get sensor_indices from database where the sensor has not been elevated in 30 minutes
+    now = optional datetime to compare against (eg. the replay clock), defaults to the database's current time
     Returns sensor_indices
     '''
     
+    if now is None:
+        current_time = sql.SQL("CURRENT_TIMESTAMP AT TIME ZONE 'America/Chicago'")
+    else:
+        current_time = sql.SQL('{}::timestamp').format(sql.Literal(now.strftime('%Y-%m-%d %H:%M:%S')))
+    
     cmd = sql.SQL(f'''SELECT sensor_index 
     FROM "PurpleAir Stations"
-    WHERE last_elevated + INTERVAL '{alert_lag} Minutes' < CURRENT_TIMESTAMP AT TIME ZONE 'America/Chicago';
-    ''')
+    WHERE last_elevated + INTERVAL '{alert_lag} Minutes' < {{}};
+    ''').format(current_time)
     
     response = psql.get_response(cmd, pg_connection_dict)   
     # Convert response into dataframe
@@ -217,22 +241,16 @@ def Get_active_users_nearby_sensor(pg_connection_dict, sensor_index, distance=10
     This function will return a list of record_ids from "Sign Up Information" that are within the distance from the sensor and subscribed
     
     sensor_index = integer
-    distance = integer (in meters)
+    distance = integer (in meters) - no larger than Sensor_Subscriber.subscriber_radius
     
     returns record_ids (a list)
     '''
 
     cmd = sql.SQL('''
-    WITH sensor as -- query for the desired sensor
-    (
-    SELECT sensor_index, geometry
-    FROM "PurpleAir Stations"
-    WHERE sensor_index = {}
-    )
-    SELECT record_id
-    FROM "Sign Up Information" u, sensor s
-    WHERE u.subscribed = TRUE AND ST_DWithin(ST_Transform(u.geometry,26915), -- query for users within the distance from the sensor
-										    ST_Transform(s.geometry, 26915),{}); 
+    SELECT u.record_id
+    FROM sensor_subscriber ss -- precomputed users nearby each sensor (see Sensor_Subscriber.py)
+    INNER JOIN "Sign Up Information" u ON (u.record_id = ss.record_id)
+    WHERE ss.sensor_index = {} AND ss.distance_m <= {} AND u.subscribed = TRUE;
     ''').format(sql.Literal(sensor_index),
                 sql.Literal(distance))
 
@@ -244,10 +262,58 @@ def Get_active_users_nearby_sensor(pg_connection_dict, sensor_index, distance=10
 
 # ~~~~~~~~~~~~~~
 
+def Get_active_users_nearby_sensors(pg_connection_dict, sensor_indices, distance=1000):
+    '''
+    This function finds the subscribed users in "Sign Up Information" within the distance of each sensor - all sensors in one join
+    If Spatial_Index is loaded the distances are answered in memory and only the alert status comes from the database
+    
+    sensor_indices = list of integers
+    distance = integer (in meters) - no larger than Sensor_Subscriber.subscriber_radius
+    
+    returns a pd.DataFrame with columns sensor_index (int), record_id (int) and no_alerts (bool - the user has no active or cached alerts in user_alert)
+    '''
+    
+    if Spatial_Index.is_loaded():
+        
+        pairs_df = Spatial_Index.Users_nearby_sensors(sensor_indices, distance)
+        
+        if len(pairs_df) == 0:
+            return pd.DataFrame(columns = ['sensor_index', 'record_id', 'no_alerts'])
+        
+        cmd = sql.SQL('''
+        SELECT u.record_id, NOT EXISTS (SELECT 1 FROM user_alert ua WHERE ua.record_id = u.record_id) as no_alerts
+        FROM "Sign Up Information" u
+        WHERE u.record_id = ANY ( {} ) AND u.subscribed = TRUE;
+        ''').format(sql.Literal([int(record_id) for record_id in pairs_df.record_id.unique()]))
+        
+        response = psql.get_response(cmd, pg_connection_dict)
+        
+        status_df = pd.DataFrame(response, columns = ['record_id', 'no_alerts'])
+        
+        nearby_df = pairs_df.merge(status_df, on = 'record_id') # Drops anyone unsubscribed
+        
+        return nearby_df
+
+    cmd = sql.SQL('''
+    SELECT ss.sensor_index, u.record_id, NOT EXISTS (SELECT 1 FROM user_alert ua WHERE ua.record_id = u.record_id) as no_alerts
+    FROM sensor_subscriber ss -- precomputed users nearby each sensor (see Sensor_Subscriber.py)
+    INNER JOIN "Sign Up Information" u ON (u.record_id = ss.record_id)
+    WHERE ss.sensor_index = ANY ( {} ) AND ss.distance_m <= {} AND u.subscribed = TRUE;
+    ''').format(sql.Literal([int(sensor_index) for sensor_index in sensor_indices]),
+                sql.Literal(distance))
+
+    response = psql.get_response(cmd, pg_connection_dict)
+
+    nearby_df = pd.DataFrame(response, columns = ['sensor_index', 'record_id', 'no_alerts']) # Unpack results into dataframe
+
+    return nearby_df
+
+# ~~~~~~~~~~~~~~
+
 
 def Get_users_to_message_new_alert(pg_connection_dict, record_ids):
     '''
-    This function will return a list of record_ids from "Sign Up Information" that have empty active and cached alerts and are in the list or record_ids given
+    This function will return a list of record_ids from "Sign Up Information" that have no active or cached alerts and are in the list or record_ids given
     
     record_ids = a list of ids to check
     
@@ -255,10 +321,11 @@ def Get_users_to_message_new_alert(pg_connection_dict, record_ids):
     '''
 
     cmd = sql.SQL('''
-    SELECT record_id
-    FROM "Sign Up Information"
-    WHERE active_alerts = {} AND cached_alerts = {} AND record_id = ANY ( {} );
-    ''').format(sql.Literal('{}'), sql.Literal('{}'), sql.Literal(record_ids))
+    SELECT u.record_id
+    FROM "Sign Up Information" u
+    WHERE u.record_id = ANY ( {} )
+        AND NOT EXISTS (SELECT 1 FROM user_alert ua WHERE ua.record_id = u.record_id); -- anti-join
+    ''').format(sql.Literal(record_ids))
 
     response = psql.get_response(cmd, pg_connection_dict)
 
@@ -274,7 +341,7 @@ def Get_users_to_message_new_alert(pg_connection_dict, record_ids):
 
 def Get_users_to_message_end_alert(pg_connection_dict, ended_alert_indices):
     '''
-    This function will return a list of record_ids from "Sign Up Information" that are subscribed, have empty active_alerts, non-empty cached_alerts
+    This function will return a list of record_ids from "Sign Up Information" that are subscribed, have no active alerts and some cached alerts
     
     ended_alert_indices = a list of alert_ids that just ended
     
@@ -282,12 +349,12 @@ def Get_users_to_message_end_alert(pg_connection_dict, ended_alert_indices):
     '''
 
     cmd = sql.SQL('''
-    SELECT record_id
-    FROM "Sign Up Information"
-    WHERE subscribed = TRUE
-        AND active_alerts = {}
-    	AND ARRAY_LENGTH(cached_alerts, 1) > 0;
-    ''').format(sql.Literal('{}'))
+    SELECT DISTINCT c.record_id
+    FROM user_alert c
+    INNER JOIN "Sign Up Information" u ON (u.record_id = c.record_id)
+    WHERE c.state = 'cached' AND u.subscribed = TRUE
+        AND NOT EXISTS (SELECT 1 FROM user_alert a WHERE a.record_id = c.record_id AND a.state = 'active'); -- anti-join
+    ''')
 
     response = psql.get_response(cmd, pg_connection_dict)
 
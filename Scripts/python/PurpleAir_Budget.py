@@ -0,0 +1,186 @@
+# PurpleAir API point budget
+# Estimates what our calls cost, keeps a daily ledger in the database (api_usage)
+# and widens the polling interval so we stay within daily_budget/monthly_budget (set from PURPLEAIR_DAILY_POINTS/PURPLEAIR_MONTHLY_POINTS in MAIN.py)
+
+## Load modules
+
+import calendar # Days in the month
+from collections import deque # Recent ticks
+
+from psycopg2 import sql
+import Basic_PSQL as psql
+
+import PurpleAir_Functions as purp
+
+# Time
+
+import datetime as dt
+import pytz # Timezones
+
+# ~~~~~~~~~~~~~~
+
+## Point model
+
+# PurpleAir charges points per field per sensor returned, plus a little per call
+# Set field_points to match your account's pricing if some fields cost more
+
+call_points = 1 # per call
+default_field_points = 1 # per field per sensor (row)
+field_points = {'sensor_index': 0} # Overrides - sensor_index always comes back
+
+# Budgets (points) - None means unlimited
+
+daily_budget = None
+monthly_budget = None
+
+# Recent history for the burn rate/interval - (datetime, points) per tick
+
+_ticks = deque(maxlen = 144)
+
+# ~~~~~~~~~~~~~~
+
+def Estimate_points(fields, sensor_count, calls = 1):
+    '''
+    Estimates the points a query for fields (a list of strings) returning sensor_count rows costs
+
+    returns an integer
+    '''
+
+    row_points = sum(field_points.get(field, default_field_points) for field in fields)
+
+    return calls * call_points + sensor_count * row_points
+
+# ~~~~~~~~~~~~~~
+
+def Record_calls(pg_connection_dict, timezone = 'America/Chicago'):
+    '''
+    Drains purp.api_call_log, estimates the points those calls cost and adds them to today's row of api_usage
+
+    returns the points recorded (an integer)
+    '''
+
+    calls = 0
+    rows = 0
+    points = 0
+
+    while len(purp.api_call_log) > 0:
+
+        entry = purp.api_call_log.popleft()
+
+        calls += 1
+
+        if entry['status_code'] == 200: # Only successful calls cost points
+            rows += entry['rows']
+            points += Estimate_points(entry['fields'], entry['rows'])
+
+    now = dt.datetime.now(pytz.timezone(timezone))
+
+    _ticks.append((now, points))
+
+    if calls > 0:
+
+        cmd = sql.SQL('''INSERT INTO api_usage (day, calls, rows, points)
+        VALUES ({}, {}, {}, {})
+        ON CONFLICT (day) DO UPDATE
+        SET calls = api_usage.calls + EXCLUDED.calls,
+            rows = api_usage.rows + EXCLUDED.rows,
+            points = api_usage.points + EXCLUDED.points;
+        ''').format(sql.Literal(now.strftime('%Y-%m-%d')),
+                    sql.Literal(calls),
+                    sql.Literal(rows),
+                    sql.Literal(points))
+
+        psql.send_update(cmd, pg_connection_dict)
+
+    return points
+
+# ~~~~~~~~~~~~~~
+
+def Get_usage(pg_connection_dict, timezone = 'America/Chicago'):
+    '''
+    Gets the points used so far today and this month from api_usage
+
+    returns a dictionary with keys day, month (integers)
+    '''
+
+    today = dt.datetime.now(pytz.timezone(timezone)).date()
+
+    cmd = sql.SQL('''SELECT COALESCE(SUM(points) FILTER (WHERE day = {}), 0),
+        COALESCE(SUM(points), 0)
+    FROM api_usage
+    WHERE day >= {};
+    ''').format(sql.Literal(today.strftime('%Y-%m-%d')),
+                sql.Literal(today.replace(day = 1).strftime('%Y-%m-%d')))
+
+    response = psql.get_response(cmd, pg_connection_dict)
+
+    return {'day': int(response[0][0]), 'month': int(response[0][1])}
+
+# ~~~~~~~~~~~~~~
+
+def Burn_rate(hours = 1, timezone = 'America/Chicago'):
+    '''
+    The points per hour we've spent over the last hours (from the ticks recorded this run)
+
+    returns a float
+    '''
+
+    now = dt.datetime.now(pytz.timezone(timezone))
+    since = now - dt.timedelta(hours = hours)
+
+    if len(_ticks) == 0:
+        return 0.0
+
+    # If we haven't been running for hours yet, use how long we have been running
+    span_hours = min(hours, max((now - _ticks[0][0]).total_seconds() / 3600, 1/60))
+
+    return sum(points for time, points in _ticks if time >= since) / span_hours
+
+# ~~~~~~~~~~~~~~
+
+def Polling_interval(timestep, pg_connection_dict, timezone = 'America/Chicago'):
+    '''
+    Returns the minutes to wait before the next tick - timestep (minutes) unless that would overspend a budget,
+    then as long as it takes to spread the remaining points over the rest of the day/month
+    (until the budget resets if it's spent)
+    '''
+
+    if (daily_budget is None and monthly_budget is None) or len(_ticks) == 0:
+        return timestep
+
+    # Typical points per tick - the median ignores the odd daily update
+
+    tick_points = sorted(points for time, points in _ticks)[len(_ticks) // 2]
+
+    if tick_points == 0:
+        return timestep
+
+    usage = Get_usage(pg_connection_dict, timezone)
+
+    now = dt.datetime.now(pytz.timezone(timezone))
+    end_of_day = (now + dt.timedelta(days = 1)).replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+    end_of_month = (now.replace(day = calendar.monthrange(now.year, now.month)[1]) + dt.timedelta(days = 1)
+                   ).replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+
+    interval = timestep
+
+    for budget, used, end in [(daily_budget, usage['day'], end_of_day),
+                              (monthly_budget, usage['month'], end_of_month)]:
+
+        if budget is None:
+            continue
+
+        minutes_left = (end - now).total_seconds() / 60
+        ticks_left = (budget - used) // tick_points # Ticks we can still afford
+
+        if ticks_left <= 0: # Spent - wait for the reset
+            needed = minutes_left
+        else:
+            needed = minutes_left / ticks_left
+
+        interval = max(interval, needed)
+
+    if interval > timestep:
+        print(f'PurpleAir budget - polling every {interval:.1f} minutes ({usage["day"]} points today, {usage["month"]} this month)')
+
+    return interval
@@ -3,6 +3,15 @@
 ## Load modules
 
 import requests
+import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading # The session is shared between threads
+import time # For timing calls
+from collections import deque # Recent call log
+from concurrent.futures import ThreadPoolExecutor # Concurrent chunks
+
+import PurpleAir_Replay # Recording/replaying responses
 
 # Time
 
@@ -14,70 +23,426 @@ import pytz # Timezones
 import numpy as np
 import pandas as pd
 
+# A faster JSON parser if it's installed
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# ~~~~~~~~~~~~~~
+
+## Response Decoding
+
+# PurpleAir sends rows of mixed types - we build one typed array per column instead
+# Fields not listed here are kept as python objects (eg. name)
+
+int_fields = ['sensor_index', 'channel_flags', 'channel_state', 'position_rating', 'altitude'] # int32
+datetime_fields = ['last_seen', 'date_created', 'last_modified'] # UNIX seconds -> datetime in our timezone
+float_prefixes = ['pm', 'humidity', 'temperature', 'pressure', 'latitude', 'longitude', 'confidence'] # float32 (latitude/longitude float64)
+
+# ~~~~~~~~~~~~~~
+
+## HTTP Session
+
+# One keep-alive session for the life of the process (so we don't pay for a new TLS handshake every call)
+# 429/5xx responses and connection errors are retried with exponential backoff (honoring Retry-After)
+
+base_url = 'https://api.purpleair.com/v1/sensors'
+
+timeout = (5, 30) # seconds - (connect, read)
+max_retries = 3 # How many times will we retry a call?
+backoff_seconds = 1 # Initial wait between retries, doubles every attempt
+retry_statuses = (429, 500, 502, 503, 504)
+
+api_call_log = deque(maxlen = 1000) # Recent calls - dictionaries of time, url, fields, status_code, seconds, bytes, rows
+
+_session = None
+_session_lock = threading.Lock()
+
+# ~~~~~~~~~~~~~~
+
+## Fetch Planning
+
+# Long sensor lists are split into chunks (show_only= is limited by URL length) that are fetched concurrently
+# If a bounding box query is cheaper (see Plan_fetch) we query the box instead and keep only our sensors
+
+max_sensors_per_call = 500 # sensor_ids per show_only= query
+max_query_length = 6000 # characters - keep well under common URL length limits
+max_workers = 4 # concurrent calls
+call_overhead_rows = 50 # rows - rough fixed cost of an extra call (headers, handshake, points) in "rows" of data
+
+_bounds_info = None # Dictionary of bounds (nwlng, selat, selng, nwlat) and sensor_count - set by Set_bounds_info()
+
+# ~~~~~~~~~~~~~~
+
+def _get_session():
+    '''
+    Returns the shared requests.Session, creating it on first use
+    '''
+
+    global _session
+
+    with _session_lock:
+
+        if _session is None:
+
+            retry = Retry(total = max_retries,
+                          backoff_factor = backoff_seconds,
+                          status_forcelist = retry_statuses,
+                          allowed_methods = ['GET'],
+                          respect_retry_after_header = True,
+                          raise_on_status = False # Return the last response instead of raising
+                         )
+
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(max_retries = retry, pool_connections = 4, pool_maxsize = 8))
+            session.headers.update({'Accept-Encoding': 'gzip, deflate'}) # Compressed responses
+
+            _session = session
+
+        return _session
+
+# ~~~~~~~~~~~~~~
+
+def close_session():
+    '''
+    Closes the shared session (at shutdown)
+    '''
+
+    global _session
+
+    with _session_lock:
+
+        if _session is not None:
+            _session.close()
+            _session = None
+
+# ~~~~~~~~~~~~~~
 
 # Function to get Sensors Data from PurpleAir
 
 def getSensorsData(query='', api_read_key=''):
+    '''
+    Sends a GET to the PurpleAir sensors endpoint with the query string over the shared session
+
+    Returns the requests.Response
+    Raises requests.RequestException if the call fails after all retries (timeouts, connection errors)
+    '''
 
     # my_url is assigned the URL we are going to send our request to.
-    url = 'https://api.purpleair.com/v1/sensors?' + query
+    url = base_url + '?' + query
 
     # my_headers is assigned the context of our request we want to make. In this case
     # we will pass through our API read key using the variable created above.
     my_headers = {'X-API-Key':api_read_key}
 
-    # This line creates and sends the request and then assigns its response to the
-    # variable, r.
-    response = requests.get(url, headers=my_headers)
+    # Replaying a recording? (see PurpleAir_Replay.py) - nothing is sent or logged
+
+    if PurpleAir_Replay.is_replaying():
+
+        response = requests.Response()
+        response.status_code, response._content = PurpleAir_Replay.Replay_response(query)
+        response.url = url
+
+        return response
+
+    # The fields we asked for (for the API point budget - see PurpleAir_Budget.py)
+    fields = [p[len('fields='):].split('%2C') for p in query.split('&') if p.startswith('fields=')]
+    fields = fields[0] if len(fields) > 0 else []
+
+    # This line sends the request and then assigns its response to the variable, response.
+    start = time.perf_counter()
+
+    try:
+        response = _get_session().get(url, headers=my_headers, timeout=timeout)
+
+    except requests.RequestException:
+        api_call_log.append({'time': dt.datetime.now(dt.timezone.utc), 'url': url, 'fields': fields, 'status_code': None,
+                             'seconds': time.perf_counter() - start, 'bytes': 0, 'rows': 0})
+        raise
+
+    entry = {'time': dt.datetime.now(dt.timezone.utc), 'url': url, 'fields': fields, 'status_code': response.status_code,
+             'seconds': time.perf_counter() - start, 'bytes': len(response.content), 'rows': 0}
+    api_call_log.append(entry)
+
+    response.call_log_entry = entry # So the caller can fill in the number of rows once it's decoded
+
+    if PurpleAir_Replay.is_recording():
+        PurpleAir_Replay.Record(query, response.status_code, response.content, PurpleAir_Replay.Now())
 
     # We then return the response we received.
     return response
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Column_to_array(field, values, timezone):
+    '''
+    Turns one column of values (a list) from a PurpleAir response into a typed array (see int_fields etc.)
+    '''
+
+    if field in int_fields:
+        if any(value is None for value in values):
+            return pd.array(values, dtype = 'Int32') # Nullable
+        return np.array(values, dtype = np.int32)
+
+    if field in datetime_fields:
+        seconds = np.array(values, dtype = np.float64) # None -> NaN -> NaT
+        return pd.to_datetime(seconds, utc = True, unit = 's').tz_convert(timezone)
+
+    if field in ['latitude', 'longitude']:
+        return np.array(values, dtype = np.float64) # float32 would cost us meters
+
+    if any(field.startswith(prefix) for prefix in float_prefixes):
+        return np.array(values, dtype = np.float32) # None -> NaN
+
+    return np.array(values, dtype = object)
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Decode_response(content, timezone = 'America/Chicago'):
+    '''
+    Decodes the body (bytes) of a PurpleAir sensors response into a pd.DataFrame with one typed column per field
+    (int32 ids/flags, float32 readings, timezone aware datetimes) - no re-casting needed downstream
+    '''
+
+    response_dict = _json_loads(content)
+
+    col_names = response_dict['fields']
+    data = response_dict['data']
+
+    columns = {}
+
+    for i, field in enumerate(col_names):
+        columns[field] = _Column_to_array(field, [row[i] for row in data], timezone)
+
+    return pd.DataFrame(columns, columns = col_names)
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Response_to_df(query_string, purpleAir_api, timezone):
+    '''
+    Calls the api with query_string and unpacks the response
+
+    returns df (pd.DataFrame with the fields typed by Decode_response - no columns if the call failed,
+                columns but no rows if nothing matched)
+    and runtime (datetime object when query was run)
+    '''
+
+    try:
+        response = getSensorsData(query_string, purpleAir_api) # The response is a requests.response object
+        runtime = PurpleAir_Replay.Now(timezone) # When we call - datetime in our timezone (recorded time if replaying)
+
+    except requests.RequestException as e:
+        runtime = PurpleAir_Replay.Now(timezone)
+        print('ERROR in PurpleAir API Call')
+        print(e)
+
+        return pd.DataFrame(), runtime
+
+    if response.status_code != 200:
+        print('ERROR in PurpleAir API Call')
+        print('HTTP Status: ' + str(response.status_code))
+        print(response.text)
+
+        df = pd.DataFrame()
+
+    else:
+        df = Decode_response(response.content, timezone) # Typed columns (empty if nothing matched, eg. nothing modified_since)
+
+        if hasattr(response, 'call_log_entry'):
+            response.call_log_entry['rows'] = len(df)
+
+    return df, runtime
     
 #### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Set_bounds_info(nwlng, selat, selng, nwlat, sensor_count):
+    '''
+    Remembers our project's bounding box and how many sensors PurpleAir returned for it
+    (from Daily_Updates.Get_PurpleAir) so Plan_fetch can compare a bounds query against a sensor list query
+    '''
+
+    global _bounds_info
+
+    _bounds_info = {'bounds': (nwlng, selat, selng, nwlat),
+                    'sensor_count': int(sensor_count)
+                   }
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Chunk_sensor_ids(sensor_ids, fields_string):
+    '''
+    Splits sensor_ids (a list of integers) into chunks of at most max_sensors_per_call
+    whose query strings stay under max_query_length
+
+    returns a list of lists of sensor_ids
+    '''
+
+    chunks = []
+    chunk = []
+    length = len(fields_string) + len('&show_only=')
+
+    for sensor_id in sensor_ids:
+
+        id_length = len(str(sensor_id)) + 3 # + '%2C'
+
+        if len(chunk) > 0 and (len(chunk) >= max_sensors_per_call or length + id_length > max_query_length):
+            chunks += [chunk]
+            chunk = []
+            length = len(fields_string) + len('&show_only=')
+
+        chunk += [sensor_id]
+        length += id_length
+
+    if len(chunk) > 0:
+        chunks += [chunk]
+
+    return chunks
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Plan_fetch(sensor_ids, fields):
+    '''
+    Decides how to fetch sensor_ids (a list of integers) with the given fields
+
+    The cost of a plan is rows returned * (fields + 1) + calls * call_overhead_rows
+    (PurpleAir charges points per row/field and every call costs a round trip)
+
+    returns a dictionary with keys
+        'method' - 'bounds' or 'sensors'
+        'chunks' - a list of lists of sensor_ids (for 'sensors')
+        'bounds' - (nwlng, selat, selng, nwlat) (for 'bounds')
+    '''
+
+    fields_string = 'fields=' + '%2C'.join(fields)
+
+    chunks = _Chunk_sensor_ids(sensor_ids, fields_string)
+
+    plan = {'method': 'sensors', 'chunks': chunks, 'bounds': None}
+
+    if _bounds_info is not None and len(sensor_ids) > 0:
+
+        row_cost = len(fields) + 1
+        sensors_cost = len(sensor_ids) * row_cost + len(chunks) * call_overhead_rows
+        bounds_cost = _bounds_info['sensor_count'] * row_cost + call_overhead_rows
+
+        if bounds_cost < sensors_cost:
+            plan = {'method': 'bounds', 'chunks': [], 'bounds': _bounds_info['bounds']}
+
+    return plan
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Sensors_query_strings(chunks, fields, modified_since = None):
+    '''
+    One show_only= query string per chunk of sensor_ids (from Plan_fetch)
+    '''
+
+    fields_string = 'fields=' + '%2C'.join(fields)
+
+    if modified_since is not None:
+        fields_string += f'&modified_since={int(modified_since)}'
+
+    query_strings = ['&'.join([fields_string, 'show_only=' + '%2C'.join([str(sensor_id) for sensor_id in chunk])])
+                     for chunk in chunks]
+
+    return query_strings
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Bounds_query_string(fields, nwlng, selat, selng, nwlat, modified_since = None):
+    '''
+    The query string for every sensor in the bounding box
+    '''
+
+    # Bounding string
+    bounds_strings = [f'nwlng={nwlng}',
+                      f'nwlat={nwlat}',
+                      f'selng={selng}',
+                      f'selat={selat}']
+    bounds_string = '&'.join(bounds_strings)  
+    # Field string
+    fields_string = 'fields=' + '%2C'.join(fields)
+
+    query_string = '&'.join([fields_string, bounds_string])
+
+    if modified_since is not None:
+        query_string += f'&modified_since={int(modified_since)}'
+
+    return query_string
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     
 ### The Function to get a dataframe from purpleair for select sensor_ids
 
-def Get_PurpleAir_df_sensors(purpleAir_api, sensor_ids, fields, timezone = 'America/Chicago'):
+def Get_PurpleAir_df_sensors(purpleAir_api, sensor_ids, fields, timezone = 'America/Chicago', modified_since = None):
     
     ''' This function queries the PurpleAir API for sensors in the list of sensor_ids for readings over a spike threshold. 
     It will return an unformatted pandas dataframe with the specified fields as well as a runtime (datetime)
+    Long lists are split into chunks fetched concurrently (or one bounds query if cheaper) - see Plan_fetch
     
     Inputs:
     
     api = string of PurpleAir API api_read_key
     sensor_ids = list of integers of purpleair sensor ids to query
     fields - list of strings that line up with PurpleAir api
+    modified_since = optional unix timestamp (int) - only return sensors modified since then
     
     Outputs:
     
-    df = Pandas DataFrame with fields (datatypes not formatted!)
+    df = Pandas DataFrame with fields (typed - see Decode_response) - no columns if it failed
+         (with modified_since, if any chunk failed)
     runtime = datetime object when query was run
     '''
     
+    ### Plan the calls (see Plan_fetch)
+
+    sensor_ids = [int(sensor_id) for sensor_id in sensor_ids]
+
+    plan = Plan_fetch(sensor_ids, fields)
+
+    if plan['method'] == 'bounds':
+
+        nwlng, selat, selng, nwlat = plan['bounds']
+
+        df, runtime = Get_PurpleAir_df_bounds(fields, nwlng, selat, selng, nwlat, purpleAir_api, timezone, modified_since)
+
+        if len(df) > 0: # Keep only the sensors we asked for
+            df = df[df.sensor_index.isin(sensor_ids)].reset_index(drop=True)
+
+        return df, runtime
+
     ### Setting parameters for API
-    fields_string = 'fields=' + '%2C'.join(fields)
-    sensor_string = 'show_only=' + '%2C'.join(pd.Series(sensor_ids).astype(str))
+    query_strings = _Sensors_query_strings(plan['chunks'], fields, modified_since)
+
+    ### Call the api - chunks concurrently on a bounded thread pool
+
+    if len(query_strings) == 0: # Nothing to ask for
+
+        df, runtime = pd.DataFrame(), PurpleAir_Replay.Now(timezone)
+
+    elif len(query_strings) == 1:
+
+        df, runtime = _Response_to_df(query_strings[0], purpleAir_api, timezone)
 
-    query_string = '&'.join([fields_string, sensor_string])
-    
-    ### Call the api
-    
-    response = getSensorsData(query_string, purpleAir_api) # The response is a requests.response object
-    runtime = dt.datetime.now(pytz.timezone(timezone)) # When we call - datetime in our timezone
-    
-    if response.status_code != 200:
-        print('ERROR in PurpleAir API Call')
-        print('HTTP Status: ' + str(response.status_code))
-        print(response.text)
-        
-        df = pd.DataFrame()
-        
     else:
-        response_dict = response.json() # Read response as a json (dictionary)
-        col_names = response_dict['fields']
-        data = np.array(response_dict['data'])
 
-        df = pd.DataFrame(data, columns = col_names) # Format as Pandas dataframe
+        with ThreadPoolExecutor(max_workers = min(max_workers, len(query_strings))) as executor:
+            results = list(executor.map(lambda query_string: _Response_to_df(query_string, purpleAir_api, timezone),
+                                        query_strings))
+
+        dfs = [chunk_df for chunk_df, chunk_runtime in results if len(chunk_df.columns) > 0] # No columns = failed
+
+        if len(dfs) < len(results):
+            print(f'{len(results) - len(dfs)} of {len(results)} PurpleAir chunks failed')
+
+        if len(dfs) < len(results) and modified_since is not None:
+            df = pd.DataFrame() # A partial delta would move the caller's modified_since past the failed chunks' sensors - fail it all
+        else:
+            df = pd.concat(dfs, ignore_index = True) if len(dfs) > 0 else pd.DataFrame()
+        runtime = max(chunk_runtime for chunk_df, chunk_runtime in results) # One runtime - when the last chunk came back
             
     return df, runtime
     
@@ -85,7 +450,7 @@ def Get_PurpleAir_df_sensors(purpleAir_api, sensor_ids, fields, timezone = 'Amer
    
 ### The Function to get a dataframe from purpleair for select sensor_ids
 
-def Get_PurpleAir_df_bounds(fields, nwlng, selat, selng, nwlat, purpleAir_api, timezone = 'America/Chicago'):
+def Get_PurpleAir_df_bounds(fields, nwlng, selat, selng, nwlat, purpleAir_api, timezone = 'America/Chicago', modified_since = None):
     
     '''
     This function gets Purple Air data for all sensors in the given boundary
@@ -99,41 +464,18 @@ def Get_PurpleAir_df_bounds(fields, nwlng, selat, selng, nwlat, purpleAir_api, t
     fields - list of strings that line up with PurpleAir api    
     purpleAir_api = string of PurpleAir API api_read_key
     nwlng, selat, selng, nwlat = the bounding box in lat/lons
+    modified_since = optional unix timestamp (int) - only return sensors modified since then
     
     Outputs:
     
-    df = Pandas DataFrame with fields (datatypes not formatted!)
+    df = Pandas DataFrame with fields (typed - see Decode_response)
     runtime = datetime object when query was run
     '''
     
-    # Bounding string
-    bounds_strings = [f'nwlng={nwlng}',
-                      f'nwlat={nwlat}',
-                      f'selng={selng}',
-                      f'selat={selat}']
-    bounds_string = '&'.join(bounds_strings)  
-    # Field string
-    fields_string = 'fields=' + '%2C'.join(fields)
-
-    query_string = '&'.join([fields_string, bounds_string])
+    query_string = _Bounds_query_string(fields, nwlng, selat, selng, nwlat, modified_since)
     
     ### Call the api
     
-    response = getSensorsData(query_string, purpleAir_api) # The response is a requests.response object
-    runtime = dt.datetime.now(pytz.timezone(timezone)) # When we call - datetime in our timezone
-    
-    if response.status_code != 200:
-        print('ERROR in PurpleAir API Call')
-        print('HTTP Status: ' + str(response.status_code))
-        print(response.text)
-        
-        df = pd.DataFrame()
-        
-    else:
-        response_dict = response.json() # Read response as a json (dictionary)
-        col_names = response_dict['fields']
-        data = np.array(response_dict['data'])
-
-        df = pd.DataFrame(data, columns = col_names) # Format as Pandas dataframe
+    df, runtime = _Response_to_df(query_string, purpleAir_api, timezone)
             
     return df, runtime
@@ -0,0 +1,193 @@
+# Record and replay PurpleAir responses
+# Recording - every raw response (with its runtime) is appended to a gzipped JSON lines file per day
+# Replay - PurpleAir_Functions.getSensorsData is answered from a recording and the clock follows the recorded runtimes
+#          so a captured day can be re-run through MAIN.py offline, deterministically and faster than real time
+# Turn them on with PURPLEAIR_RECORD_DIR/PURPLEAIR_REPLAY in the .env file (see MAIN.py)
+
+## Load modules
+
+import os # Files
+import glob # Finding recordings
+import gzip # Compressed recordings
+import json
+import threading # Chunks are fetched concurrently
+import time # For Sleeping
+
+# Time
+
+import datetime as dt
+import pytz # Timezones
+
+# ~~~~~~~~~~~~~~
+
+_record_directory = None # Where recordings are written (None = not recording)
+_record_lock = threading.Lock()
+
+_replay = None # Dictionary of entries (list of dictionaries), used (list of bools), speed (float or None)
+_replay_lock = threading.Lock()
+
+_clock = None # The replay clock (datetime) - None unless replaying
+
+# ~~~~~~~~~~~~~~
+
+def _Query_key(query):
+    '''
+    What a query is matched on during replay - everything but modified_since (which depends on when we polled)
+    '''
+
+    return '&'.join(p for p in query.split('&') if not p.startswith('modified_since='))
+
+# ~~~~~~~~~~~~~~
+
+def Start_recording(directory):
+    '''
+    Start writing every PurpleAir response to directory (created if needed)
+    '''
+
+    global _record_directory
+
+    os.makedirs(directory, exist_ok = True)
+
+    _record_directory = directory
+
+# ~~~~~~~~~~~~~~
+
+def is_recording():
+    '''
+    Are we recording responses?
+    '''
+
+    return _record_directory is not None
+
+# ~~~~~~~~~~~~~~
+
+def Record(query, status_code, content, runtime):
+    '''
+    Appends one response (query string, status code, body as bytes, runtime as a timezone aware datetime)
+    to today's recording - purpleair_YYYYMMDD.jsonl.gz
+    '''
+
+    if _record_directory is None:
+        return
+
+    line = json.dumps({'runtime': runtime.isoformat(),
+                       'query': query,
+                       'status_code': status_code,
+                       'body': content.decode('utf-8')
+                      }) + '\n'
+
+    path = os.path.join(_record_directory, f'purpleair_{runtime.strftime("%Y%m%d")}.jsonl.gz')
+
+    with _record_lock:
+        with gzip.open(path, 'at', encoding = 'utf-8') as f: # Appending adds a gzip member - still one readable file
+            f.write(line)
+
+# ~~~~~~~~~~~~~~
+
+def Load_replay(path, speed = None):
+    '''
+    Loads a recording - a .jsonl.gz file or a directory of them (read in name order)
+    speed = how many times faster than real time to sleep (eg. 60), None = don't sleep at all
+    '''
+
+    global _replay, _clock
+
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, '*.jsonl.gz')))
+    else:
+        paths = [path]
+
+    entries = []
+
+    for p in paths:
+        with gzip.open(p, 'rt', encoding = 'utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                entry['runtime'] = dt.datetime.fromisoformat(entry['runtime'])
+                entry['key'] = _Query_key(entry['query'])
+                entries += [entry]
+
+    _replay = {'entries': entries,
+               'used': [False] * len(entries),
+               'speed': speed
+              }
+
+    if len(entries) > 0:
+        _clock = entries[0]['runtime']
+
+    print(len(entries), 'PurpleAir responses loaded for replay')
+
+# ~~~~~~~~~~~~~~
+
+def is_replaying():
+    '''
+    Are we answering PurpleAir calls from a recording?
+    '''
+
+    return _replay is not None
+
+# ~~~~~~~~~~~~~~
+
+def is_finished():
+    '''
+    Have all the recorded responses been replayed?
+    '''
+
+    return _replay is not None and all(_replay['used'])
+
+# ~~~~~~~~~~~~~~
+
+def Replay_response(query):
+    '''
+    Finds the first unused recorded response to the same query and moves the clock to its runtime
+
+    returns status_code (int) and body (bytes) - 404 if the recording has no such query left
+    '''
+
+    global _clock
+
+    key = _Query_key(query)
+
+    with _replay_lock:
+
+        for i, entry in enumerate(_replay['entries']):
+
+            if not _replay['used'][i] and entry['key'] == key:
+
+                _replay['used'][i] = True
+                _clock = max(_clock, entry['runtime'])
+
+                return entry['status_code'], entry['body'].encode('utf-8')
+
+    return 404, b'Not in the recording'
+
+# ~~~~~~~~~~~~~~
+
+def Now(timezone = 'America/Chicago'):
+    '''
+    The current time - the replay clock if replaying, otherwise the real time
+    '''
+
+    if _clock is not None:
+        return _clock.astimezone(pytz.timezone(timezone))
+
+    return dt.datetime.now(pytz.timezone(timezone))
+
+# ~~~~~~~~~~~~~~
+
+def Sleep(seconds):
+    '''
+    time.sleep(seconds) - if replaying, advance the replay clock instead and sleep seconds/speed (or not at all)
+    '''
+
+    global _clock
+
+    if _replay is None:
+        time.sleep(seconds)
+        return
+
+    with _replay_lock:
+        _clock = _clock + dt.timedelta(seconds = seconds)
+
+    if _replay['speed']:
+        time.sleep(seconds / _replay['speed'])
@@ -25,9 +25,18 @@ def Get_phone_numbers(record_ids, redCap_token_signUp):
     
     Assumption: there will always be a valid phone number in REDcap data. Otherwise we would need to add error handling in send_all_messages
     '''
-    # Initialize return value
     
-    phone_numbers = []
+    # Send the request
+    r = requests.post('https://redcap.ahc.umn.edu/api/',data=_Phone_numbers_request(record_ids, redCap_token_signUp))
+    
+    return _Unpack_phone_numbers(r.status_code, r.text, record_ids)
+
+# ~~~~~~~~~~~~~
+
+def _Phone_numbers_request(record_ids, redCap_token_signUp):
+    '''
+    The REDCap API request (a dictionary to POST) for the phone numbers of record_ids [int]
+    '''
     
     ## Prep the REDCap Query
     
@@ -61,14 +70,21 @@ def Get_phone_numbers(record_ids, redCap_token_signUp):
     'filterLogic': filterLogic_str  
     }
     
-    # Send the request
-    r = requests.post('https://redcap.ahc.umn.edu/api/',data=data)
+    return data
+
+# ~~~~~~~~~~~~~
+
+def _Unpack_phone_numbers(status_code, text, record_ids):
+    '''
+    Unpacks REDCap's response (status_code and text) into phone_numbers in a list with the same order as record_ids
+    '''
+    # Initialize return value
     
-    # Unpack the response
+    phone_numbers = []
     
-    if r.status_code == 200 and r.text != '\n':
+    if status_code == 200 and text != '\n':
         
-        df = pd.read_csv(StringIO(r.text)) # Read as a dataframe
+        df = pd.read_csv(StringIO(text)) # Read as a dataframe
         
         sorted_df = df.set_index('record_id').loc[record_ids] # Sort df by input record_ids
         
@@ -0,0 +1,132 @@
+# A ring buffer of every sensor's recent readings
+# One row per sensor, one column per tick (the oldest column is overwritten) - NaN where a sensor had no clean reading
+# Lets spike detection look at persistence ("K of the last N above threshold") or a rising trend for all sensors at once
+
+## Load modules
+
+import numpy as np
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+capacity = 12 # ticks kept per sensor (2 hours at a 10 minute timestep)
+
+_buffer = None # Dictionary of sensor_ids (sorted np.array of int64), readings (np.array sensors x capacity of float32), position (next column), ticks (columns written)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _empty():
+    '''
+    A new, empty buffer
+    '''
+
+    return {'sensor_ids': np.array([], dtype = np.int64),
+            'readings': np.full((0, capacity), np.nan, dtype = np.float32),
+            'position': 0,
+            'ticks': 0
+           }
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _positions(sensor_indices):
+    '''
+    Returns the rows (np.array of ints) of sensor_indices, adding rows for sensors we haven't seen yet
+    '''
+
+    global _buffer
+
+    sensor_indices = np.asarray(sensor_indices, dtype = np.int64)
+
+    new_ids = np.setdiff1d(sensor_indices, _buffer['sensor_ids'])
+
+    if len(new_ids) > 0: # Keep sensor_ids sorted
+
+        sensor_ids = np.concatenate([_buffer['sensor_ids'], new_ids])
+        order = np.argsort(sensor_ids, kind = 'stable')
+
+        readings = np.concatenate([_buffer['readings'], np.full((len(new_ids), capacity), np.nan, dtype = np.float32)])
+
+        _buffer = dict(_buffer, sensor_ids = sensor_ids[order], readings = readings[order])
+
+    return np.searchsorted(_buffer['sensor_ids'], sensor_indices)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Update(sensor_indices, readings):
+    '''
+    Writes this tick's readings (np.array/list of floats) for sensor_indices (list of integers) into the next column
+    Sensors without a reading this tick get NaN
+    '''
+
+    global _buffer
+
+    if _buffer is None:
+        _buffer = _empty()
+
+    rows = _positions(sensor_indices)
+
+    column = np.full(len(_buffer['sensor_ids']), np.nan, dtype = np.float32)
+    column[rows] = np.asarray(readings, dtype = np.float32)
+
+    _buffer['readings'][:, _buffer['position']] = column
+    _buffer['position'] = (_buffer['position'] + 1) % capacity
+    _buffer['ticks'] += 1
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _window(n):
+    '''
+    The last n columns (sensors x n, oldest to newest)
+    '''
+
+    n = min(n, capacity)
+    columns = (_buffer['position'] - n + np.arange(n)) % capacity
+
+    return _buffer['readings'][:, columns]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Persistent(sensor_indices, threshold, k, n):
+    '''
+    Which of sensor_indices (list of integers) had at least k of their last n readings >= threshold?
+
+    returns a np.array of bools lined up with sensor_indices
+    '''
+
+    if _buffer is None or len(sensor_indices) == 0:
+        return np.zeros(len(sensor_indices), dtype = bool)
+
+    window = _window(n)[_positions(sensor_indices)]
+
+    return (window >= threshold).sum(axis = 1) >= k # NaN comparisons are False
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Rising(sensor_indices, n, min_points = 3):
+    '''
+    Which of sensor_indices (list of integers) have a rising trend (positive least squares slope) over their last n readings?
+    Needs at least min_points readings in the window
+
+    returns a np.array of bools lined up with sensor_indices
+    '''
+
+    if _buffer is None or len(sensor_indices) == 0:
+        return np.zeros(len(sensor_indices), dtype = bool)
+
+    window = _window(n)[_positions(sensor_indices)].astype(np.float64)
+
+    valid = ~np.isnan(window)
+    counts = valid.sum(axis = 1)
+
+    x = np.broadcast_to(np.arange(window.shape[1], dtype = np.float64), window.shape)
+    y = np.where(valid, window, 0)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        x_mean = np.where(valid, x, 0).sum(axis = 1) / counts
+        y_mean = y.sum(axis = 1) / counts
+
+        dx = np.where(valid, x - x_mean[:, None], 0)
+        dy = np.where(valid, y - y_mean[:, None], 0)
+
+        slope = (dx * dy).sum(axis = 1) / (dx * dx).sum(axis = 1)
+
+    return (counts >= min_points) & (slope > 0)
@@ -0,0 +1,131 @@
+# Functions to keep every reading we fetch from PurpleAir in the readings table
+# readings is partitioned by UTC day (readings_YYYYMMDD) so appends stay cheap, month long queries only touch their partitions
+# Times are stored in UTC (timestamptz) - America/Chicago wall time repeats an hour when daylight saving time ends
+# and old data is removed by dropping whole partitions (retention_days)
+
+## Load modules
+
+from psycopg2 import sql
+import Basic_PSQL as psql
+
+# Time
+
+import datetime as dt
+
+# Data Manipulation
+
+import pandas as pd
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+retention_days = 90 # Partitions older than this are dropped
+days_ahead = 1 # Partitions created in advance
+
+_partitions = set() # Days (dt.date) we know have a partition - saves a round trip every tick
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _partition_name(day):
+    '''
+    The partition for day (dt.date)
+    '''
+
+    return f'readings_{day.strftime("%Y%m%d")}'
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Ensure_partitions(pg_connection_dict, first_day, last_day = None):
+    '''
+    Creates the (UTC) day partitions from first_day to last_day (dt.dates, inclusive) if they don't exist yet
+    '''
+
+    if last_day is None:
+        last_day = first_day
+
+    days = [first_day + dt.timedelta(days = i) for i in range((last_day - first_day).days + 1)]
+
+    cmds = [sql.SQL('''CREATE TABLE IF NOT EXISTS {} PARTITION OF readings
+    FOR VALUES FROM ({}) TO ({});''').format(sql.Identifier(_partition_name(day)),
+                                             sql.Literal(day.strftime('%Y-%m-%d 00:00:00+00')),
+                                             sql.Literal((day + dt.timedelta(days = 1)).strftime('%Y-%m-%d 00:00:00+00')))
+            for day in days if day not in _partitions]
+
+    if len(cmds) > 0:
+
+        psql.send_update(sql.SQL('\n').join(cmds), pg_connection_dict)
+
+        _partitions.update(days)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Drop_old_partitions(pg_connection_dict, today, keep_days = None):
+    '''
+    Drops the day partitions older than keep_days (default retention_days) before today (dt.date)
+
+    returns the names of the dropped partitions (a list)
+    '''
+
+    if keep_days is None:
+        keep_days = retention_days
+
+    oldest = _partition_name(today - dt.timedelta(days = keep_days))
+
+    cmd = sql.SQL('''SELECT c.relname
+    FROM pg_inherits i
+    INNER JOIN pg_class c ON (c.oid = i.inhrelid)
+    WHERE i.inhparent = 'readings'::regclass
+        AND c.relname < {} -- readings_YYYYMMDD sorts by date
+    ORDER BY c.relname;
+    ''').format(sql.Literal(oldest))
+
+    names = [row[0] for row in psql.get_response(cmd, pg_connection_dict)]
+
+    if len(names) > 0:
+
+        cmd = sql.SQL('\n').join([sql.SQL('DROP TABLE IF EXISTS {};').format(sql.Identifier(name)) for name in names])
+
+        psql.send_update(cmd, pg_connection_dict)
+
+        _partitions.difference_update([dt.datetime.strptime(name[len('readings_'):], '%Y%m%d').date() for name in names])
+
+    return names
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Maintain(pg_connection_dict, today):
+    '''
+    Daily - creates today's and the coming partitions and drops the expired ones
+    '''
+
+    Ensure_partitions(pg_connection_dict, today, today + dt.timedelta(days = days_ahead))
+
+    dropped = Drop_old_partitions(pg_connection_dict, today)
+
+    if len(dropped) > 0:
+        print(len(dropped), 'old readings partitions dropped')
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Append(sensors_df, runtime, pg_connection_dict):
+    '''
+    Appends one tick of readings with one COPY
+
+    sensors_df = pd.DataFrame with columns sensor_index, pm2.5_10minute, channel_flags, last_seen (typed - see purp.Decode_response)
+    runtime = datetime (timezone aware) when PurpleAir was queried
+    '''
+
+    if len(sensors_df) == 0:
+        return
+
+    runtime = runtime.astimezone(dt.timezone.utc)
+
+    Ensure_partitions(pg_connection_dict, runtime.date()) # Usually already there
+
+    readings_df = pd.DataFrame({'ts': runtime.strftime('%Y-%m-%d %H:%M:%S+00'),
+                                'sensor_index': sensors_df.sensor_index.to_numpy(),
+                                'pm25': sensors_df['pm2.5_10minute'].to_numpy(),
+                                'channel_flags': sensors_df.channel_flags.to_numpy(),
+                                'last_seen': sensors_df.last_seen.dt.tz_convert('UTC').dt.strftime('%Y-%m-%d %H:%M:%S+00').to_numpy()
+                               })
+
+    psql.insert_into(readings_df, 'readings', pg_connection_dict)
@@ -0,0 +1,164 @@
+# A drift-free tick scheduler and background pipeline stages for MAIN.py
+# Ticks are scheduled on a fixed grid (start + n * interval) on a monotonic clock, so they don't drift
+# If a tick overruns, the policy decides: 'skip' waits for the next grid point, 'catch_up' runs right away (up to max_catch_up ticks)
+# Slow stages (eg. sending texts) can run on their own worker so the next tick's PurpleAir fetch doesn't wait for them
+
+## Load modules
+
+import time # Monotonic clock and sleeping
+from concurrent.futures import ThreadPoolExecutor # Background stages
+import threading
+import traceback
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+max_catch_up = 3 # Ticks run back to back at most before we skip ahead anyway
+
+_stages = {} # stage name: ThreadPoolExecutor with one worker (so a stage's jobs stay in order)
+_futures = {} # stage name: list of futures not yet done
+_stages_lock = threading.Lock()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Start(interval_seconds, policy = 'skip', clock = time.monotonic):
+    '''
+    Starts a schedule with the first tick now
+
+    interval_seconds = time between ticks
+    policy = 'skip' or 'catch_up' (what to do after an overrun)
+    clock = function returning seconds (eg. time.monotonic, or the replay clock)
+
+    returns the schedule (a dictionary) for Wait()
+    '''
+
+    if policy not in ['skip', 'catch_up']:
+        raise ValueError(f'Unknown overrun policy {policy}')
+
+    now = clock()
+
+    schedule = {'interval': interval_seconds,
+                'policy': policy,
+                'clock': clock,
+                'tick_start': now, # When the current tick was due
+                'ticks': 0,
+                'overruns': 0,
+                'skipped': 0,
+                'behind': 0 # Ticks in a row run late (catch_up)
+               }
+
+    return schedule
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Wait(schedule, interval_seconds = None, sleep = time.sleep):
+    '''
+    Sleeps until the next tick is due - call at the end of every tick
+
+    interval_seconds = a new interval (eg. widened by PurpleAir_Budget), otherwise the schedule's
+    sleep = function that sleeps seconds (eg. the replay clock's Sleep)
+
+    returns how late the next tick starts (seconds, 0 if on time)
+    '''
+
+    if interval_seconds is not None:
+        schedule['interval'] = interval_seconds
+
+    interval = schedule['interval']
+    now = schedule['clock']()
+
+    schedule['ticks'] += 1
+
+    due = schedule['tick_start'] + interval # Fixed cadence - from when this tick was due, not when it finished
+
+    if now <= due: # On time
+
+        schedule['behind'] = 0
+        sleep(due - now)
+        schedule['tick_start'] = due
+
+        return 0
+
+    # Overrun
+
+    schedule['overruns'] += 1
+    missed = int((now - due) // interval) # Whole ticks that are already past
+
+    print(f'Tick overran by {now - schedule["tick_start"] - interval:.1f} seconds ({schedule["overruns"]} overruns so far)')
+
+    if schedule['policy'] == 'catch_up' and schedule['behind'] < max_catch_up:
+
+        schedule['behind'] += 1
+        schedule['tick_start'] = due # Run now, stay on the grid
+
+        return now - due
+
+    # Skip - the missed ticks are dropped and we wait for the next grid point
+
+    schedule['behind'] = 0
+    schedule['skipped'] += missed
+    next_due = due + (missed + 1) * interval
+
+    sleep(next_due - now)
+    schedule['tick_start'] = next_due
+
+    return 0
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Report_errors(future):
+    '''
+    Prints the error of a background job (it would be lost otherwise)
+    '''
+
+    error = future.exception()
+
+    if error is not None:
+        print('ERROR in background stage')
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Submit(stage, function, *args, **kwargs):
+    '''
+    Runs function(*args, **kwargs) on the stage's background worker (one worker per stage - jobs run in order)
+
+    returns a concurrent.futures.Future
+    '''
+
+    with _stages_lock:
+
+        if stage not in _stages:
+            _stages[stage] = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = stage)
+            _futures[stage] = []
+
+        future = _stages[stage].submit(function, *args, **kwargs)
+        future.add_done_callback(_Report_errors)
+
+        _futures[stage] = [f for f in _futures[stage] if not f.done()] + [future]
+
+    return future
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Pending(stage):
+    '''
+    How many jobs the stage has queued or running
+    '''
+
+    with _stages_lock:
+        return len([f for f in _futures.get(stage, []) if not f.done()])
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Shutdown():
+    '''
+    Waits for every stage to finish its jobs and stops the workers
+    '''
+
+    with _stages_lock:
+        stages = list(_stages.items())
+        _stages.clear()
+        _futures.clear()
+
+    for stage, executor in stages:
+        executor.shutdown(wait = True)
@@ -9,7 +9,6 @@ from dotenv import load_dotenv # Loading .env info
 # Database 
 
 import Basic_PSQL as psql
-import psycopg2
 from psycopg2 import sql
 
 # Data Manipulation
@@ -21,6 +20,10 @@ import pandas as pd
 
 import Twilio_Functions as our_twilio 
 import REDCap_Functions as redcap
+import Create_messages
+import Sensor_Subscriber
+import Spatial_Index
+import Opt_Outs
   
 # ~~~~~~~~~~~~~~ 
    
@@ -30,17 +33,18 @@ def send_all_messages(record_ids, messages, redCap_token_signUp, pg_connection_d
     1. Send each message to the corresponding record_id
     2. update the user signup data to reflect each new message sent (+1 messages_sent, time added)
 
-    Assumptions: 
-    - We won't message the same user twice within an invocation of this function. Otherwise we might need to aggregate the data before step #2
+    Users messaged twice within an invocation of this function are incremented twice in step #2
     '''
     
     #import twilio_functions # This didn't work with my version yet, leaving for future reference
     
     numbers = redcap.Get_phone_numbers(record_ids, redCap_token_signUp) # See Send_Alerts.py
     
-    # Check Unsubscriptions
+    # Check Unsubscriptions - catch up on new opt outs, then look the numbers up in the registry (see Opt_Outs.py)
     
-    unsubscribed_indices = our_twilio.check_unsubscriptions(numbers) # See twilio_functions.py
+    Opt_Outs.Sync(pg_connection_dict)
+    
+    unsubscribed_indices = Opt_Outs.Check(numbers)
     
     if len(unsubscribed_indices) > 0:
     
@@ -53,7 +57,7 @@ def send_all_messages(record_ids, messages, redCap_token_signUp, pg_connection_d
         
         # pop() unsubscriptions from numbers/record_ids/messages list
         
-        for unsubscribed_index in unsubscribed_indices:
+        for unsubscribed_index in sorted(unsubscribed_indices, reverse = True): # From the back so the indices still line up
             
             numbers.pop(unsubscribed_index)
             record_ids.pop(unsubscribed_index)
@@ -63,58 +67,53 @@ def send_all_messages(record_ids, messages, redCap_token_signUp, pg_connection_d
     
     times = our_twilio.send_texts(numbers, messages) # See twilio_functions.py
     
-    update_user_table(record_ids, times, pg_connection_dict) # See Send_Alerts.py
+    segments_sent = sum(Create_messages.count_segments(message) for message, t in zip(messages, times) if t is not None) # See Create_messages.py
+    
+    update_user_table(record_ids, times, pg_connection_dict, segments_sent) # See Send_Alerts.py
 
     return
 
 # ~~~~~~~~~~~~~
 
-def update_user_table(record_ids, times, pg_connection_dict):
+def update_user_table(record_ids, times, pg_connection_dict, segments_sent = 0):
     '''
     Takes a list of users + time objects and updates the "Sign Up Information" table
-    to increment each user's messages_sent and last_messaged
+    to increment each user's messages_sent and last_messaged - all users in one statement
+    
+    It also adds this batch's messages_sent and segments_sent (integer) to today's row of "Daily Log"
     '''
     #print("updating Sign Up Information", record_ids, times)
+    
+    sent = [(record_id, t) for record_id, t in zip(record_ids, times) if t is not None] # Only messages that have a time were sent
+    record_ids = [int(record_id) for record_id, t in sent]
+    times = [t.strftime('%Y-%m-%d %H:%M:%S') for record_id, t in sent]
 
-    conn = psycopg2.connect(**pg_connection_dict,keepalives_idle=10)
-    cur = conn.cursor()
-
-    # dataframe is sorted by record ID because SQL messages_sent query needs to be ordered (and this needs to match
-    sorted = pd.DataFrame({'record_ids': record_ids,'times': times}).sort_values(by = "record_ids")  
-
+    # Users messaged more than once are grouped so they are incremented by the number of messages
     cmd = sql.SQL('''
-    SELECT messages_sent
-    FROM "Sign Up Information" u
-    WHERE u.record_id = ANY ( {} )
-    ORDER BY u.record_id asc; 
-    ''').format(sql.Literal(record_ids))
-
-    cur.execute(cmd)
-    conn.commit()
-
-    messages_sent_list = [i[0] for i in cur.fetchall()] # Unpack results into list
-    messages_sent_new = [v+1 for v in messages_sent_list]
-    sorted["messages_sent_new"] = messages_sent_new
-
-    # SQL statement that updates each record (identified by record_ids) with new times, messages_sent_new values
-    # if this ever has performance trouble, we could try https://dev.mysql.com/doc/refman/8.0/en/insert-on-duplicate.html
-    # which would require record_id to be made into a foreign key  
-    for id, time, msg_inc in zip(sorted["record_ids"], sorted["times"], sorted["messages_sent_new"]):
-        cmd = sql.SQL('''
-        UPDATE "Sign Up Information"
-        SET last_messaged = {lm}, messages_sent = {ms} 
-        WHERE record_id =  {ri} ;
-        ''').format(ri = sql.Literal(id),
-                    lm = sql.Literal(time),
-                    ms = sql.Literal(msg_inc)
-                    )
-        cur.execute(cmd)
-    
-    conn.commit()
-    
-    cur.close()
-    conn.close()
-    return
+    WITH sent as
+    (
+    SELECT s.record_id, MAX(s.last_messaged) as last_messaged, COUNT(*) as n
+    FROM unnest({ri}::int[], {lm}::timestamp[]) AS s(record_id, last_messaged) -- inserted record_ids/times
+    GROUP BY s.record_id
+    ), users as
+    (
+    UPDATE "Sign Up Information" u
+    SET last_messaged = s.last_messaged, messages_sent = u.messages_sent + s.n
+    FROM sent s
+    WHERE u.record_id = s.record_id
+    )
+    INSERT INTO "Daily Log" ("date", messages_sent, segments_sent) -- Start today's totals or add to them
+    VALUES (CURRENT_DATE, {ms}, {ss})
+    ON CONFLICT ("date") DO UPDATE
+    SET messages_sent = "Daily Log".messages_sent + EXCLUDED.messages_sent,
+        segments_sent = "Daily Log".segments_sent + EXCLUDED.segments_sent;
+    ''').format(ri = sql.Literal(record_ids),
+                lm = sql.Literal(times),
+                ms = sql.Literal(len(record_ids)),
+                ss = sql.Literal(int(segments_sent))
+                )
+    
+    psql.send_update(cmd, pg_connection_dict)
     
 # ~~~~~~~~~~~~~
     
@@ -129,3 +128,8 @@ WHERE record_id = ANY ( {} );
     ''').format(sql.Literal(record_ids))
     
     psql.send_update(cmd, pg_connection_dict)
+    
+    # They are no longer anyone's audience
+    
+    Sensor_Subscriber.Remove_users(record_ids, pg_connection_dict)
+    Spatial_Index.Remove_users(record_ids) # If it's in use
@@ -0,0 +1,172 @@
+# An in-memory state engine for every sensor
+# Keeps each sensor's last_elevated and active alert in NumPy arrays (rebuilt from the database at startup - see MAIN.py)
+# so sorting sensors into new/ongoing/ended/not is a few vectorized comparisons instead of queries every tick
+# The database still gets every transition (Update_last_elevated, New_Alerts, Ended_Alerts)
+
+## Load modules
+
+from psycopg2 import sql
+import Basic_PSQL as psql
+
+# Time
+
+import datetime as dt
+
+# Data Manipulation
+
+import numpy as np
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# The state - arrays line up with sensor_ids (sorted, so a sensor's slot is found with np.searchsorted)
+# last_elevated is in seconds (America/Chicago wall time, like the database), never_elevated if it hasn't been
+# active_alert is the sensor's alert_index, no_alert if it isn't in an alert
+
+never_elevated = np.iinfo(np.int64).max
+no_alert = -1
+
+_state = None # Dictionary of sensor_ids, last_elevated, active_alert (np.arrays of int64)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def is_loaded():
+    '''
+    Is the state engine in use?
+    '''
+
+    return _state is not None
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _to_seconds(time):
+    '''
+    A datetime (aware or naive) -> seconds since 1970 of its America/Chicago wall time (how the database stores it)
+    '''
+
+    return int((time.replace(tzinfo = None) - dt.datetime(1970, 1, 1)).total_seconds())
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Load(pg_connection_dict):
+    '''
+    Rebuilds the state from "PurpleAir Stations" (last_elevated) and "Active Alerts Acute PurpleAir" (sensor_indices)
+    '''
+
+    global _state
+
+    cmd = sql.SQL('''SELECT sensor_index, EXTRACT(EPOCH FROM last_elevated)::bigint
+    FROM "PurpleAir Stations"
+    ORDER BY sensor_index;
+    ''')
+
+    response = psql.get_response(cmd, pg_connection_dict)
+
+    sensor_ids = np.array([row[0] for row in response], dtype = np.int64)
+    last_elevated = np.array([never_elevated if row[1] is None else row[1] for row in response], dtype = np.int64)
+
+    cmd = sql.SQL('''SELECT x.sensor_index, a.alert_index
+    FROM "Active Alerts Acute PurpleAir" a
+    CROSS JOIN LATERAL unnest(a.sensor_indices) AS x(sensor_index);
+    ''')
+
+    response = psql.get_response(cmd, pg_connection_dict)
+
+    _state = {'sensor_ids': sensor_ids,
+              'last_elevated': last_elevated,
+              'active_alert': np.full(len(sensor_ids), no_alert, dtype = np.int64)
+             }
+
+    if len(response) > 0:
+        Set_alerts([row[0] for row in response], [row[1] for row in response])
+
+    print(len(sensor_ids), 'sensors and', len(response), 'active alerted sensors in the sensor state')
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _positions(sensor_indices):
+    '''
+    Returns the slots (np.array of ints) of sensor_indices, adding any sensors we don't know yet
+    '''
+
+    global _state
+
+    sensor_indices = np.asarray(sensor_indices, dtype = np.int64)
+
+    new_ids = np.setdiff1d(sensor_indices, _state['sensor_ids'])
+
+    if len(new_ids) > 0: # Make room for new sensors (eg. added by the daily update) - keep sensor_ids sorted
+
+        sensor_ids = np.concatenate([_state['sensor_ids'], new_ids])
+        order = np.argsort(sensor_ids, kind = 'stable')
+
+        _state = {'sensor_ids': sensor_ids[order],
+                  'last_elevated': np.concatenate([_state['last_elevated'], np.full(len(new_ids), never_elevated, dtype = np.int64)])[order],
+                  'active_alert': np.concatenate([_state['active_alert'], np.full(len(new_ids), no_alert, dtype = np.int64)])[order]
+                 }
+
+    return np.searchsorted(_state['sensor_ids'], sensor_indices)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Classify(spiked_sensor_indices, flagged_sensor_ids, elevated_time, now, alert_lag = 20):
+    '''
+    Marks spiked_sensor_indices (list of integers) as elevated at elevated_time (datetime - the PurpleAir runtime)
+    and sorts every sensor (not elevated = not elevated in the alert_lag minutes before now)
+
+    returns a dictionary with keys 'new', 'ongoing', 'ended', 'flagged', or 'not'
+                values are sets of integers (sensor_index) - same as GetSort_Spikes.Sort_sensor_indices
+    '''
+
+    elevated_seconds = _to_seconds(elevated_time)
+    now_seconds = _to_seconds(now)
+
+    positions = _positions(list(spiked_sensor_indices)) # (may add sensors, so before sizing the masks)
+
+    spiked = np.zeros(len(_state['sensor_ids']), dtype = bool)
+    spiked[positions] = True
+
+    _state['last_elevated'][positions] = elevated_seconds
+
+    # The masks
+
+    alerted = _state['active_alert'] != no_alert
+    not_elevated = (_state['last_elevated'] != never_elevated) & (_state['last_elevated'] + alert_lag * 60 < now_seconds)
+
+    sensor_ids = _state['sensor_ids']
+
+    sensor_dict = {'new': set(sensor_ids[spiked & ~alerted].tolist()),
+                   'ongoing': set(sensor_ids[spiked & alerted].tolist()),
+                   'ended': set(sensor_ids[not_elevated & alerted].tolist()),
+                   'flagged': set(flagged_sensor_ids),
+                   'not': set(sensor_ids[not_elevated].tolist())
+                  }
+
+    return sensor_dict
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Set_alerts(sensor_indices, alert_indices):
+    '''
+    Records that sensor_indices (list of integers) are in alert_indices (equally long list of integers)
+    Use after New_Alerts creates alerts - does nothing if the state isn't loaded
+    '''
+
+    if _state is None or len(sensor_indices) == 0:
+        return
+
+    _state['active_alert'][_positions(sensor_indices)] = np.asarray(alert_indices, dtype = np.int64)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Clear_alerts(alert_indices):
+    '''
+    Records that alert_indices (list of integers) have ended
+    Use after Ended_Alerts ends alerts - does nothing if the state isn't loaded
+    '''
+
+    if _state is None or len(alert_indices) == 0:
+        return
+
+    ended = np.isin(_state['active_alert'], np.asarray(alert_indices, dtype = np.int64))
+
+    _state['active_alert'][ended] = no_alert
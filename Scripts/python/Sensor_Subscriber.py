@@ -0,0 +1,111 @@
+# Functions to maintain the sensor_subscriber table
+# A precomputed mapping of (sensor_index, record_id, distance_m) for every active sensor and subscribed user within subscriber_radius
+# So finding an alert's audience is an indexed equality join instead of a spatial scan
+
+## Load modules
+
+from psycopg2 import sql
+import Basic_PSQL as psql
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+subscriber_radius = 1000 # meters - the largest distance we will ever look up (see New_Alerts.py)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Rebuild(pg_connection_dict, distance = subscriber_radius):
+    '''
+    Recomputes the whole sensor_subscriber table from "Sign Up Information" and "PurpleAir Stations"
+    Only needed once (or after changing the distance), afterwards the table is kept up to date incrementally
+    '''
+
+    cmd = sql.SQL('''
+    DELETE FROM sensor_subscriber;
+
+    INSERT INTO sensor_subscriber (sensor_index, record_id, distance_m)
+    SELECT s.sensor_index, u.record_id,
+        ST_Distance(u.geometry_utm, s.geometry_utm) as distance_m
+    FROM "Sign Up Information" u, "PurpleAir Stations" s
+    WHERE u.subscribed = TRUE AND s.channel_state <> 0
+        AND ST_DWithin(u.geometry_utm, s.geometry_utm, {}); -- index assisted (UTM 15N meters)
+    ''').format(sql.Literal(distance))
+
+    psql.send_update(cmd, pg_connection_dict)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Add_users(record_ids, pg_connection_dict, distance = subscriber_radius):
+    '''
+    Adds the sensors within the distance of new users (record_ids, a list of integers) to sensor_subscriber
+
+    Use after Daily_Updates.Add_new_users
+    '''
+
+    cmd = sql.SQL('''
+    INSERT INTO sensor_subscriber (sensor_index, record_id, distance_m)
+    SELECT s.sensor_index, u.record_id,
+        ST_Distance(u.geometry_utm, s.geometry_utm) as distance_m
+    FROM "Sign Up Information" u, "PurpleAir Stations" s
+    WHERE u.record_id = ANY ( {} ) -- inserted record_ids
+        AND u.subscribed = TRUE AND s.channel_state <> 0
+        AND ST_DWithin(u.geometry_utm, s.geometry_utm, {}) -- index assisted (UTM 15N meters)
+    ON CONFLICT DO NOTHING;
+    ''').format(sql.Literal([int(record_id) for record_id in record_ids]),
+                sql.Literal(distance))
+
+    psql.send_update(cmd, pg_connection_dict)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Add_sensors(sensor_indices, pg_connection_dict, distance = subscriber_radius):
+    '''
+    Adds the subscribed users within the distance of new sensors (sensor_indices, a list of integers) to sensor_subscriber
+
+    Use after Daily_Updates.Add_new_PurpleAir_Stations
+    '''
+
+    cmd = sql.SQL('''
+    INSERT INTO sensor_subscriber (sensor_index, record_id, distance_m)
+    SELECT s.sensor_index, u.record_id,
+        ST_Distance(u.geometry_utm, s.geometry_utm) as distance_m
+    FROM "Sign Up Information" u, "PurpleAir Stations" s
+    WHERE s.sensor_index = ANY ( {} ) -- inserted sensor_indices
+        AND u.subscribed = TRUE AND s.channel_state <> 0
+        AND ST_DWithin(u.geometry_utm, s.geometry_utm, {}) -- index assisted (UTM 15N meters)
+    ON CONFLICT DO NOTHING;
+    ''').format(sql.Literal([int(sensor_index) for sensor_index in sensor_indices]),
+                sql.Literal(distance))
+
+    psql.send_update(cmd, pg_connection_dict)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Remove_users(record_ids, pg_connection_dict):
+    '''
+    Removes users (record_ids, a list of integers) from sensor_subscriber
+
+    Use after Send_Alerts.Unsubscribe_users
+    '''
+
+    cmd = sql.SQL('''
+    DELETE FROM sensor_subscriber
+    WHERE record_id = ANY ( {} );
+    ''').format(sql.Literal([int(record_id) for record_id in record_ids]))
+
+    psql.send_update(cmd, pg_connection_dict)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Remove_sensors(sensor_indices, pg_connection_dict):
+    '''
+    Removes sensors (sensor_indices, a list of integers) from sensor_subscriber
+
+    Use after Daily_Updates.Flag_channel_states
+    '''
+
+    cmd = sql.SQL('''
+    DELETE FROM sensor_subscriber
+    WHERE sensor_index = ANY ( {} );
+    ''').format(sql.Literal([int(sensor_index) for sensor_index in sensor_indices]))
+
+    psql.send_update(cmd, pg_connection_dict)
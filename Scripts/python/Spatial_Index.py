@@ -0,0 +1,227 @@
+# An optional in-memory spatial index of subscribers and sensors
+# Answers "which subscribed users are within N meters of these sensors" for a whole batch of spikes in one vectorized call
+# Turn it on with SPATIAL_BACKEND='memory' in the .env file (see MAIN.py), otherwise Our_Queries uses the database
+# Rebuilt as a whole once per daily update (see Daily_Updates.Maintenance/Daily_Worker.py) - an STRtree can't be edited in place
+
+## Load modules
+
+import threading # Removals come from the send thread
+
+from psycopg2 import sql
+import Basic_PSQL as psql
+
+# Data Manipulation
+
+import numpy as np
+import pandas as pd
+import shapely # Needs shapely >= 2.0 for vectorized STRtree queries
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# The index - replaced as a whole (never edited in place) so readers always see a consistent version
+# users/sensors are dictionaries with ids (np.array of integers) and xy (np.array n x 2 of UTM 15N meters)
+
+_index = None
+
+# Users removed (unsubscribed) since startup - a snapshot built before a removal gets it re-applied when it's swapped in
+
+_removed_users = []
+_lock = threading.Lock() # Remove_users (send thread) and Swap (main thread) both replace _index
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def is_loaded():
+    '''
+    Is the in-memory index in use?
+    '''
+
+    return _index is not None
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _build(users, sensors):
+    '''
+    Builds a new index from users/sensors dictionaries (ids + xy)
+    The STRtree is over the users, sensors are looked up by sensor_index
+    '''
+
+    user_points = shapely.points(users['xy'])
+
+    index = {'users': users,
+             'sensors': sensors,
+             'sensor_positions': pd.Series(np.arange(len(sensors['ids'])), index = sensors['ids']),
+             'user_tree': shapely.STRtree(user_points)
+            }
+
+    return index
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _query_coordinates(cmd, pg_connection_dict):
+    '''
+    Runs a query returning (id, x, y) rows and unpacks it into a dictionary of ids and xy
+    '''
+
+    response = psql.get_response(cmd, pg_connection_dict)
+
+    if len(response) > 0:
+        array = np.array(response, dtype = float)
+        coordinates = {'ids': array[:, 0].astype(np.int64), 'xy': array[:, 1:3]}
+    else:
+        coordinates = {'ids': np.array([], dtype = np.int64), 'xy': np.empty((0, 2))}
+
+    return coordinates
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _get_users(pg_connection_dict, record_ids = None):
+    '''
+    Gets subscribed users' projected coordinates (all of them, or just record_ids)
+    '''
+
+    if record_ids is None:
+        condition = sql.SQL('TRUE')
+    else:
+        condition = sql.SQL('record_id = ANY ( {} )').format(sql.Literal([int(i) for i in record_ids]))
+
+    cmd = sql.SQL('''SELECT record_id, ST_X(geometry_utm), ST_Y(geometry_utm)
+    FROM "Sign Up Information"
+    WHERE subscribed = TRUE AND {};
+    ''').format(condition)
+
+    return _query_coordinates(cmd, pg_connection_dict)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _get_sensors(pg_connection_dict, sensor_indices = None):
+    '''
+    Gets active sensors' projected coordinates (all of them, or just sensor_indices)
+    '''
+
+    if sensor_indices is None:
+        condition = sql.SQL('TRUE')
+    else:
+        condition = sql.SQL('sensor_index = ANY ( {} )').format(sql.Literal([int(i) for i in sensor_indices]))
+
+    cmd = sql.SQL('''SELECT sensor_index, ST_X(geometry_utm), ST_Y(geometry_utm)
+    FROM "PurpleAir Stations"
+    WHERE channel_state <> 0 AND {};
+    ''').format(condition)
+
+    return _query_coordinates(cmd, pg_connection_dict)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _combine(old, new, remove_ids = None):
+    '''
+    Appends new ids/xy to old ones, dropping remove_ids and any ids that are being replaced
+    '''
+
+    drop = new['ids'] if remove_ids is None else np.concatenate([new['ids'], np.asarray(remove_ids, dtype = np.int64)])
+    keep = ~np.isin(old['ids'], drop)
+
+    return {'ids': np.concatenate([old['ids'][keep], new['ids']]),
+            'xy': np.concatenate([old['xy'][keep], new['xy']])}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _without_users(index, record_ids):
+    '''
+    A new index without record_ids (a list of integers)
+    '''
+
+    empty = {'ids': np.array([], dtype = np.int64), 'xy': np.empty((0, 2))}
+
+    new_index = _build(_combine(index['users'], empty, record_ids), index['sensors'])
+    new_index['removed_before'] = index['removed_before']
+
+    return new_index
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Load(pg_connection_dict):
+    '''
+    Loads every subscribed user and active sensor from the database and builds the index
+    '''
+
+    Swap(Build(pg_connection_dict))
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Build(pg_connection_dict):
+    '''
+    Builds a whole new index from the database without using it (eg. on the daily worker - see Daily_Worker.py)
+    '''
+
+    removed_before = len(_removed_users) # Removals after this point may be missing from the database reads below
+
+    index = _build(_get_users(pg_connection_dict), _get_sensors(pg_connection_dict))
+    index['removed_before'] = removed_before
+
+    return index
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Swap(index):
+    '''
+    Starts using index (from Build) - one assignment, so readers see the old or the new version, never a mix
+    Users removed while it was being built are removed from it first
+    '''
+
+    global _index
+
+    with _lock:
+
+        missed = _removed_users[index['removed_before']:]
+
+        if len(missed) > 0:
+            index = _without_users(index, missed)
+
+        _index = index
+
+    print(len(_index['users']['ids']), 'users and', len(_index['sensors']['ids']), 'sensors in the spatial index')
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Remove_users(record_ids):
+    '''
+    Removes users (record_ids, a list of integers) from the index - does nothing if the index isn't loaded
+    Rebuilds the whole STRtree (unsubscribes are rare - new/retired stations and users wait for the daily rebuild instead)
+    '''
+
+    global _index
+
+    if len(record_ids) == 0:
+        return
+
+    with _lock:
+
+        _removed_users.extend(int(record_id) for record_id in record_ids) # Even if it isn't loaded yet - Swap re-applies them
+
+        if _index is not None:
+            _index = _without_users(_index, record_ids)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Users_nearby_sensors(sensor_indices, distance = 1000):
+    '''
+    Finds the users within the distance (meters) of each sensor in sensor_indices (a list of integers) in one vectorized query
+
+    returns a pd.DataFrame with columns sensor_index (int), record_id (int)
+    '''
+
+    index = _index # One consistent version for the whole query
+
+    positions = index['sensor_positions'].reindex(list(sensor_indices)).dropna().astype(int).to_numpy()
+
+    if len(positions) == 0 or len(index['users']['ids']) == 0:
+        return pd.DataFrame({'sensor_index': pd.Series(dtype = int), 'record_id': pd.Series(dtype = int)})
+
+    sensor_points = shapely.points(index['sensors']['xy'][positions])
+
+    sensor_hits, user_hits = index['user_tree'].query(sensor_points, predicate = 'dwithin', distance = distance)
+
+    nearby_df = pd.DataFrame({'sensor_index': index['sensors']['ids'][positions][sensor_hits],
+                              'record_id': index['users']['ids'][user_hits]})
+
+    return nearby_df
@@ -5,51 +5,191 @@ Drivers will be communicate_alert_start and communicate_alert_end
 
 import os
 from twilio.rest import Client
+from twilio.base.exceptions import TwilioRestException, TwilioException
+import requests # Twilio's http client - tells us whether a failed request ever reached Twilio
+import urllib3
 
 # Getting .env information
 from dotenv import load_dotenv
 import time # Sleeping
+import threading # The client and rate limit are shared between threads
+from collections import deque # Recent send log
+from concurrent.futures import ThreadPoolExecutor # Sending concurrently
+import datetime as dt
 import pytz # Timezones
 import numpy as np
 
-def send_texts(numbers, messages): # could refactor to send to user, that way we could inc. messages_sent in this function (better than havign to do it in parents)
-    '''basic send function that takes in a list of numbers + list of messages and sends them out
-    and returns a list of times that each message was sent
+# ~~~~~~~~~~~~~~
+
+## Sending
+
+# One client for the life of the process, a token bucket so we never send faster than the messaging service allows
+# (messages_per_second, set from TWILIO_MESSAGES_PER_SECOND in MAIN.py) and a bounded pool of senders
+# A failed message is retried (max_attempts) after the rest of the batch has gone out - only if Twilio never accepted it
+# (a 429, or no connection at all), a 5xx or a dropped response may have sent it already and a retry would text them twice
+
+messages_per_second = 1 # The messaging service's throughput (1 per long code number, more for toll-free/short codes)
+burst_size = 1 # Tokens the bucket can hold
+max_workers = 4 # Concurrent sends
+max_attempts = 3 # Tries per message
+backoff_seconds = 2 # Wait before retrying failures, doubles every round
+retry_statuses = (429,) # Rejected before sending
+
+send_log = deque(maxlen = 1000) # Recent results - dictionaries of number, sid, status, time, error, attempts
+
+_client = None
+_client_lock = threading.Lock()
+
+_bucket = {'tokens': 0.0, 'updated': None}
+_bucket_lock = threading.Lock()
+
+# ~~~~~~~~~~~~~~
+
+def _get_client():
+    '''
+    Returns the shared Twilio client, creating it on first use (from the .env file)
     '''
 
-    load_dotenv()
+    global _client
 
-    account_sid = os.environ['TWILIO_ACCOUNT_SID']
-    auth_token = os.environ['TWILIO_AUTH_TOKEN']
-    twilio_number = os.environ['TWILIO_NUMBER']
-    messaging_service_sid = os.environ['TWILIO_SERVICE_SID']
-    
-    client = Client(account_sid, auth_token)
+    with _client_lock:
+
+        if _client is None:
+
+            load_dotenv()
+
+            _client = Client(os.environ['TWILIO_ACCOUNT_SID'], os.environ['TWILIO_AUTH_TOKEN'])
 
-    times = []
-    for number, message in zip(numbers, messages):
+        return _client
+
+# ~~~~~~~~~~~~~~
+
+def _Take_token():
+    '''
+    Blocks until the token bucket allows another message
+    '''
 
-        msg = client.messages.create(
+    while True:
+
+        with _bucket_lock:
+
+            now = time.monotonic()
+
+            if _bucket['updated'] is None:
+                _bucket['tokens'] = float(burst_size)
+            else:
+                _bucket['tokens'] = min(float(burst_size), _bucket['tokens'] + (now - _bucket['updated']) * messages_per_second)
+
+            _bucket['updated'] = now
+
+            if _bucket['tokens'] >= 1:
+                _bucket['tokens'] -= 1
+                return
+
+            wait = (1 - _bucket['tokens']) / messages_per_second
+
+        time.sleep(wait)
+
+# ~~~~~~~~~~~~~~
+
+def _Never_sent(e):
+    '''
+    Did the request fail before reaching Twilio (e, a connection error)? Only then is a retry safe
+    '''
+
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+
+    reason = getattr(e.args[0], 'reason', None) if len(e.args) > 0 else None # requests wraps urllib3's MaxRetryError
+
+    return isinstance(e, requests.exceptions.ConnectionError) and isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+# ~~~~~~~~~~~~~~
+
+def _Send_one(number, message, result):
+    '''
+    Sends one message (waiting for the token bucket) and fills in result (a dictionary from Send_messages)
+    '''
+
+    _Take_token()
+
+    result['attempts'] += 1
+
+    try:
+        msg = _get_client().messages.create(
         body= message,
-        messaging_service_sid=messaging_service_sid,
-        from_=twilio_number,
-        to=number # replace with number in PROD
-        ) # should check error handling, if needed based on SDK
-        
-        time.sleep(1) # Sleeping for 1 second between sending messages
-        
-        times.append(msg.date_updated.replace(tzinfo=pytz.timezone('America/Chicago'))) # Append times sent - must change timezone in TWILIO otherwise I think it defaults to pacific time
-        
-    return times
+        messaging_service_sid=os.environ['TWILIO_SERVICE_SID'],
+        from_=os.environ['TWILIO_NUMBER'],
+        to=number
+        )
+
+    except TwilioRestException as e:
+        result.update({'status': 'failed', 'error': f'{e.status} {e.code}: {e.msg}',
+                       'retry': e.status in retry_statuses})
+        return
+
+    except (TwilioException, OSError) as e: # Connection problems (requests' errors are OSErrors)
+        result.update({'status': 'failed', 'error': str(e), 'retry': _Never_sent(e)})
+        return
+
+    sent_time = msg.date_created if msg.date_created is not None else dt.datetime.now(dt.timezone.utc)
+
+    result.update({'sid': msg.sid, 'status': msg.status, 'error': None, 'retry': False,
+                   'time': sent_time.astimezone(pytz.timezone('America/Chicago'))}) # Twilio's times are UTC
+
+# ~~~~~~~~~~~~~~
+
+def Send_messages(numbers, messages):
+    '''
+    Sends each message to the matching number (lists) on max_workers threads, as fast as the token bucket allows
+
+    returns a list of results (same order) - dictionaries of number, sid, status, time (datetime, None if it failed), error, attempts
+    '''
+
+    results = [{'number': number, 'sid': None, 'status': 'queued', 'time': None, 'error': None, 'attempts': 0, 'retry': True}
+               for number in numbers]
+
+    to_send = list(range(len(results)))
+
+    for attempt in range(max_attempts):
+
+        if attempt > 0: # Retry the failures after the rest of the batch
+            time.sleep(backoff_seconds * 2 ** (attempt - 1))
+
+        with ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'twilio') as executor:
+            for i in to_send:
+                executor.submit(_Send_one, numbers[i], messages[i], results[i])
+
+        to_send = [i for i in to_send if results[i]['time'] is None and results[i]['retry']]
+
+        if len(to_send) == 0:
+            break
+
+    for result in results:
+        del result['retry']
+        send_log.append(result)
+
+        if result['time'] is None:
+            print(f'ERROR sending text to {result["number"]} - {result["error"]}')
+
+    return results
+
+# ~~~~~~~~~~~~~~
+
+def send_texts(numbers, messages): # could refactor to send to user, that way we could inc. messages_sent in this function (better than havign to do it in parents)
+    '''basic send function that takes in a list of numbers + list of messages and sends them out
+    and returns a list of times that each message was sent (None if it couldn't be sent - see Send_messages)
+    '''
+
+    return [result['time'] for result in Send_messages(numbers, messages)]
+
+# ~~~~~~~~~~~~~~
     
 def check_unsubscriptions(numbers):
     '''Returns the indices of the phone numbers in numbers that have unsubscribed
-    Which corresponds to record_ids_to_text'''
-
-    load_dotenv()
-
-    account_sid = os.environ['TWILIO_ACCOUNT_SID']
-    auth_token = os.environ['TWILIO_AUTH_TOKEN']
+    Which corresponds to record_ids_to_text
+    
+    Scans each number's whole history - Send_Alerts uses the opt out registry instead (see Opt_Outs.py)'''
     
     unsubscribed_indices = []
     
@@ -57,7 +197,7 @@ def check_unsubscriptions(numbers):
 
     # Set up Twilio Client
 
-    client = Client(account_sid, auth_token)
+    client = _get_client()
 
     # Iterate through the numbers 
     
@@ -81,13 +221,9 @@ def delete_twilio_info(numbers):
     '''This function deletes texts to/from phone numbers in twilio
     '''
     
-    load_dotenv()
-
-    account_sid = os.environ['TWILIO_ACCOUNT_SID']
-    auth_token = os.environ['TWILIO_AUTH_TOKEN']
     # Set up Twilio Client
 
-    client = Client(account_sid, auth_token)
+    client = _get_client()
 
     # Iterate through the unique numbers 
     
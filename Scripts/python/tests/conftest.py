@@ -0,0 +1,6 @@
+# Lets the tests import the flat modules in Scripts/python (run from Scripts/python with python -m pytest -q tests)
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,154 @@
+# Tests for Alert_Clusters.py - component labelling and the merge/split plans (Get_sensor_xy is replaced, no database)
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import Alert_Clusters
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def dense_labels(xy, distance, groups = None):
+    '''
+    Reference labelling from the full n x n distance matrix
+    '''
+
+    n = len(xy)
+    connected = np.hypot(*(xy[:, None, :] - xy[None, :, :]).transpose(2, 0, 1)) <= distance
+    if groups is not None:
+        connected &= groups[:, None] == groups[None, :]
+
+    labels = np.arange(n)
+    while True:
+        new_labels = np.where(connected, labels[None, :], n).min(axis = 1)
+        if (new_labels == labels).all():
+            return labels
+        labels = new_labels
+
+@pytest.fixture
+def sensor_xy(monkeypatch):
+    '''
+    Replaces Get_sensor_xy with a lookup in the returned dictionary of sensor_index: (x, y)
+    '''
+
+    locations = {}
+
+    def get_sensor_xy(sensor_indices, pg_connection_dict):
+        rows = [(s, *locations[s]) for s in sensor_indices if s in locations]
+        return pd.DataFrame(rows, columns = ['sensor_index', 'x', 'y'])
+
+    monkeypatch.setattr(Alert_Clusters, 'Get_sensor_xy', get_sensor_xy)
+
+    return locations
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_label_components_empty():
+
+    assert len(Alert_Clusters.Label_components(np.zeros((0, 2)))) == 0
+
+def test_label_components_chains():
+    '''
+    0-1-2 are a chain (each within distance of the next, not of both), 3 is alone
+    '''
+
+    xy = np.array([[0, 0], [1000, 0], [2000, 0], [10000, 0]])
+
+    assert Alert_Clusters.Label_components(xy, 1500).tolist() == [0, 0, 0, 3]
+
+def test_label_components_distance_is_inclusive():
+
+    xy = np.array([[0, 0], [1500, 0]])
+
+    assert Alert_Clusters.Label_components(xy, 1500).tolist() == [0, 0]
+    assert Alert_Clusters.Label_components(xy, 1499).tolist() == [0, 1]
+
+def test_label_components_groups_are_never_connected():
+
+    xy = np.array([[0, 0], [10, 0], [20, 0], [30, 0]])
+    groups = np.array([7, 8, 7, 8])
+
+    assert Alert_Clusters.Label_components(xy, 25, groups = groups).tolist() == [0, 1, 0, 1]
+
+@pytest.mark.parametrize('seed', range(20))
+def test_label_components_matches_dense_matrix(seed):
+
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, 20000, (60, 2))
+    groups = rng.integers(0, 3, 60)
+
+    assert (Alert_Clusters.Label_components(xy, 1500) == dense_labels(xy, 1500)).all()
+    assert (Alert_Clusters.Label_components(xy, 1500, groups) == dense_labels(xy, 1500, groups)).all()
+
+def test_plan_new_alerts_joins_and_merges(sensor_xy):
+    '''
+    Sensor 10 bridges alerts 1 and 2 - it joins alert 1 (the oldest) and alert 2 merges into it
+    Sensor 11 is far from everything - a new alert. Sensor 12 has no location - a new alert of its own
+    '''
+
+    sensor_xy.update({1: (0, 0), 2: (2000, 0), 3: (50000, 0), 10: (1000, 0), 11: (20000, 0)})
+    active_sensors_df = pd.DataFrame({'alert_index': [1, 2, 5], 'sensor_index': [1, 2, 3]})
+
+    plan_df, merges = Alert_Clusters.Plan_new_alerts([10, 11, 12], active_sensors_df, None)
+
+    assert plan_df.sensor_index.tolist() == [10, 11, 12]
+    assert plan_df.alert_index.tolist() == [1, -1, -1]
+    assert plan_df.group.nunique() == 3
+    assert merges == {1: [2]}
+
+def test_plan_new_alerts_groups_new_sensors_together(sensor_xy):
+
+    sensor_xy.update({10: (0, 0), 11: (1000, 0), 12: (30000, 0)})
+    active_sensors_df = pd.DataFrame({'alert_index': pd.Series(dtype = int), 'sensor_index': pd.Series(dtype = int)})
+
+    plan_df, merges = Alert_Clusters.Plan_new_alerts([10, 11, 12], active_sensors_df, None)
+
+    groups = plan_df.set_index('sensor_index').group
+    assert groups[10] == groups[11] != groups[12]
+    assert (plan_df.alert_index == -1).all()
+    assert merges == {}
+
+def test_plan_new_alerts_no_merge_without_a_new_sensor_between(sensor_xy):
+    '''
+    Active alerts that are already close to each other only merge when a new sensor is in their cluster
+    '''
+
+    sensor_xy.update({1: (0, 0), 2: (1000, 0), 10: (30000, 0)})
+    active_sensors_df = pd.DataFrame({'alert_index': [1, 2], 'sensor_index': [1, 2]})
+
+    plan_df, merges = Alert_Clusters.Plan_new_alerts([10], active_sensors_df, None)
+
+    assert plan_df.alert_index.tolist() == [-1]
+    assert merges == {}
+
+def test_plan_splits_moves_the_smaller_part(sensor_xy):
+    '''
+    Alert 1 has split into {1, 2} and {3}, alert 2 is still one cluster, alert 3 has a single sensor
+    '''
+
+    sensor_xy.update({1: (0, 0), 2: (1000, 0), 3: (30000, 0), 4: (0, 5000), 5: (500, 5000), 6: (90000, 0)})
+    spiking_sensors_df = pd.DataFrame({'alert_index': [1, 1, 1, 2, 2, 3], 'sensor_index': [1, 2, 3, 4, 5, 6]})
+
+    moving_df = Alert_Clusters.Plan_splits(spiking_sensors_df, None)
+
+    assert moving_df.parent.tolist() == [1]
+    assert moving_df.sensor_index.tolist() == [3]
+
+def test_plan_splits_tie_keeps_the_lowest_part(sensor_xy):
+
+    sensor_xy.update({1: (0, 0), 2: (30000, 0)})
+    spiking_sensors_df = pd.DataFrame({'alert_index': [4, 4], 'sensor_index': [1, 2]})
+
+    moving_df = Alert_Clusters.Plan_splits(spiking_sensors_df, None)
+
+    assert moving_df.sensor_index.tolist() == [2]
+
+def test_plan_splits_nothing_to_split(sensor_xy):
+
+    sensor_xy.update({1: (0, 0), 2: (1000, 0), 3: (30000, 0)})
+    spiking_sensors_df = pd.DataFrame({'alert_index': [1, 1, 2], 'sensor_index': [1, 2, 3]})
+
+    moving_df = Alert_Clusters.Plan_splits(spiking_sensors_df, None)
+
+    assert len(moving_df) == 0
+    assert moving_df.columns.tolist() == ['parent', 'part', 'sensor_index']
@@ -0,0 +1,97 @@
+# Tests for PurpleAir_Functions.Plan_fetch and _Chunk_sensor_ids - chunk limits and the bounds vs sensors choice (no network)
+
+import pytest
+
+import PurpleAir_Functions
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+fields = ['sensor_index', 'pm2.5_10minute', 'last_seen']
+fields_string = 'fields=' + '%2C'.join(fields)
+
+@pytest.fixture(autouse = True)
+def no_bounds_info(monkeypatch):
+
+    monkeypatch.setattr(PurpleAir_Functions, '_bounds_info', None)
+
+def query_length(chunk):
+    '''
+    Length of the query string for one chunk, as counted by _Chunk_sensor_ids
+    '''
+
+    return len(fields_string) + len('&show_only=') + sum(len(str(sensor_id)) + 3 for sensor_id in chunk)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_chunk_empty():
+
+    assert PurpleAir_Functions._Chunk_sensor_ids([], fields_string) == []
+
+def test_chunk_max_sensors_per_call(monkeypatch):
+
+    monkeypatch.setattr(PurpleAir_Functions, 'max_sensors_per_call', 3)
+
+    chunks = PurpleAir_Functions._Chunk_sensor_ids(list(range(1, 8)), fields_string)
+
+    assert chunks == [[1, 2, 3], [4, 5, 6], [7]]
+
+def test_chunk_exactly_full():
+
+    sensor_ids = list(range(PurpleAir_Functions.max_sensors_per_call))
+
+    assert len(PurpleAir_Functions._Chunk_sensor_ids(sensor_ids, fields_string)) == 1
+    assert len(PurpleAir_Functions._Chunk_sensor_ids(sensor_ids + [10**6], fields_string)) == 2
+
+def test_chunk_max_query_length(monkeypatch):
+
+    monkeypatch.setattr(PurpleAir_Functions, 'max_query_length', 200)
+
+    sensor_ids = list(range(100000, 100100))
+    chunks = PurpleAir_Functions._Chunk_sensor_ids(sensor_ids, fields_string)
+
+    assert sum(chunks, []) == sensor_ids # every id once, in order
+    assert all(query_length(chunk) <= 200 for chunk in chunks)
+    assert all(query_length(chunk + [sensor_ids[0]]) > 200 for chunk in chunks[:-1]) # chunks are as full as they can be
+
+def test_chunk_query_strings_stay_under_the_limit(monkeypatch):
+
+    monkeypatch.setattr(PurpleAir_Functions, 'max_query_length', 300)
+
+    chunks = PurpleAir_Functions._Chunk_sensor_ids(list(range(100000, 100200)), fields_string)
+
+    for query_string in PurpleAir_Functions._Sensors_query_strings(chunks, fields):
+        assert len('&' + query_string) <= 300
+
+def test_chunk_oversized_id_still_gets_a_chunk(monkeypatch):
+
+    monkeypatch.setattr(PurpleAir_Functions, 'max_query_length', 10)
+
+    assert PurpleAir_Functions._Chunk_sensor_ids([123456, 7], fields_string) == [[123456], [7]]
+
+def test_plan_fetch_without_bounds_info_uses_sensors():
+
+    plan = PurpleAir_Functions.Plan_fetch([1, 2, 3], fields)
+
+    assert plan == {'method': 'sensors', 'chunks': [[1, 2, 3]], 'bounds': None}
+
+def test_plan_fetch_prefers_bounds_when_cheaper(monkeypatch):
+    '''
+    1000 sensors in 2 calls cost 1000 * 4 + 2 * 50 rows, a bounds call over 1200 sensors costs 1200 * 4 + 50
+    '''
+
+    bounds = (-88.0, 41.6, -87.5, 42.1)
+    monkeypatch.setattr(PurpleAir_Functions, '_bounds_info', {'bounds': bounds, 'sensor_count': 1200})
+
+    assert PurpleAir_Functions.Plan_fetch(list(range(1000)), fields)['method'] == 'sensors'
+
+    monkeypatch.setattr(PurpleAir_Functions, '_bounds_info', {'bounds': bounds, 'sensor_count': 1010})
+
+    plan = PurpleAir_Functions.Plan_fetch(list(range(1000)), fields)
+
+    assert plan == {'method': 'bounds', 'chunks': [], 'bounds': bounds}
+
+def test_plan_fetch_no_sensors_never_uses_bounds(monkeypatch):
+
+    monkeypatch.setattr(PurpleAir_Functions, '_bounds_info', {'bounds': (0, 0, 1, 1), 'sensor_count': 0})
+
+    assert PurpleAir_Functions.Plan_fetch([], fields) == {'method': 'sensors', 'chunks': [], 'bounds': None}
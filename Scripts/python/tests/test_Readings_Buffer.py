@@ -0,0 +1,108 @@
+# Tests for Readings_Buffer.py - persistence and rising windows over the ring buffer (no database or network)
+
+import numpy as np
+import pytest
+
+import Readings_Buffer
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@pytest.fixture(autouse = True)
+def empty_buffer(monkeypatch):
+    '''
+    Every test starts with no buffer and a small capacity
+    '''
+
+    monkeypatch.setattr(Readings_Buffer, 'capacity', 4)
+    monkeypatch.setattr(Readings_Buffer, '_buffer', None)
+
+def update_ticks(sensor_indices, ticks):
+    '''
+    One Readings_Buffer.Update per tick (a list of readings lined up with sensor_indices)
+    '''
+
+    for readings in ticks:
+        Readings_Buffer.Update(sensor_indices, readings)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_no_buffer_is_never_persistent_or_rising():
+
+    assert not Readings_Buffer.Persistent([1, 2], 35, 1, 1).any()
+    assert not Readings_Buffer.Rising([1, 2], 4).any()
+    assert len(Readings_Buffer.Persistent([], 35, 1, 1)) == 0
+
+def test_persistent_k_of_n():
+
+    update_ticks([1, 2, 3], [[50, 10, 50],
+                             [10, 10, 50],
+                             [50, 50, 50]])
+
+    assert Readings_Buffer.Persistent([1, 2, 3], 35, 2, 3).tolist() == [True, False, True]
+    assert Readings_Buffer.Persistent([1, 2, 3], 35, 3, 3).tolist() == [False, False, True]
+    assert Readings_Buffer.Persistent([1, 2, 3], 35, 1, 1).tolist() == [True, True, True]
+
+def test_results_line_up_with_the_order_asked():
+
+    update_ticks([5, 1], [[50, 10]])
+
+    assert Readings_Buffer.Persistent([1, 5], 35, 1, 1).tolist() == [False, True]
+    assert Readings_Buffer.Persistent([5, 1], 35, 1, 1).tolist() == [True, False]
+
+def test_missing_readings_are_nan_and_never_count():
+
+    update_ticks([1, 2], [[50, 50]])
+    Readings_Buffer.Update([1], [50]) # sensor 2 missed this tick
+
+    assert Readings_Buffer.Persistent([1, 2], 35, 2, 2).tolist() == [True, False]
+
+def test_new_sensor_starts_empty():
+
+    update_ticks([1], [[50], [50]])
+    Readings_Buffer.Update([1, 2], [50, 50])
+
+    assert Readings_Buffer.Persistent([1, 2], 35, 2, 3).tolist() == [True, False]
+
+def test_ring_wraps_around_and_drops_the_oldest_readings():
+
+    update_ticks([1], [[50], [50], [50], [50]]) # fills capacity 4
+    update_ticks([1], [[10], [10], [10]]) # overwrites 3 of them
+
+    assert Readings_Buffer._buffer['ticks'] == 7
+    assert Readings_Buffer._buffer['position'] == 3
+    assert Readings_Buffer.Persistent([1], 35, 1, 4).tolist() == [True]
+    assert Readings_Buffer.Persistent([1], 35, 2, 4).tolist() == [False]
+    assert Readings_Buffer.Persistent([1], 35, 1, 3).tolist() == [False]
+
+def test_window_is_oldest_to_newest_after_wrap():
+
+    update_ticks([1], [[1], [2], [3], [4], [5], [6]])
+
+    assert Readings_Buffer._window(4)[0].tolist() == [3, 4, 5, 6]
+    assert Readings_Buffer._window(10)[0].tolist() == [3, 4, 5, 6] # capped at capacity
+
+def test_rising_needs_a_positive_slope_and_min_points():
+
+    update_ticks([1, 2, 3], [[10, 40, 10],
+                             [20, 30, 20],
+                             [30, 20, np.nan]])
+
+    assert Readings_Buffer.Rising([1, 2, 3], 3).tolist() == [True, False, False] # sensor 3 only has 2 points
+    assert Readings_Buffer.Rising([1, 2, 3], 3, min_points = 2).tolist() == [True, False, True]
+
+def test_rising_ignores_gaps():
+
+    update_ticks([1], [[10], [np.nan], [30], [40]])
+
+    assert Readings_Buffer.Rising([1], 4).tolist() == [True]
+
+def test_lone_jump_is_neither_persistent_nor_nearly_persistent():
+    '''
+    readings [10, 10, 500] with k = 3, n = 4 - rising, but only 1 reading over the threshold (see GetSort_Spikes.py)
+    '''
+
+    update_ticks([1], [[10], [10], [500]])
+
+    assert Readings_Buffer.Rising([1], 4).tolist() == [True]
+    assert Readings_Buffer.Persistent([1], 35, 3, 4).tolist() == [False]
+    assert Readings_Buffer.Persistent([1], 35, 2, 4).tolist() == [False]